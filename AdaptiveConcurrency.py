@@ -0,0 +1,155 @@
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from config import NO_CONCURRENT, ETSY_MIN_CONCURRENT, ETSY_MAX_CONCURRENT, ETSY_CONCURRENCY_LATENCY_TOLERANCE, \
+	ETSY_CONCURRENCY_BACKOFF
+from MyLogger import Logger
+logging = Logger().logging
+
+LATENCY_EWMA_ALPHA = 0.2
+BASELINE_DRIFT = 1.01
+
+
+def endpoint_key(url: str) -> str:
+	"""/shops/MyShop/receipts and /receipts/123,456 become /shops/:id/receipts and /receipts/:id"""
+	url = re.sub(r"^/shops/[^/]+", "/shops/:id", url)
+	return re.sub(r"/[0-9][0-9,]*", "/:id", url)
+
+
+class AdaptiveConcurrency:
+	"""
+		AIMD window for in-flight Etsy requests. The window grows by roughly one
+		request per round trip while latency stays close to the best latency seen,
+		and is cut by ETSY_CONCURRENCY_BACKOFF on 429/5xx, transport errors or
+		when latency climbs above ETSY_CONCURRENCY_LATENCY_TOLERANCE x baseline.
+		The window is enforced in AsyncEtsy.send, so callers that prefetch on
+		their own (e.g. parallel backfill windows) still share it.
+	"""
+
+	def __init__(self,
+	             initial: int = NO_CONCURRENT,
+	             minimum: int = ETSY_MIN_CONCURRENT,
+	             maximum: int = ETSY_MAX_CONCURRENT,
+	             latency_tolerance: float = ETSY_CONCURRENCY_LATENCY_TOLERANCE,
+	             backoff: float = ETSY_CONCURRENCY_BACKOFF):
+		self.minimum = minimum
+		self.maximum = maximum
+		self.window: float = float(min(max(initial, minimum), maximum))
+		self.latency_tolerance = latency_tolerance
+		self.backoff = backoff
+		self.latency_ewma: Optional[float] = None
+		self.baseline_latency: Optional[float] = None
+		self.last_decrease = 0.0
+		self.successes = 0
+		self.failures = 0
+		self.in_flight = 0
+		self.waiters: Deque[asyncio.Future] = deque()
+
+	@property
+	def limit(self) -> int:
+		return max(self.minimum, int(self.window))
+
+	async def acquire(self):
+		"""Waits until fewer than `limit` requests of this endpoint are in flight."""
+		if self.in_flight < self.limit and len(self.waiters) == 0:
+			self.in_flight += 1
+			return
+		waiter = asyncio.get_running_loop().create_future()
+		self.waiters.append(waiter)
+		try:
+			await waiter
+		except asyncio.CancelledError:
+			if waiter.done() and not waiter.cancelled():
+				# The slot was handed over right before the cancellation, pass it on.
+				self.release()
+			elif waiter in self.waiters:
+				self.waiters.remove(waiter)
+			raise
+
+	def release(self):
+		"""Synchronous, so a request cancelled in its finally can't keep its slot."""
+		self.in_flight -= 1
+		self.wake()
+
+	def wake(self):
+		# Slots are handed over to the waiters in order, in_flight counts them right away.
+		while len(self.waiters) > 0 and self.in_flight < self.limit:
+			waiter = self.waiters.popleft()
+			if not waiter.done():
+				self.in_flight += 1
+				waiter.set_result(None)
+
+	def on_success(self, latency: float):
+		self.successes += 1
+		if self.latency_ewma is None:
+			self.latency_ewma = latency
+		else:
+			self.latency_ewma = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.latency_ewma
+		if self.baseline_latency is None or latency < self.baseline_latency:
+			self.baseline_latency = latency
+		else:
+			# Let the baseline follow slow, permanent shifts in Etsy's latency.
+			self.baseline_latency = min(self.baseline_latency * BASELINE_DRIFT, self.latency_ewma)
+		if self.latency_ewma > self.baseline_latency * self.latency_tolerance:
+			self.decrease()
+		else:
+			self.window = min(self.maximum, self.window + 1 / self.window)
+			self.wake()
+
+	def on_failure(self):
+		self.failures += 1
+		self.decrease()
+
+	def decrease(self):
+		now = time.monotonic()
+		# Cut at most once per round trip, the requests already in flight
+		# were sent with the old window and will report the same congestion.
+		if self.latency_ewma is not None and now - self.last_decrease < self.latency_ewma:
+			return
+		self.last_decrease = now
+		self.window = max(self.minimum, self.window * self.backoff)
+
+	def metrics(self) -> dict:
+		return {
+			"limit": self.limit,
+			"window": round(self.window, 2),
+			"in_flight": self.in_flight,
+			"latency_ewma": self.latency_ewma,
+			"baseline_latency": self.baseline_latency,
+			"successes": self.successes,
+			"failures": self.failures
+		}
+
+
+class AdaptiveConcurrencyRegistry(object):
+	"""One AdaptiveConcurrency per (etsy connection, endpoint), shared by every sync in this process."""
+	_instance = None
+
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No AdaptiveConcurrencyRegistry found creating one.")
+			cls._instance = object.__new__(cls)
+			AdaptiveConcurrencyRegistry._instance.controllers = {}
+		return cls._instance
+
+	def __init__(self):
+		self.controllers: Dict[Tuple[str, str], AdaptiveConcurrency] = self._instance.controllers
+
+	def get(self, etsy_connection_id: str, url: str) -> AdaptiveConcurrency:
+		key = (etsy_connection_id, endpoint_key(url))
+		try:
+			return self.controllers[key]
+		except KeyError:
+			controller = AdaptiveConcurrency()
+			self.controllers[key] = controller
+			return controller
+
+	def metrics(self, etsy_connection_id: str) -> dict:
+		return {
+			endpoint: controller.metrics()
+			for (connection_id, endpoint), controller in self.controllers.items()
+			if connection_id == etsy_connection_id
+		}
@@ -4,12 +4,22 @@ from enum import Enum
 
 from authlib.integrations.httpx_client import AsyncOAuth1Client
 import asyncio
+import random
+import time
 from math import ceil
-from config import ETSY_API_BASE_URI, NO_CONCURRENT, LIMIT, ENV_MODE
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from config import ETSY_API_BASE_URI, NO_CONCURRENT, LIMIT, ENV_MODE, ETSY_HTTP2, ETSY_HTTP_MAX_CONNECTIONS, \
+	ETSY_HTTP_MAX_KEEPALIVE_CONNECTIONS, ETSY_HTTP_KEEPALIVE_EXPIRY, ETSY_HTTP_TIMEOUT, ETSY_HTTP_CONNECT_TIMEOUT, \
+	ETSY_MAX_RETRIES, ETSY_RETRY_BACKOFF_BASE, ETSY_RETRY_BACKOFF_MAX, ETSY_JSON_THREAD_THRESHOLD
 
+import httpx
+import orjson
 from bson import ObjectId
 from httpx import Response
 
+from AdaptiveConcurrency import AdaptiveConcurrency, AdaptiveConcurrencyRegistry
+from CircuitBreaker import CircuitBreaker, CircuitBreakerRegistry, CircuitOpenError
+from EtsyRateLimiter import EtsyRateLimiter
 from MyLogger import Logger
 logging = Logger().logging
 logging.info(f"{__name__}'s logger successfully created.")
@@ -26,80 +36,342 @@ class EtsyUrl:
 	findAllShopReceipts = lambda shop_id: "/shops/{shop_id}/receipts".format(shop_id=shop_id)
 	findAllShop_Receipt2Transactions = lambda receipt_id: "/receipts/{receipt_id}/transactions".format(receipt_id=receipt_id)
 	getShop_Receipt2 = lambda receipt_id_s: "/receipts/{receipt_id_s}".format(receipt_id_s=receipt_id_s)
+	findAllShopListingsActive = lambda shop_id: "/shops/{shop_id}/listings/active".format(shop_id=shop_id)
+	getListing = lambda listing_id_s: "/listings/{listing_id_s}".format(listing_id_s=listing_id_s)
+
+
+def http2_available() -> bool:
+	if not ETSY_HTTP2:
+		return False
+	try:
+		import h2
+	except ImportError:
+		logging.info("ETSY_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1.")
+		return False
+	return True
+
+
+def retry_after(res: Response) -> Optional[float]:
+	try:
+		return float(res.headers["Retry-After"])
+	except (KeyError, ValueError):
+		return None
+
+
+def is_retryable(status_code: int) -> bool:
+	return status_code == 429 or status_code >= 500
+
+
+def backoff_delay(attempt: int) -> float:
+	"""Exponential backoff with full jitter."""
+	return random.uniform(0, min(ETSY_RETRY_BACKOFF_MAX, ETSY_RETRY_BACKOFF_BASE * 2 ** attempt))
+
+
+class PageOutcome:
+	"""Result of fetching one page, so a sync can tell a complete run from a partial one."""
+	
+	def __init__(self, page: int, response: Optional[Response] = None, error: Optional[BaseException] = None,
+	             data: Optional[dict] = None, decode_seconds: Optional[float] = None):
+		self.page = page
+		self.response = response
+		self.error = error
+		self.data = data
+		self.decode_seconds = decode_seconds
+	
+	@property
+	def results(self) -> List[dict]:
+		return self.data["results"] if self.data is not None else []
+	
+	@property
+	def ok(self) -> bool:
+		return self.error is None and self.response is not None and self.response.status_code == 200 and self.data is not None
+	
+	@property
+	def status_code(self) -> Optional[int]:
+		return self.response.status_code if self.response is not None else None
+	
+	def __repr__(self):
+		return f"PageOutcome(page={self.page}, status_code={self.status_code}, error={self.error!r})"
+
+
+def all_pages_ok(outcomes: List[PageOutcome]) -> bool:
+	return len(outcomes) > 0 and all(outcome.ok for outcome in outcomes)
+
+
+class AsyncEtsyClientRegistry(object):
+	"""
+		Keeps one long-lived, pooled AsyncOAuth1Client per etsy connection so that
+		every page of every sync reuses the same keep-alive connections to Etsy.
+	"""
+	_instance = None
+	
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No AsyncEtsyClientRegistry found creating one.")
+			cls._instance = object.__new__(cls)
+			AsyncEtsyClientRegistry._instance.clients = {}
+			AsyncEtsyClientRegistry._instance.retiring = set()
+		return cls._instance
+	
+	def __init__(self):
+		self.clients: Dict[str, Tuple[AsyncOAuth1Client, tuple]] = self._instance.clients
+		# Close tasks of replaced clients, referenced until they are done so they can't be garbage collected.
+		self.retiring: Set[Task] = self._instance.retiring
+	
+	@staticmethod
+	def create_client(client_id: str, client_secret: str, token: str, token_secret: str) -> AsyncOAuth1Client:
+		return AsyncOAuth1Client(
+			client_id,
+			client_secret,
+			token,
+			token_secret,
+			http2=http2_available(),
+			limits=httpx.Limits(
+				max_connections=ETSY_HTTP_MAX_CONNECTIONS,
+				max_keepalive_connections=ETSY_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+				keepalive_expiry=ETSY_HTTP_KEEPALIVE_EXPIRY),
+			timeout=httpx.Timeout(ETSY_HTTP_TIMEOUT, connect=ETSY_HTTP_CONNECT_TIMEOUT))
+	
+	def get_client(self, key: str, client_id: str, client_secret: str, token: str, token_secret: str) -> AsyncOAuth1Client:
+		credentials = (client_id, client_secret, token, token_secret)
+		try:
+			client, client_credentials = self.clients[key]
+		except KeyError:
+			pass
+		else:
+			if client_credentials == credentials and not client.is_closed:
+				return client
+			# Tokens were rotated (e.g. the shop was re-connected), retire the old pool.
+			logging.info(f"{key} credentials changed, replacing its pooled Etsy client.")
+			if not client.is_closed:
+				self.retire(key, client)
+		client = AsyncEtsyClientRegistry.create_client(client_id, client_secret, token, token_secret)
+		self.clients[key] = (client, credentials)
+		return client
+	
+	def retire(self, key: str, client: AsyncOAuth1Client):
+		task = asyncio.get_running_loop().create_task(client.aclose())
+		self.retiring.add(task)
+		
+		def retired(task: Task):
+			self.retiring.discard(task)
+			if not task.cancelled() and task.exception() is not None:
+				logging.error(f"{key} replaced Etsy client failed to close: {task.exception()!r}")
+		
+		task.add_done_callback(retired)
+	
+	async def close(self, key: str):
+		entry = self.clients.pop(key, None)
+		if entry is not None and not entry[0].is_closed:
+			await entry[0].aclose()
+	
+	async def close_all(self):
+		for key in list(self.clients.keys()):
+			await self.close(key)
+		await asyncio.gather(*self.retiring, return_exceptions=True)
+		logging.info("All pooled Etsy clients are closed.")
 
 
 class AsyncEtsy:
 	
-	def __init__(self, client_id: str, client_secret: str, token: str, token_secret: str, shop_id: str):
+	def __init__(self, client_id: str, client_secret: str, token: str, token_secret: str, shop_id: str,
+	             etsy_connection_id: Optional[str] = None):
 		self.client_id = client_id
 		self.client_secret = client_secret
 		self.token = token
 		self.token_secret = token_secret
 		self.shop_id = shop_id
+		self.etsy_connection_id = etsy_connection_id if etsy_connection_id is not None else shop_id
+		self.rate_limiter = EtsyRateLimiter(client_id)
+		self.decode_stats = {"pages": 0, "bytes": 0, "seconds": 0.0, "off_loop": 0}
+	
+	@property
+	def client(self) -> AsyncOAuth1Client:
+		return AsyncEtsyClientRegistry().get_client(
+			self.etsy_connection_id,
+			self.client_id,
+			self.client_secret,
+			self.token,
+			self.token_secret)
+	
+	@property
+	def circuit_breaker(self) -> CircuitBreaker:
+		return CircuitBreakerRegistry().get(self.etsy_connection_id)
+	
+	def concurrency(self, url: str) -> AdaptiveConcurrency:
+		return AdaptiveConcurrencyRegistry().get(self.etsy_connection_id, url)
+	
+	@staticmethod
+	async def close_all_clients():
+		await AsyncEtsyClientRegistry().close_all()
 		
 	# async def requestToDb(self, method, url, params):
 	
 	async def request(self, method: Method, url: str, params: dict = None):
+		"""
+			Sends the request, retrying timeouts, transport errors, 429 and 5xx with
+			exponential backoff (or Etsy's Retry-After) up to ETSY_MAX_RETRIES times.
+			Raises CircuitOpenError without calling Etsy while the shop's circuit is open.
+		"""
+		breaker = self.circuit_breaker
+		attempt = 0
+		while True:
+			breaker.before_request()
+			try:
+				res = await self.send(method, url, params)
+			except httpx.TransportError as e:
+				breaker.record_failure()
+				if attempt >= ETSY_MAX_RETRIES:
+					raise
+				delay = backoff_delay(attempt)
+				reason = repr(e)
+			except BaseException:
+				# Cancelled (e.g. iter_pages stopped early) or failed before Etsy answered,
+				# a half open circuit mustn't keep waiting for this probe.
+				breaker.record_abandoned()
+				raise
+			else:
+				if not is_retryable(res.status_code):
+					breaker.record_success()
+					return res
+				breaker.record_failure()
+				if attempt >= ETSY_MAX_RETRIES:
+					return res
+				delay = retry_after(res)
+				if delay is None:
+					delay = backoff_delay(attempt)
+				reason = res.status_code
+			attempt += 1
+			logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} ({url}) failed with {reason}, retry #{attempt} in {round(delay, 2)}s")
+			await asyncio.sleep(delay)
+	
+	async def send(self, method: Method, url: str, params: dict = None):
 		if params is None:
 			params = {"limit": LIMIT}
+		concurrency = self.concurrency(url)
 		url = ETSY_API_BASE_URI + url
 		logging.info(colored(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Starting to fetch ({url})", on_color='on_grey'))
-		params["limit"] = LIMIT
-		async with AsyncOAuth1Client(self.client_id, self.client_secret, self.token, self.token_secret) as etsy:
-			# print(params)
-			res = await etsy.request(method=method.value, url=url, params=params, timeout=None)
-			# print(f"({url}) Fetched page #{res.json()['params']['page']} {res.status_code}")
-			if res.status_code != 200:
-				logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Text) =)> {res.text}")
-				logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Reason Phrase) =)> {res.reason_phrase}")
-				try:
-					logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Error Detail) =)> {res.headers['X-Error-Detail']}")
-				except KeyError:
-					pass
-
-			logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Done ... ({method}) ({url}) ({colored(str(res.status_code), 'green' if res.status_code == 200 else 'red', attrs=['reverse', 'blink', 'bold', 'underline'])}) ({params})")
+		params.setdefault("limit", LIMIT)
+		await concurrency.acquire()
+		try:
+			await self.rate_limiter.acquire()
+			started_at = time.monotonic()
+			try:
+				res = await self.client.request(method=method.value, url=url, params=params)
+			except httpx.TransportError:
+				concurrency.on_failure()
+				raise
+		finally:
+			concurrency.release()
+		await self.rate_limiter.update_from_headers(res.headers)
+		if res.status_code == 429:
+			await self.rate_limiter.penalize(retry_after(res))
+		if res.status_code == 429 or res.status_code >= 500:
+			concurrency.on_failure()
+		else:
+			concurrency.on_success(time.monotonic() - started_at)
+		# print(f"({url}) Fetched page #{res.json()['params']['page']} {res.status_code}")
+		if res.status_code != 200:
+			logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Text) =)> {res.text}")
+			logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Reason Phrase) =)> {res.reason_phrase}")
+			try:
+				logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} (Error Detail) =)> {res.headers['X-Error-Detail']}")
+			except KeyError:
+				pass
+
+		logging.info(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Done ... ({method}) ({url}) ({colored(str(res.status_code), 'green' if res.status_code == 200 else 'red', attrs=['reverse', 'blink', 'bold', 'underline'])}) ({params})")
 		return res
 	
 	async def requestByPage(self, method, url, params, page):
-		if params is None:
-			params = {}
+		# Every page runs concurrently, so each one needs its own copy of params.
+		params = dict(params) if params is not None else {}
 		params["page"] = page
 		res = await self.request(method, url, params)
 		return res
 	
-	async def getAllPages(self, loop, method, url, params=None):
-		responses = []
+	async def outcomeByPage(self, method, url, params, page) -> PageOutcome:
+		try:
+			res = await self.requestByPage(method, url, params, page)
+		except (httpx.TransportError, CircuitOpenError) as e:
+			logging.error(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Page #{page} of {url} failed. {e!r}")
+			return PageOutcome(page, error=e)
+		if res.status_code != 200:
+			return PageOutcome(page, response=res)
+		try:
+			data, decode_seconds = await self.decode(res)
+		except ValueError as e:
+			logging.error(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Page #{page} of {url} is not valid JSON. {e!r}")
+			return PageOutcome(page, response=res, error=e)
+		return PageOutcome(page, response=res, data=data, decode_seconds=decode_seconds)
+	
+	async def decode(self, res: Response) -> Tuple[dict, float]:
+		"""
+			Parses the body with orjson. Pages above ETSY_JSON_THREAD_THRESHOLD bytes
+			are parsed in the default executor so they don't hold up the event loop.
+		"""
+		content = res.content
+		off_loop = len(content) > ETSY_JSON_THREAD_THRESHOLD
+		started_at = time.perf_counter()
+		if off_loop:
+			data = await asyncio.get_running_loop().run_in_executor(None, orjson.loads, content)
+		else:
+			data = orjson.loads(content)
+		decode_seconds = time.perf_counter() - started_at
+		self.decode_stats["pages"] += 1
+		self.decode_stats["bytes"] += len(content)
+		self.decode_stats["seconds"] += decode_seconds
+		self.decode_stats["off_loop"] += int(off_loop)
+		logging.debug(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} decoded {len(content)} bytes in {round(decode_seconds * 1000, 2)}ms{' (worker thread)' if off_loop else ''}")
+		return data, decode_seconds
+	
+	async def iter_pages(self, method: Method, url: str, params: dict = None,
+	                     ordered: bool = False, prefetch: Optional[int] = None) -> AsyncIterator[PageOutcome]:
+		"""
+			Yields one PageOutcome per page as soon as it is downloaded and parsed.
+			The first page is fetched once and reused for `count`. At most `prefetch`
+			pages (the shop's adaptive concurrency limit by default) are in flight or
+			waiting to be consumed. With ordered=True pages are yielded 1, 2, 3, ...
+		"""
 		if params is None:
 			params = {}
-		count_res = await self.request(method, url, params)
-		################################
-		if count_res.status_code != 200:
-			return responses
-		################################
-		count = count_res.json()["count"]
+		first_outcome = await self.outcomeByPage(method, url, params, 1)
+		yield first_outcome
+		if not first_outcome.ok:
+			return
+		count = first_outcome.data["count"]
+		last_page = ceil(count / params.get("limit", LIMIT))
 		logging.info(colored(f"{colored(self.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} Total {count} item has been found for {url}", 'blue', 'on_white', attrs=['reverse', 'blink']))
+		concurrency = self.concurrency(url)
+		loop = asyncio.get_running_loop()
 		dltasks = set()
-		next_page = 1
-		while next_page <= ceil(count / LIMIT):
-			if len(dltasks) >= NO_CONCURRENT:
+		buffered: Dict[int, PageOutcome] = {}
+		next_page = 2
+		next_to_yield = 2
+		try:
+			while next_page <= last_page or len(dltasks) > 0 or len(buffered) > 0:
+				window = prefetch if prefetch is not None else concurrency.limit
+				while next_page <= last_page and len(dltasks) + len(buffered) < window:
+					dltasks.add(loop.create_task(self.outcomeByPage(method, url, params, next_page)))
+					next_page += 1
+				if ordered and next_to_yield in buffered:
+					yield buffered.pop(next_to_yield)
+					next_to_yield += 1
+					continue
 				_done, dltasks = await asyncio.wait(dltasks, return_when=asyncio.FIRST_COMPLETED)
-				task: Task = next(iter(_done))
-				res: Response = task.result()
-				responses.append(res)
-				# print(_done[0])
-			
-			dltasks.add(loop.create_task(self.requestByPage(method, url, params, next_page)))
-			next_page += 1
-		
-		if len(dltasks) <= 0:
-			return responses
-		done, pending = await asyncio.wait(dltasks)
-		t: Task
-		for t in done:
-			logging.info(t)
-			res: Response = t.result()
-			responses.append(res)
-		return responses
+				for task in _done:
+					outcome: PageOutcome = task.result()
+					if ordered:
+						buffered[outcome.page] = outcome
+					else:
+						yield outcome
+		finally:
+			for task in dltasks:
+				task.cancel()
+	
+	async def getAllPages(self, loop, method, url, params=None) -> List[PageOutcome]:
+		outcomes: List[PageOutcome] = [outcome async for outcome in self.iter_pages(method, url, params)]
+		outcomes.sort(key=lambda outcome: outcome.page)
+		return outcomes
 	
 	async def getAllTransactions(self, loop, receipt_ids):
 		transactions_by_receipt_id = {}
@@ -107,14 +379,16 @@ class AsyncEtsy:
 		receipt_ids_index = 0
 		while receipt_ids_index < len(receipt_ids):
 			mongodb_id, receipt_id = receipt_ids[receipt_ids_index]
-			if len(dltasks) >= NO_CONCURRENT:
+			concurrency = self.concurrency(EtsyUrl.findAllShop_Receipt2Transactions(receipt_id))
+			while len(dltasks) >= concurrency.limit:
 				_done, dltasks = await asyncio.wait(dltasks, return_when=asyncio.FIRST_COMPLETED)
-				task: Task = next(iter(_done))
-				res: Response = task.result()
-				transactions_by_receipt_id[receipt_id] = {
-					"mongodb_id": mongodb_id,
-					"transactions": res.json()["results"]
-				}
+				for task in _done:
+					done_mongodb_id, done_receipt_id = task.get_name().split(":")
+					res: Response = task.result()
+					transactions_by_receipt_id[done_receipt_id] = {
+						"mongodb_id": done_mongodb_id,
+						"transactions": res.json()["results"]
+					}
 				
 			dltasks.add(
 				loop.create_task(
@@ -123,7 +397,6 @@ class AsyncEtsy:
 						EtsyUrl.findAllShop_Receipt2Transactions(receipt_id)),
 					name=f"{mongodb_id}:{receipt_id}")
 			)
-			await asyncio.sleep(0.25)
 			receipt_ids_index += 1
 		
 		logging.info("Last transactions")
@@ -169,5 +442,6 @@ class AsyncEtsy:
 			etsy_connection["app_secret"],
 			etsy_connection["etsy_oauth_token"],
 			etsy_connection["etsy_oauth_token_secret"],
-			etsy_connection["etsy_shop_name"])
+			etsy_connection["etsy_shop_name"],
+			etsy_connection_id)
 		return async_etsy_api
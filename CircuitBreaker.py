@@ -0,0 +1,104 @@
+import time
+from enum import Enum
+from typing import Dict, Optional
+
+from config import ETSY_CIRCUIT_FAILURE_THRESHOLD, ETSY_CIRCUIT_RESET_TIMEOUT
+from MyLogger import Logger
+logging = Logger().logging
+
+
+class CircuitState(str, Enum):
+	closed = "CLOSED"
+	open = "OPEN"
+	half_open = "HALF_OPEN"
+
+
+class CircuitOpenError(Exception):
+	def __init__(self, key: str, retry_in: float):
+		self.key = key
+		self.retry_in = retry_in
+		super().__init__(f"Circuit for {key} is open, retry in {round(retry_in)}s")
+
+
+class CircuitBreaker:
+	"""
+		Stops sending requests for a shop after ETSY_CIRCUIT_FAILURE_THRESHOLD
+		consecutive failures. After ETSY_CIRCUIT_RESET_TIMEOUT seconds one probe is
+		let through (half open); its success closes the circuit, its failure
+		opens it again. A probe that ends without an answer (cancelled, or an
+		error that isn't Etsy's) lets the next request probe instead, and a probe
+		still pending after ETSY_CIRCUIT_RESET_TIMEOUT seconds is given up on.
+	"""
+
+	def __init__(self, key: str,
+	             failure_threshold: int = ETSY_CIRCUIT_FAILURE_THRESHOLD,
+	             reset_timeout: float = ETSY_CIRCUIT_RESET_TIMEOUT):
+		self.key = key
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.state = CircuitState.closed
+		self.consecutive_failures = 0
+		self.opened_at: Optional[float] = None
+		self.probe_started_at: Optional[float] = None
+
+	def before_request(self):
+		if self.state == CircuitState.closed:
+			return
+		now = time.monotonic()
+		if self.state == CircuitState.half_open and now - self.probe_started_at >= self.reset_timeout:
+			logging.error(f"({self.key}) circuit probe got no answer in {self.reset_timeout}s, probing again.")
+			self.probe_started_at = now
+			return
+		elapsed = now - self.opened_at
+		if self.state == CircuitState.open and elapsed >= self.reset_timeout:
+			logging.info(f"({self.key}) circuit is half open, letting a probe request through.")
+			self.state = CircuitState.half_open
+			self.probe_started_at = now
+			return
+		raise CircuitOpenError(self.key, max(0.0, self.reset_timeout - elapsed))
+
+	def record_success(self):
+		if self.state != CircuitState.closed:
+			logging.info(f"({self.key}) circuit is closed again.")
+		self.state = CircuitState.closed
+		self.consecutive_failures = 0
+		self.opened_at = None
+		self.probe_started_at = None
+
+	def record_abandoned(self):
+		"""The request ended without an answer from Etsy, it counts neither way."""
+		if self.state == CircuitState.half_open:
+			# opened_at is kept, so the next request is let through as the probe.
+			self.state = CircuitState.open
+			self.probe_started_at = None
+
+	def record_failure(self):
+		self.consecutive_failures += 1
+		if self.state == CircuitState.half_open or self.consecutive_failures >= self.failure_threshold:
+			if self.state != CircuitState.open:
+				logging.error(f"({self.key}) circuit opened after {self.consecutive_failures} consecutive failures.")
+			self.state = CircuitState.open
+			self.opened_at = time.monotonic()
+			self.probe_started_at = None
+
+
+class CircuitBreakerRegistry(object):
+	_instance = None
+
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No CircuitBreakerRegistry found creating one.")
+			cls._instance = object.__new__(cls)
+			CircuitBreakerRegistry._instance.breakers = {}
+		return cls._instance
+
+	def __init__(self):
+		self.breakers: Dict[str, CircuitBreaker] = self._instance.breakers
+
+	def get(self, key: str) -> CircuitBreaker:
+		try:
+			return self.breakers[key]
+		except KeyError:
+			breaker = CircuitBreaker(key)
+			self.breakers[key] = breaker
+			return breaker
@@ -1,4 +1,5 @@
 import pprint
+from typing import List
 
 import requests
 from bson.objectid import ObjectId
@@ -6,6 +7,8 @@ from requests import HTTPError, Response
 from requests_oauthlib import OAuth1Session
 # from async_oauthlib import OAuth1Session
 from EtsyAPISession import EtsyAPISession
+from AsyncEtsyApi import AsyncEtsy, Method, PageOutcome
+from EtsyCache import EtsyReadCache, CachedResource
 from schemas import ReceiptStatus
 from config import ETSY_API_BASE_URI
 
@@ -34,6 +37,21 @@ async def create_etsy_api_with_etsy_connection(db, etsy_connection_id: str, want
 		return etsy_connection, etsy_api
 
 
+async def create_async_etsy_api_with_etsy_connection(db, etsy_connection_id: str, want: int = 2):
+	_id: ObjectId = ObjectId(etsy_connection_id)
+	etsy_connection = await db["EtsyShopConnections"].find_one({"_id": _id})
+	etsy_api = AsyncEtsyAPI(AsyncEtsy(etsy_connection["app_key"],
+	                                  etsy_connection["app_secret"],
+	                                  etsy_connection["etsy_oauth_token"],
+	                                  etsy_connection["etsy_oauth_token_secret"],
+	                                  etsy_connection.get("etsy_shop_name") or "__SELF__",
+	                                  etsy_connection_id))
+	if want == 1:
+		return etsy_api
+	else:
+		return etsy_connection, etsy_api
+
+
 class EtsyAPI:
 	
 	def __init__(self, session: OAuth1Session):
@@ -181,3 +199,97 @@ class EtsyAPI:
 		res_json = response.json()
 		pprint.pprint(res_json)
 		print(res_json["count"])
+
+
+class AsyncEtsyAPI:
+	"""
+		Non-blocking EtsyAPI with the same methods. Requests go through AsyncEtsy,
+		so they share the shop's pooled client, rate limiter, retries and circuit
+		breaker, and paginated calls fetch their pages concurrently. Receipts,
+		listings, shipping templates and listing images are read through
+		EtsyReadCache.
+	"""
+	
+	def __init__(self, async_etsy: AsyncEtsy):
+		self.__async_etsy = async_etsy
+		self.__cache = EtsyReadCache(async_etsy.etsy_connection_id)
+	
+	def get_session(self) -> AsyncEtsy:
+		return self.__async_etsy
+	
+	async def __all_results(self, url: str, params: dict = None) -> dict:
+		outcomes = [outcome async for outcome in self.__async_etsy.iter_pages(Method.get, url, params)]
+		failed: List[PageOutcome] = [outcome for outcome in outcomes if not outcome.ok]
+		if len(failed) > 0:
+			raise HTTPError(f"{url} could not be fetched {failed}")
+		return {
+			"count": outcomes[0].data["count"],
+			"results": [result for outcome in outcomes for result in outcome.results]
+		}
+	
+	async def findUserProfile(self):
+		return await self.__async_etsy.request(Method.get, "/users/__SELF__/profile")
+	
+	async def findAllUserShops(self):
+		response = await self.__async_etsy.request(Method.get, "/users/__SELF__/shops")
+		if response.status_code == 200:
+			return response
+		raise HTTPError("User shops not found")
+	
+	async def getUser(self):
+		return await self.__async_etsy.request(Method.get, "/users/__SELF__")
+	
+	async def getShop_Receipt2(self, receipt_id: int):
+		receipt = await self.__cache.get(
+			CachedResource.receipt, receipt_id,
+			lambda: self.__async_etsy.request(Method.get, f"/receipts/{receipt_id}"))
+		return receipt["results"]
+	
+	async def findAllShopReceipts(self, shop_id: str, **kwargs):
+		params = {}
+		for k, v in kwargs.items():
+			if v is not None:
+				if k == "was_shipped" or k == "was_paid":
+					v = str(v).lower()
+				params[k] = v
+		try:
+			all_receipts = await self.__all_results(f"/shops/{shop_id}/receipts", params)
+		except HTTPError as e:
+			return "Error: " + str(e)
+		return {
+			"results": all_receipts["results"]
+		}
+	
+	async def findAllShopTransactions(self, shop_id: str):
+		return await self.__async_etsy.request(Method.get, f"/shops/{shop_id}/transactions")
+	
+	async def findAllShop_Receipt2Transactions(self, receipt_id):
+		all_transactions = await self.__all_results(f"/receipts/{receipt_id}/transactions")
+		return {
+			"results": all_transactions["results"]
+		}
+	
+	async def getImage_Listing(self, listing_id: str, listing_image_id: str) -> dict:
+		return await self.__cache.get(
+			CachedResource.image, f"{listing_id}:{listing_image_id}",
+			lambda: self.__async_etsy.request(Method.get, f"/listings/{listing_id}/images/{listing_image_id}"))
+	
+	async def searchAllShopReceipts(self, shop_id: str, search_query: str = '14957 Clemson Dr'):
+		all_receipts = await self.__all_results(f"/shops/{shop_id}/receipts/search", {"search_query": search_query})
+		return {
+			"results": all_receipts["results"]
+		}
+	
+	async def getListing(self, listing_id):
+		return await self.__cache.get(
+			CachedResource.listing, listing_id,
+			lambda: self.__async_etsy.request(Method.get, f"/listings/{listing_id}"))
+	
+	async def getShippingTemplate(self, shipping_template_id):
+		return await self.__cache.get(
+			CachedResource.shipping_template, shipping_template_id,
+			lambda: self.__async_etsy.request(Method.get, f"/shipping/templates/{shipping_template_id}"))
+	
+	async def findAllShopReceiptsByStatus(self, shop_id: str, status: ReceiptStatus):
+		response = await self.__async_etsy.request(Method.get, f"/shops/{shop_id}/receipts/{status}")
+		return response.json()
@@ -1,7 +1,11 @@
 from requests_oauthlib import OAuth1Session
 # from async_oauthlib import OAuth1Session
 from requests_oauthlib.oauth1_session import TokenRequestDenied
-from config import ETSY_API_KEY, ETSY_API_SECRET, CALLBACK_URI
+from authlib.integrations.httpx_client import AsyncOAuth1Client, OAuthError
+from config import ETSY_API_KEY, ETSY_API_SECRET, CALLBACK_URI, ETSY_HTTP_TIMEOUT
+
+REQUEST_TOKEN_URL = "https://openapi.etsy.com/v2/oauth/request_token?scope=email_r%20listings_r%20transactions_r%20profile_r%20address_r%20shops_rw"
+ACCESS_TOKEN_URL = "https://openapi.etsy.com/v2/oauth/access_token"
 
 
 def check_keys_and_secrets(*args):
@@ -60,7 +64,7 @@ class EtsyAPISession:
 			callback_uri=CALLBACK_URI
 		)
 		request_token_dict = oauth_session.fetch_request_token(
-			url="https://openapi.etsy.com/v2/oauth/request_token?scope=email_r%20listings_r%20transactions_r%20profile_r%20address_r%20shops_rw"
+			url=REQUEST_TOKEN_URL
 		)
 		return request_token_dict
 	
@@ -79,10 +83,46 @@ class EtsyAPISession:
 		)
 		try:
 			access_token_dict = oauth_session.fetch_access_token(
-				url="https://openapi.etsy.com/v2/oauth/access_token",
+				url=ACCESS_TOKEN_URL,
 				verifier=verifier
 			)
 		except TokenRequestDenied as e:
 			return {}
 		else:
 			return access_token_dict
+	
+	@staticmethod
+	async def async_get_request_token(
+			client_key=None,
+			client_secret=None):
+		"""Same as get_request_token without blocking the event loop."""
+		if client_key is None or client_secret is None:
+			client_key = ETSY_API_KEY
+			client_secret = ETSY_API_SECRET
+		async with AsyncOAuth1Client(
+				client_key,
+				client_secret,
+				redirect_uri=CALLBACK_URI,
+				timeout=ETSY_HTTP_TIMEOUT) as oauth_client:
+			request_token_dict = await oauth_client.fetch_request_token(REQUEST_TOKEN_URL)
+		return request_token_dict
+	
+	@staticmethod
+	async def async_get_access_token(resource_owner_key: str, resource_owner_secret: str, verifier: str,
+	                                 client_key=None,
+	                                 client_secret=None):
+		"""Same as get_access_token without blocking the event loop, {} when Etsy denies the token."""
+		if client_key is None or client_secret is None:
+			client_key = ETSY_API_KEY
+			client_secret = ETSY_API_SECRET
+		async with AsyncOAuth1Client(
+				client_key,
+				client_secret,
+				token=resource_owner_key,
+				token_secret=resource_owner_secret,
+				timeout=ETSY_HTTP_TIMEOUT) as oauth_client:
+			try:
+				access_token_dict = await oauth_client.fetch_access_token(ACCESS_TOKEN_URL, verifier=verifier)
+			except OAuthError as e:
+				return {}
+		return access_token_dict
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+from enum import Enum
+from typing import Awaitable, Callable, Iterable, Set
+
+from httpx import Response
+from aioredis import RedisError
+
+from config import ETSY_CACHE_TTL_RECEIPT, ETSY_CACHE_TTL_LISTING, ETSY_CACHE_TTL_SHIPPING_TEMPLATE, \
+	ETSY_CACHE_TTL_IMAGE, ETSY_CACHE_STALE_TTL
+from database import MyRedis
+from MyLogger import Logger
+logging = Logger().logging
+
+REFRESH_LOCK_SECONDS = 30
+
+
+class CachedResource(str, Enum):
+	receipt = "receipt"
+	listing = "listing"
+	shipping_template = "shipping_template"
+	image = "image"
+
+
+RESOURCE_TTL = {
+	CachedResource.receipt: ETSY_CACHE_TTL_RECEIPT,
+	CachedResource.listing: ETSY_CACHE_TTL_LISTING,
+	CachedResource.shipping_template: ETSY_CACHE_TTL_SHIPPING_TEMPLATE,
+	CachedResource.image: ETSY_CACHE_TTL_IMAGE
+}
+
+
+class EtsyErrorResponse(Exception):
+	"""A non-200 Etsy response on a cached route, its body is kept as is (often plain text)."""
+
+	def __init__(self, res: Response):
+		self.status_code = res.status_code
+		self.text = res.text
+		self.content_type = res.headers.get("content-type", "text/plain")
+		super().__init__(f"Etsy answered {res.status_code}: {res.text[:200]}")
+
+
+def decode(res: Response) -> dict:
+	if res.status_code != 200:
+		raise EtsyErrorResponse(res)
+	return res.json()
+
+
+class EtsyReadCache:
+	"""
+		Read-through Redis cache for single Etsy resources. An entry is fresh for
+		its resource's TTL; after that it is served stale for up to
+		ETSY_CACHE_STALE_TTL seconds while one request refreshes it in the
+		background. Only 200 responses are decoded and cached, any other one is
+		raised as EtsyErrorResponse.
+	"""
+	# Keeps background refreshes referenced until they finish.
+	refreshing: Set[asyncio.Task] = set()
+
+	def __init__(self, etsy_connection_id: str):
+		self.etsy_connection_id = etsy_connection_id
+
+	def key(self, resource: CachedResource, resource_id) -> str:
+		return f"etsy_cache:{self.etsy_connection_id}:{resource.value}:{resource_id}"
+
+	async def get(self, resource: CachedResource, resource_id, fetch: Callable[[], Awaitable[Response]]) -> dict:
+		key = self.key(resource, resource_id)
+		r = MyRedis().r
+		try:
+			cached = await r.get(key)
+		except RedisError as e:
+			logging.error(f"Etsy read cache is unavailable, fetching {key} from Etsy. {e}")
+			return decode(await fetch())
+		if cached is None:
+			return await self.fetch_and_store(resource, key, fetch)
+		entry = json.loads(cached)
+		if time.time() - entry["fetched_at"] > RESOURCE_TTL[resource] and \
+				await self.lock_refresh(key):
+			task = asyncio.get_running_loop().create_task(self.revalidate(resource, key, fetch))
+			EtsyReadCache.refreshing.add(task)
+			task.add_done_callback(EtsyReadCache.refreshing.discard)
+		return entry["data"]
+
+	async def fetch_and_store(self, resource: CachedResource, key: str, fetch: Callable[[], Awaitable[Response]]) -> dict:
+		try:
+			res = await fetch()
+		except Exception as e:
+			logging.error(f"Couldn't refresh {key}. {e!r}")
+			raise
+		if res.status_code != 200:
+			logging.info(f"Etsy answered {res.status_code} for {key}, it isn't cached.")
+			raise EtsyErrorResponse(res)
+		data = res.json()
+		r = MyRedis().r
+		try:
+			async with r.pipeline(transaction=False) as pipe:
+				pipe.set(key, json.dumps({"fetched_at": time.time(), "data": data}),
+				         ex=RESOURCE_TTL[resource] + ETSY_CACHE_STALE_TTL)
+				pipe.delete(f"{key}:refreshing")
+				await pipe.execute()
+		except RedisError as e:
+			logging.error(f"Couldn't store {key} in the Etsy read cache. {e}")
+		return data
+
+	@staticmethod
+	async def lock_refresh(key: str) -> bool:
+		try:
+			return await MyRedis().r.set(f"{key}:refreshing", 1, nx=True, ex=REFRESH_LOCK_SECONDS)
+		except RedisError as e:
+			logging.error(f"Couldn't lock {key} for a refresh, serving it stale. {e}")
+			return False
+
+	async def revalidate(self, resource: CachedResource, key: str, fetch: Callable[[], Awaitable[Response]]):
+		try:
+			await self.fetch_and_store(resource, key, fetch)
+		except Exception:
+			# Already logged, the stale entry is served until the next attempt.
+			pass
+
+	async def invalidate(self, resource: CachedResource, resource_ids: Iterable):
+		keys = [self.key(resource, resource_id) for resource_id in resource_ids]
+		if len(keys) == 0:
+			return
+		try:
+			await MyRedis().r.delete(*keys)
+		except RedisError as e:
+			logging.error(f"Couldn't invalidate {len(keys)} {resource.value} entries of the Etsy read cache. {e}")
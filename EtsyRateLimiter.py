@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import Optional
+
+from aioredis import RedisError
+
+from config import ETSY_RATE_LIMIT_PER_SECOND, ETSY_RATE_LIMIT_BURST, ETSY_RATE_LIMIT_DAILY_RESERVE
+from database import MyRedis
+from MyLogger import Logger
+logging = Logger().logging
+
+# Token bucket shared by every process that talks to Etsy with the same app_key.
+# Tokens may go negative: a caller always takes its token and sleeps for the
+# returned number of milliseconds, which keeps the callers in arrival order.
+# When Etsy tells us (X-RateLimit-Remaining) that the daily budget is almost
+# spent, the refill rate drops to what the daily limit can sustain.
+ACQUIRE_SCRIPT = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local reserve = tonumber(ARGV[5])
+
+local state = redis.call('HMGET', key, 'tokens', 'ts', 'remaining', 'limit')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+local remaining = tonumber(state[3])
+local limit = tonumber(state[4])
+if tokens == nil or ts == nil then
+	tokens = capacity
+	ts = now
+end
+if remaining ~= nil and limit ~= nil and remaining <= reserve then
+	rate = math.min(rate, limit / 86400)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+tokens = tokens - requested
+local wait = 0
+if tokens < 0 then
+	wait = math.ceil(-tokens * 1000 / rate)
+end
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now, 'rate', tostring(rate), 'last_wait_ms', wait)
+redis.call('HINCRBY', key, 'acquired', requested)
+redis.call('HINCRBY', key, 'total_wait_ms', wait)
+redis.call('EXPIRE', key, 86400)
+return wait
+"""
+
+PENALIZE_SCRIPT = """
+local key = KEYS[1]
+local state = redis.call('HMGET', key, 'tokens', 'rate')
+local tokens = tonumber(state[1])
+local rate = tonumber(state[2]) or tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local penalty = tonumber(ARGV[3])
+if tokens == nil then
+	tokens = 0
+end
+tokens = math.min(tokens, -penalty * rate / 1000)
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+redis.call('HINCRBY', key, 'throttled', 1)
+return tokens
+"""
+
+
+class EtsyRateLimiter:
+	"""
+		Cluster-wide token bucket for the Etsy API, one per app_key, kept in Redis
+		so that the web workers and the clock process share the same budget.
+	"""
+
+	def __init__(self, app_key: str,
+	             rate: float = ETSY_RATE_LIMIT_PER_SECOND,
+	             capacity: int = ETSY_RATE_LIMIT_BURST,
+	             reserve: int = ETSY_RATE_LIMIT_DAILY_RESERVE):
+		self.app_key = app_key
+		self.rate = rate
+		self.capacity = capacity
+		self.reserve = reserve
+		self.key = f"etsy_rate_limit:{app_key}"
+
+	@staticmethod
+	def now_ms() -> int:
+		return int(time.time() * 1000)
+
+	async def acquire(self, requested: int = 1) -> float:
+		"""Take `requested` tokens, sleeping until they are available. Returns the seconds waited."""
+		r = MyRedis().r
+		try:
+			wait_ms = await r.register_script(ACQUIRE_SCRIPT)(
+				keys=[self.key],
+				args=[self.rate, self.capacity, EtsyRateLimiter.now_ms(), requested, self.reserve])
+		except RedisError as e:
+			logging.error(f"Etsy rate limiter is unavailable, continuing without it. {e}")
+			return 0
+		wait = int(wait_ms) / 1000
+		if wait > 0:
+			logging.debug(f"({self.app_key}) Etsy rate limit reached, waiting {wait}s.")
+			await asyncio.sleep(wait)
+		return wait
+
+	async def penalize(self, retry_after: Optional[float] = None):
+		"""Empty the bucket after Etsy answered with 429 so that every process backs off."""
+		penalty = retry_after if retry_after is not None else 1 / self.rate * self.capacity
+		r = MyRedis().r
+		try:
+			await r.register_script(PENALIZE_SCRIPT)(
+				keys=[self.key],
+				args=[self.rate, EtsyRateLimiter.now_ms(), int(penalty * 1000)])
+		except RedisError as e:
+			logging.error(f"Etsy rate limiter is unavailable, couldn't register 429. {e}")
+
+	async def update_from_headers(self, headers):
+		"""Keep the daily budget in sync with Etsy's X-RateLimit-* response headers."""
+		limit = headers.get("X-RateLimit-Limit")
+		remaining = headers.get("X-RateLimit-Remaining")
+		if limit is None or remaining is None:
+			return
+		r = MyRedis().r
+		try:
+			await r.hset(self.key, mapping={
+				"limit": int(limit),
+				"remaining": int(remaining),
+				"remaining_updated_at": int(time.time())
+			})
+		except (RedisError, ValueError) as e:
+			logging.error(f"Couldn't update Etsy rate limit from headers. {e}")
+
+	async def metrics(self) -> dict:
+		r = MyRedis().r
+		state = await r.hgetall(self.key)
+		tokens = float(state["tokens"]) if "tokens" in state else float(self.capacity)
+		rate = float(state.get("rate", self.rate))
+		if "ts" in state:
+			elapsed = max(0, EtsyRateLimiter.now_ms() - int(state["ts"])) / 1000
+			tokens = min(self.capacity, tokens + elapsed * rate)
+		return {
+			"tokens": tokens,
+			"capacity": self.capacity,
+			"rate_per_second": rate,
+			"wait_seconds": max(0.0, -tokens / rate) if tokens < 0 else 0.0,
+			"daily_limit": int(state["limit"]) if "limit" in state else None,
+			"daily_remaining": int(state["remaining"]) if "remaining" in state else None,
+			"acquired": int(state.get("acquired", 0)),
+			"throttled": int(state.get("throttled", 0)),
+			"last_wait_ms": int(state.get("last_wait_ms", 0)),
+			"total_wait_ms": int(state.get("total_wait_ms", 0))
+		}
@@ -1,26 +1,93 @@
+import asyncio
+import hashlib
+import math
 import pprint
 
 # from pydantic.fields import T
 from termcolor import colored
 
 from datetime import datetime
-from typing import List, Optional
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
-from pymongo import errors
+import orjson
+from pymongo import UpdateOne
 from helpers import calculate_max_min_due_date
 
-from bson import ObjectId
-
-from AsyncEtsyApi import AsyncEtsy, Method, EtsyUrl
+from AsyncEtsyApi import AsyncEtsy, Method, EtsyUrl, PageOutcome, all_pages_ok
+from ListingCatalog import ListingCatalog
+from EtsyCache import EtsyReadCache, CachedResource
 from MyLogger import Logger
+from SyncLease import SyncLease
+from SyncState import SyncState, BackfillProgress
+from SyncTelemetry import SyncTelemetry
+from config import RECEIPT_BATCH_SIZE, RECEIPT_WRITE_BATCH_SIZE, SYNC_TWO_PHASE, SYNC_CHECKPOINT_PAGES, \
+    BACKFILL_WINDOW_RECEIPTS, BACKFILL_MAX_WINDOWS, BACKFILL_PARALLEL_WINDOWS
 
 logging = Logger().logging
 
-from database import MongoDB, MyRedis, ReceiptNoteStatus
+from database import MongoDB, ReceiptNoteStatus
 
 # import pytz
 
 
+# Fields that are maintained by OrderAIO and must survive an update from Etsy.
+LOCAL_RECEIPT_FIELDS = ("_id", "is_completed", "content_hash")
+
+
+# Listings come from the Listings collection (ListingCatalog), receipts only keep listing_ids.
+RECEIPT_INCLUDES = "Transactions/MainImage"
+
+
+# Enough to tell whether a listed receipt is paid, already stored or changed.
+LIGHT_RECEIPT_FIELDS = "receipt_id,was_paid,creation_tsz,last_modified_tsz"
+
+
+class SyncMode(str, Enum):
+    created = "CREATED"  # new receipts by min_created, watermark last_updated in {id}:sync_state
+    backfill = "BACKFILL"  # a never synced shop's whole history in parallel time windows, watermark last_updated
+    modified = "MODIFIED"  # changed receipts by min_last_modified, watermark last_modified in {id}:sync_state
+
+
+def receipt_content_hash(fields: dict) -> str:
+    """Stable hash of everything a sync writes for a receipt, key order doesn't matter."""
+    return hashlib.sha1(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def merge_receipts(*receipt_lists: List[dict]) -> Tuple[List[dict], int]:
+    """
+    Keeps one receipt per receipt_id, the one with the highest last_modified_tsz
+    (the later one on a tie). Returns the merged receipts in first-seen order and
+    how many duplicates differed from the version that was kept.
+    """
+    merged: Dict[int, dict] = {}
+    conflicts = 0
+    for receipts in receipt_lists:
+        for receipt in receipts:
+            receipt_id = receipt["receipt_id"]
+            kept = merged.get(receipt_id)
+            if kept is None:
+                merged[receipt_id] = receipt
+                continue
+            if kept != receipt:
+                conflicts += 1
+                logging.info(
+                    f"{receipt_id} was fetched twice with different content, keeping the most recently modified one."
+                )
+            if receipt.get("last_modified_tsz", 0) >= kept.get("last_modified_tsz", 0):
+                merged[receipt_id] = receipt
+    return list(merged.values()), conflicts
+
+
+class IncompleteSyncError(Exception):
+    """Raised when a sync couldn't fetch every page, last_updated must not move forward."""
+
+    def __init__(self, etsy_connection_id: str, reason: str):
+        self.etsy_connection_id = etsy_connection_id
+        self.reason = reason
+        super().__init__(f"{etsy_connection_id} sync is incomplete: {reason}")
+
+
 class MyEtsyShopManager:
     def __init__(self, shop_name):
         self.shop_name = shop_name
@@ -30,229 +97,652 @@ class MyEtsyShopManager:
         receipt_insert_result = await db["Receipts"].insert_one(receipt)
         return receipt_insert_result.inserted_id
 
-    async def insert_notes(self, inserted_receipt_ids):
-        if len(inserted_receipt_ids) == 0:
-            return
-        mongodb = MongoDB()
-        db = mongodb.db
-        notes = []
-        for receipt_id in inserted_receipt_ids:
-            # receipt = await db["Receipts"].find_one({"_id": receipt_mongodb_id})
-            note = {
-                "receipt_id": receipt_id,
-                "created_at": datetime.now(),
-                "status": ReceiptNoteStatus.notseen,
-                "assigned_to": None,
+    async def upsert_receipts(self, receipts: List[dict], db) -> Dict[str, int]:
+        """
+        Writes receipts with idempotent upserts in batches of RECEIPT_WRITE_BATCH_SIZE.
+        Etsy fields are $set, a new receipt also gets a notseen Note with $setOnInsert
+        so a note that already exists is never touched. Receipts whose content_hash
+        matches the stored one are not written at all. Returns how many receipts
+        were inserted, updated and left unchanged.
+        """
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        logging.info(f"{len(receipts)} receipts will be upserted into MongoDB.")
+        for i in range(0, len(receipts), RECEIPT_WRITE_BATCH_SIZE):
+            batch = receipts[i : i + RECEIPT_WRITE_BATCH_SIZE]
+            stored_hashes = {
+                receipt["receipt_id"]: receipt.get("content_hash")
+                async for receipt in db["Receipts"].find(
+                    {"receipt_id": {"$in": [receipt["receipt_id"] for receipt in batch]}},
+                    projection={"_id": False, "receipt_id": True, "content_hash": True},
+                )
             }
-            notes.append(note)
-            # pprint.pprint(note)
-            logging.debug(note)
-        try:
-            insert_all_notes_result = await db["Notes"].insert_many(notes, ordered=False)
-        except errors.BulkWriteError as e:
-            panic_list = list(
-                filter(lambda x: x["code"] == 11000, e.details["writeErrors"])
-            )
-            if len(panic_list) > 0:
-                logging.info(
-                    f"{colored('...', 'red')} (insert_notes) There have been found {len(panic_list)} duplicates. {colored('...', 'red')}"
+            receipt_requests = []
+            note_requests = []
+            for receipt in batch:
+                receipt["shop_name"] = self.shop_name
+                fields = {k: v for k, v in receipt.items() if k not in LOCAL_RECEIPT_FIELDS}
+                fields["content_hash"] = receipt_content_hash(fields)
+                if stored_hashes.get(receipt["receipt_id"]) == fields["content_hash"]:
+                    counts["unchanged"] += 1
+                    continue
+                receipt_requests.append(
+                    UpdateOne(
+                        {"receipt_id": receipt["receipt_id"]},
+                        {
+                            "$set": fields,
+                            "$setOnInsert": {"is_completed": receipt.get("is_completed", False)},
+                            # Receipts stored before the listing catalog carry a full copy of their listings.
+                            "$unset": {"Listings": ""},
+                        },
+                        upsert=True,
+                    )
+                )
+                note_requests.append(
+                    UpdateOne(
+                        {"receipt_id": receipt["receipt_id"]},
+                        {
+                            "$setOnInsert": {
+                                "receipt_id": receipt["receipt_id"],
+                                "created_at": datetime.now(),
+                                "status": ReceiptNoteStatus.notseen,
+                                "assigned_to": None,
+                            }
+                        },
+                        upsert=True,
+                    )
                 )
+            if len(receipt_requests) == 0:
+                continue
+            receipts_result = await db["Receipts"].bulk_write(receipt_requests, ordered=False)
+            notes_result = await db["Notes"].bulk_write(note_requests, ordered=False)
+            counts["inserted"] += receipts_result.upserted_count
+            counts["updated"] += receipts_result.modified_count
+            counts["unchanged"] += receipts_result.matched_count - receipts_result.modified_count
+            logging.debug(f"({self.shop_name}) {notes_result.upserted_count} notes created.")
+        logging.info(
+            f"{colored('......', on_color='on_yellow')} ({self.shop_name}) inserted {counts['inserted']}, updated {counts['updated']}, unchanged {counts['unchanged']} receipts {colored('.......', on_color='on_yellow')}"
+        )
+        return counts
 
-            else:
-                logging.info(f"these are not duplicate errors {panic_list}")
-                pass
-                # for writeError in e.details['writeErrors']:
-                # logging.info(f"{writeError['keyValue']['receipt_id']} has already note associated with the given receipt_id in the Notes Collection.")
-
-    async def insert_receipts(self, receipts: List[dict], db):
-        logging.info(f"{len(receipts)} receipts will be added to MongoDB.")
-        if len(receipts) <= 0:
-            return []
-        for r in receipts:
-            r["shop_name"] = self.shop_name
-        receipt_ids = [str(receipt['receipt_id']) for receipt in receipts]
-        dup_ids = []
-        insert_all_receipts_result = None
-        logging.info(f"{colored('  ', 'magenta')} Inserting Receipt Notes for given receipt ids. {colored('  ', 'magenta')}")
-        await self.insert_notes([receipt['receipt_id'] for receipt in receipts])
-        try:
-            insert_all_receipts_result = await db["Receipts"].insert_many(
-                receipts, ordered=False
+    @staticmethod
+    async def calculate_due_dates(asyncEtsyApi: AsyncEtsy, receipts: List[dict]) -> List[int]:
+        """
+        Stores the listing ids of every receipt and calculates its due dates from the
+        listing catalog. Listings the catalog can't resolve are looked up through the
+        receipts' Listings include. Returns the ids of the receipts that still miss a
+        listing, they have no due dates and must not be written.
+        """
+        for receipt in receipts:
+            receipt["listing_ids"] = list(
+                dict.fromkeys(transaction["listing_id"] for transaction in receipt["Transactions"])
+            )
+        catalog = ListingCatalog(asyncEtsyApi)
+        listings = await catalog.get_listings(
+            listing_id for receipt in receipts for listing_id in receipt["listing_ids"]
+        )
+
+        def unresolved_receipts() -> List[int]:
+            return [
+                receipt["receipt_id"]
+                for receipt in receipts
+                if any(listing_id not in listings for listing_id in receipt["listing_ids"])
+            ]
+
+        unresolved = unresolved_receipts()
+        if len(unresolved) > 0:
+            listings.update(
+                (listing["listing_id"], listing) for listing in await catalog.fetch_receipt_listings(unresolved)
+            )
+            unresolved = unresolved_receipts()
+        for receipt in receipts:
+            if receipt["receipt_id"] in unresolved:
+                continue
+            calculate_max_min_due_date(
+                receipt, [listings[listing_id] for listing_id in receipt["listing_ids"]]
             )
-            
-        except errors.BulkWriteError as e:
-            # logging.error(f"Articles bulk write insertion error {e}")
-            panic_list = list(
-                filter(lambda x: x["code"] == 11000, e.details["writeErrors"])
+        if len(unresolved) > 0:
+            logging.error(
+                f"{asyncEtsyApi.shop_id} listings of receipts {unresolved} could not be found, their due dates can't be calculated."
             )
-            dup_ids = list(str(error['keyValue']['receipt_id']) for error in filter(lambda x: x['code'] == 11000, e.details["writeErrors"]))
-            if len(panic_list) > 0:
+        return unresolved
+
+    @staticmethod
+    async def fetch_receipts_by_ids(
+        asyncEtsyApi: AsyncEtsy, receipt_ids: List[str], params: dict
+    ) -> List[Tuple[List[str], List[PageOutcome]]]:
+        """Fetches receipts with multi-id getShop_Receipt2 requests, returns the outcomes of every batch."""
+        receipt_ids = [str(receipt_id) for receipt_id in receipt_ids]
+        batches = [
+            receipt_ids[i : i + RECEIPT_BATCH_SIZE]
+            for i in range(0, len(receipt_ids), RECEIPT_BATCH_SIZE)
+        ]
+        semaphore = asyncio.Semaphore(
+            asyncEtsyApi.concurrency(EtsyUrl.getShop_Receipt2(0)).limit
+        )
+
+        async def fetch_batch(batch: List[str]):
+            async with semaphore:
                 logging.info(
-                    f"{colored('...', 'red')} (insert_receipts) There have been found {len(panic_list)} duplicates. {colored('...', 'red')}"
+                    f"{colored('  ', 'yellow')} Fetching receipt ids {','.join(batch)} ... {colored('  ', 'yellow')}"
                 )
-
-            else:
-                logging.info(f"these are not duplicate errors {panic_list}")
-                pass
-                # for writeError in e.details['writeErrors']:
-                # logging.info(f"{writeError['keyValue']['receipt_id']} is alreadya in the Receipts Collection.")
-        finally:
-            delta = set(receipt_ids) ^ set(dup_ids)
-            logging.info(
-                    f"{colored('......', on_color='on_yellow')} ({self.shop_name}) Successfully inserted receipts => {','.join(delta)} {colored('.......', on_color='on_yellow')}"
+                return batch, await asyncEtsyApi.getAllPages(
+                    None,
+                    Method.get,
+                    EtsyUrl.getShop_Receipt2(",".join(batch)),
+                    params,
                 )
-        # else:
-        # 	await self.insert_notes(insert_all_receipts_result.inserted_ids)
-        # finally:
-
-        #     if insert_all_receipts_result is None:
-        #         logging.info(
-        #             f"{colored('  ', 'red')} inserted_all_receipts_result is NONE {colored('  ', 'red')}"
-        #         )
-        #         return []
-        #     receipts_ids = [receipt["receipt_id"] for receipt in receipts]
-        #     delta = set(insert_all_receipts_result.inserted_ids) ^ set(receipts_ids)
-        #     logging.info(
-        #         f"{colored('  ', 'magenta')} ({len(delta)}) Difference between given receipts and inserted receipts is {', '.join(delta)} {colored('  ', 'magenta')}"
-        #     )
-        #     logging.info(
-        #         f"{colored('  ', 'magenta')} ({len(insert_all_receipts_result.inserted_ids)}) Inserted receipts are {', '.join([str(inserted_mongodb_id) for inserted_mongodb_id in insert_all_receipts_result.inserted_ids])} {colored('  ', 'magenta')}"
-        #     )
-            # logging.info(f"{insert_all_receipts_result.inserted_ids}")
-            
-            # return [
-            #     (str(mongodb_id), receipt["receipt_id"])
-            #     for mongodb_id, receipt in zip(
-            #         insert_all_receipts_result.inserted_ids, receipts
-            #     )
-            # ]
-        # return insert_all_receipts_result.inserted_ids
-
-    async def update_receipt(
-        self, mongodb_id: str, receipt_id: str, transactions: List[dict], db
-    ):
-        if type(mongodb_id) is not ObjectId:
-            mongodb_id = ObjectId(mongodb_id)
-        update_receipt_result = await db["Receipts"].update_one(
-            {"_id": mongodb_id, "receipt_id": receipt_id},
-            {"$set": {"transactions": transactions}},
-        )
+
+        return await asyncio.gather(*(fetch_batch(batch) for batch in batches))
 
     @staticmethod
-    async def check_unpaids(etsy_connection_id, asyncEtsyApi, params, r):
+    async def check_unpaids(etsy_connection_id, asyncEtsyApi, params, state: SyncState):
         logging.info(f"Checking unpaid receipts {etsy_connection_id}")
         my_params = dict(params)
         my_params.pop("min_created", None)
         receipts_not_paid = []
         receipts_to_be_inserted = []
-        unpaid_from_redis = r.get(f"{etsy_connection_id}:unpaid_receipts")
-        if unpaid_from_redis is None:
-            logging.info("UNPAID NOT SET !!!")
-            r.set(f"{etsy_connection_id}:unpaid_receipts", "")
-        #######
-        unpaid_from_redis = unpaid_from_redis.split(",")
-        #######
-        if unpaid_from_redis is not None and len(unpaid_from_redis) > 0:
-            for unpaid_receipt in unpaid_from_redis:
-                logging.info(
-                    f"{colored('  ', 'yellow')} Checking receipt id {unpaid_receipt} ... {colored('  ', 'yellow')}"
-                )
-
-                unpaid_responses = await AsyncEtsy.asyncLoop(
-                    f=asyncEtsyApi.getAllPages,
-                    method=Method.get,
-                    url=EtsyUrl.getShop_Receipt2(unpaid_receipt),
-                    params=my_params,
-                )
-                logging.info(
-                    f"{len(unpaid_responses)} pages of fetched receipts found."
-                )
+        is_complete = True
+        for receipt_ids, unpaid_outcomes in await MyEtsyShopManager.fetch_receipts_by_ids(
+            asyncEtsyApi, state.unpaid_receipt_ids, my_params
+        ):
+            logging.info(f"{len(unpaid_outcomes)} pages of fetched receipts found.")
+            if not all_pages_ok(unpaid_outcomes):
+                # Keep them in the unpaid list so the next run checks them again.
+                is_complete = False
+                receipts_not_paid.extend(receipt_ids)
 
-                for res in unpaid_responses:
-                    if res.status_code != 200:
+            for outcome in unpaid_outcomes:
+                if not outcome.ok:
+                    logging.info(
+                        f"{etsy_connection_id} check unpaids response was not successful {outcome}"
+                    )
+                    continue
+                results: List[dict] = outcome.results
+                for receipt in results:
+                    logging.info(receipt["receipt_id"])
+                    was_paid: bool = receipt["was_paid"]
+                    logging.info(f"was_paid: {was_paid}")
+                    paid_tzs: Optional[int] = receipt["Transactions"][0]["paid_tsz"]
+                    if not was_paid or paid_tzs is None:
                         logging.info(
-                            f"{etsy_connection_id} check unpaids response was not successful {res.text}"
+                            f"{receipt['receipt_id']} : was_paid={was_paid} : paid_tzs={paid_tzs}. Probably processing payment in the Etsy side."
                         )
+                        receipts_not_paid.append(receipt["receipt_id"])
                         continue
-                    res_json = res.json()
-                    results: List[dict] = res_json["results"]
-                    for receipt in results:
-                        logging.info(receipt["receipt_id"])
-                        was_paid: bool = receipt["was_paid"]
-                        logging.info(f"was_paid: {was_paid}")
-                        # logging.info(f"{receipt['receipt_id']} -> Transactions[0]: {f'\n\t' + str(receipt['Transactions'][0]['receipt_id'])} {f'\n\t' + str(receipt['Transactions'][0]['paid_tsz'])}")
-                        paid_tzs: Optional[int] = receipt["Transactions"][0]["paid_tsz"]
-                        if not was_paid or paid_tzs is None:
-                            logging.info(
-                                f"{receipt['receipt_id']} : was_paid={was_paid} : paid_tzs={paid_tzs}. Probably processing payment in the Etsy side."
-                            )
-                            # pop_list.append(i)
-                            receipts_not_paid.append(receipt["receipt_id"])
-                            continue
-                        calculate_max_min_due_date(receipt)
-                        receipts_to_be_inserted.append(receipt)
-                    # for pop_index in pop_list:
-                    # 	results.pop(pop_index)
-                    # receipts_to_be_inserted = numpy.concatenate((receipts_to_be_inserted, results))
+                    receipts_to_be_inserted.append(receipt)
         logging.info(
             f"{asyncEtsyApi.shop_id} Receipts to be inserted -> {' , '.join(str(receipt['receipt_id']) for receipt in receipts_to_be_inserted)}"
         )
         logging.info(
             f"{asyncEtsyApi.shop_id} Not yet finished payment process Receipts -> {receipts_not_paid}"
         )
-        return receipts_not_paid, receipts_to_be_inserted
+        return receipts_not_paid, receipts_to_be_inserted, is_complete
 
     @staticmethod
-    async def check_for_new_orders(asyncEtsyApi, params):
-        logging.info(f"Checking for new orders {asyncEtsyApi.shop_id}")
+    async def hydrate_listed_receipts(asyncEtsyApi: AsyncEtsy, listed: Dict[int, dict], params: dict):
+        """
+        Second phase of a two-phase listing: fetches the full includes of the listed
+        paid receipts that are not stored yet or were modified since they were stored.
+        """
+        db = MongoDB().db
         receipts_not_paid = []
         receipts_to_be_inserted = []
-        receipt_responses = await AsyncEtsy.asyncLoop(
-            f=asyncEtsyApi.getAllPages,
-            method=Method.get,
-            url=EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id),
-            params=params,
+        receipts_to_be_updated = []
+        is_complete = True
+        stored: Dict[int, Optional[int]] = {}
+        async for receipt in db["Receipts"].find(
+            {"receipt_id": {"$in": list(listed.keys())}},
+            projection={"_id": False, "receipt_id": True, "last_modified_tsz": True},
+        ):
+            stored[receipt["receipt_id"]] = receipt.get("last_modified_tsz")
+        to_be_hydrated = [
+            receipt_id
+            for receipt_id, receipt in listed.items()
+            if receipt_id not in stored
+            or stored[receipt_id] is None
+            or receipt["last_modified_tsz"] > stored[receipt_id]
+        ]
+        logging.info(
+            f"{asyncEtsyApi.shop_id} {len(listed)} paid receipts listed, {len(listed) - len(to_be_hydrated)} are already up to date."
         )
 
-        for res in receipt_responses:
-            if res.status_code != 200:
-                logging.info(
-                    f"{asyncEtsyApi.shop_id} check new orders response was not successful {res.text}"
-                )
-                continue
-            res_json = res.json()
-            results: List[dict] = res_json["results"]
-            for receipt in results:
-                logging.debug(receipt["receipt_id"])
-                was_paid: bool = receipt["was_paid"]
-                logging.debug(f"was_paid: {was_paid}")
-                paid_tzs: Optional[int] = receipt["Transactions"][0]["paid_tsz"]
-                # logging.info(f"{receipt['receipt_id']} -> Transactions[0]: {receipt['Transactions'][0]}")
-                if not was_paid or paid_tzs is None:
+        hydrate_params = {"includes": params["includes"]} if "includes" in params else {}
+        for receipt_ids, outcomes in await MyEtsyShopManager.fetch_receipts_by_ids(
+            asyncEtsyApi, to_be_hydrated, hydrate_params
+        ):
+            if not all_pages_ok(outcomes):
+                is_complete = False
+            for outcome in outcomes:
+                if not outcome.ok:
                     logging.info(
-                        colored(
-                            f"{receipt['receipt_id']} : was_paid={was_paid} : paid_tzs={paid_tzs}. Probably processing payment in the Etsy side.",
-                            "magenta",
-                            attrs=["underline", "bold"],
-                        )
+                        f"{asyncEtsyApi.shop_id} receipt hydration was not successful {outcome}"
                     )
-                    # pop_list.append(i)
-                    receipts_not_paid.append(receipt["receipt_id"])
                     continue
-                calculate_max_min_due_date(receipt)
-                receipts_to_be_inserted.append(receipt)
-            # for pop_index in pop_list:
-            # 	results.pop(pop_index)
-            # receipts_to_be_inserted = numpy.concatenate((receipts_to_be_inserted, results))
-        # logging.info(receipts_not_paid)
-        # logging.info(receipts_to_be_inserted)
+                for receipt in outcome.results:
+                    paid_tzs: Optional[int] = receipt["Transactions"][0]["paid_tsz"]
+                    if not receipt["was_paid"] or paid_tzs is None:
+                        receipts_not_paid.append(receipt["receipt_id"])
+                        continue
+                    if receipt["receipt_id"] in stored:
+                        receipts_to_be_updated.append(receipt)
+                    else:
+                        receipts_to_be_inserted.append(receipt)
         logging.info(
             f"{asyncEtsyApi.shop_id} Receipts to be inserted -> {' , '.join(str(receipt['receipt_id']) for receipt in receipts_to_be_inserted)}"
         )
         logging.info(
-            f"{asyncEtsyApi.shop_id} Not yet finished payment process Receipts -> {receipts_not_paid}"
+            f"{asyncEtsyApi.shop_id} Receipts to be updated -> {' , '.join(str(receipt['receipt_id']) for receipt in receipts_to_be_updated)}"
+        )
+        return receipts_not_paid, receipts_to_be_inserted, receipts_to_be_updated, is_complete
+
+    @staticmethod
+    async def probe_new_orders(asyncEtsyApi: AsyncEtsy, params: dict) -> Optional[int]:
+        """Asks Etsy how many receipts are in the sync window with a single one-receipt page, None if it failed."""
+        probe_params = {k: v for k, v in params.items() if k != "includes"}
+        probe_params["limit"] = 1
+        probe_params["fields"] = "receipt_id"
+        outcome = await asyncEtsyApi.outcomeByPage(
+            Method.get, EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id), probe_params, 1
         )
-        return receipts_not_paid, receipts_to_be_inserted
+        if not outcome.ok:
+            logging.info(f"{asyncEtsyApi.shop_id} count probe was not successful {outcome}")
+            return None
+        return outcome.data["count"]
+
+    async def import_new_orders(
+        self,
+        asyncEtsyApi: AsyncEtsy,
+        params: dict,
+        checkpoint: dict,
+        state: SyncState,
+        telemetry: SyncTelemetry,
+        checkpoint_name: str = "last_updated",
+        on_batch: Optional[Callable[[int], Awaitable[None]]] = None,
+        rechecked: Optional[Callable[[], Awaitable[Dict[int, dict]]]] = None,
+        two_phase: bool = SYNC_TWO_PHASE,
+    ) -> Tuple[List[int], bool]:
+        """
+        Pages through the sync window oldest first and writes every
+        SYNC_CHECKPOINT_PAGES pages. After each written batch the checkpoint (the
+        window, the pages done and the creation_tsz reached) is saved, a later run
+        resumes from there. Stops at the first page that can't be fetched. Returns
+        the unpaid receipt ids found and whether the whole window was imported.
+        rechecked returns paid receipts fetched by another source (the unpaid
+        recheck) by receipt_id, the ones a batch lists are merged into it and
+        removed, the caller writes what is left. two_phase lists light fields and
+        hydrates only the receipts that aren't stored or changed, it only pays off
+        when most of the window is already stored.
+        """
+        page_params = MyEtsyShopManager.new_orders_page_params(params, two_phase)
+        receipts_not_paid: List[int] = []
+        batch: List[PageOutcome] = []
+
+        async def write_batch() -> bool:
+            receipts = [receipt for outcome in batch for receipt in outcome.results]
+            batch.clear()
+            if len(receipts) == 0:
+                return True
+            if two_phase:
+                not_paid = [receipt["receipt_id"] for receipt in receipts if not receipt["was_paid"]]
+                (
+                    hydrated_not_paid, to_be_inserted, to_be_updated, is_complete
+                ) = await MyEtsyShopManager.hydrate_listed_receipts(
+                    asyncEtsyApi,
+                    {receipt["receipt_id"]: receipt for receipt in receipts if receipt["was_paid"]},
+                    params,
+                )
+                not_paid += hydrated_not_paid
+            else:
+                not_paid = [
+                    receipt["receipt_id"] for receipt in receipts if not MyEtsyShopManager.is_paid(receipt)
+                ]
+                to_be_inserted = [receipt for receipt in receipts if MyEtsyShopManager.is_paid(receipt)]
+                to_be_updated = []
+                is_complete = True
+            rechecked_receipts = {}
+            if rechecked is not None:
+                pool = await rechecked()
+                rechecked_receipts = {
+                    receipt["receipt_id"]: pool.pop(receipt["receipt_id"])
+                    for receipt in receipts
+                    if receipt["receipt_id"] in pool
+                }
+            # The batch's own receipts come last, they win ties.
+            to_be_written, merge_conflicts = merge_receipts(
+                list(rechecked_receipts.values()), to_be_inserted, to_be_updated
+            )
+            telemetry.incr("merge_conflicts", merge_conflicts)
+            if len(await MyEtsyShopManager.calculate_due_dates(asyncEtsyApi, to_be_written)) > 0:
+                # Nothing of the batch is written or checkpointed, the next run fetches it again.
+                telemetry.incr("unresolved_listings", 1)
+                if rechecked is not None:
+                    pool.update(rechecked_receipts)
+                return False
+            written_ids = {receipt["receipt_id"] for receipt in to_be_written}
+            not_paid = [receipt_id for receipt_id in not_paid if receipt_id not in written_ids]
+            write_counts = await self.upsert_receipts(to_be_written, MongoDB().db)
+            await EtsyReadCache(state.etsy_connection_id).invalidate(
+                CachedResource.receipt, (receipt["receipt_id"] for receipt in to_be_written)
+            )
+            for name, value in write_counts.items():
+                telemetry.incr(name, value)
+            if on_batch is not None:
+                await on_batch(len(to_be_written))
+            # Saved right away, the checkpoint moves past these receipts.
+            await state.add_unpaid(not_paid)
+            receipts_not_paid.extend(not_paid)
+            if not is_complete:
+                return False
+            checkpoint["watermark"] = max(receipt["creation_tsz"] for receipt in receipts)
+            await state.save_checkpoint(checkpoint_name, checkpoint)
+            telemetry.set(checkpoint=dict(checkpoint))
+            logging.info(
+                f"{asyncEtsyApi.shop_id} {checkpoint_name} checkpoint after {checkpoint['pages_done']} pages, receipts up to {datetime.fromtimestamp(checkpoint['watermark'])} are imported."
+            )
+            return True
+
+        is_complete = True
+        pages = asyncEtsyApi.iter_pages(
+            Method.get, EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id), page_params, ordered=True
+        )
+        try:
+            async for outcome in pages:
+                if not outcome.ok:
+                    logging.info(
+                        f"{asyncEtsyApi.shop_id} check new orders response was not successful {outcome}"
+                    )
+                    is_complete = False
+                    break
+                batch.append(outcome)
+                checkpoint["pages_done"] += 1
+                if len(batch) >= SYNC_CHECKPOINT_PAGES and not await write_batch():
+                    is_complete = False
+                    break
+        finally:
+            await pages.aclose()
+        # Pages before a failed one are still written and checkpointed.
+        if len(batch) > 0:
+            is_complete = await write_batch() and is_complete
+        return receipts_not_paid, is_complete
+
+    @staticmethod
+    def new_orders_page_params(params: dict, two_phase: bool = SYNC_TWO_PHASE) -> dict:
+        """Oldest first so a checkpoint can resume, only the light fields when hydrating in two phases."""
+        page_params = dict(params, sort_on="created", sort_order="up")
+        if two_phase:
+            page_params.pop("includes", None)
+            page_params["fields"] = LIGHT_RECEIPT_FIELDS
+        return page_params
+
+    @staticmethod
+    def is_paid(receipt: dict) -> bool:
+        return receipt["was_paid"] and receipt["Transactions"][0]["paid_tsz"] is not None
+
+    @staticmethod
+    async def sync_new_receipts(
+        etsy_connection_id: str, asyncEtsyApi: AsyncEtsy, state: SyncState, telemetry: SyncTelemetry
+    ) -> int:
+        """
+        Imports receipts created since last_updated, or since the checkpoint of a
+        run that stopped halfway, and rechecks the unpaid ones. Returns the new watermark.
+        """
+        db = MongoDB().db
+        last_updated = state.last_updated
+        params = {"includes": RECEIPT_INCLUDES}
+        if last_updated is not None:
+            logging.info("last_updated is not None, setting min_created")
+            params["min_created"] = last_updated
+        current_time = int(datetime.now().timestamp())
+        params["max_created"] = current_time
+        # The window start stays the last committed watermark, so a resumed run can be resumed again.
+        checkpoint = {
+            "min_created": last_updated if last_updated is not None else "",
+            "max_created": current_time,
+            "pages_done": 0,
+        }
+        if state.checkpoint is not None and state.checkpoint.get("min_created") == str(checkpoint["min_created"]):
+            logging.info(
+                f"{asyncEtsyApi.shop_id} resuming the sync that stopped after {state.checkpoint['pages_done']} pages."
+            )
+            telemetry.set(resumed_from=state.checkpoint)
+            params["min_created"] = int(state.checkpoint["watermark"])
+            checkpoint["pages_done"] = int(state.checkpoint["pages_done"])
+        if "min_created" in params:
+            logging.info(f"From = {datetime.fromtimestamp(params['min_created'])}")
+            logging.info(f"To = {datetime.fromtimestamp(current_time)}")
+        else:
+            logging.info(f"From = -")
+            logging.info(f"To = {datetime.fromtimestamp(current_time)}")
+
+        probe_count = await MyEtsyShopManager.probe_new_orders(asyncEtsyApi, params)
+        has_unpaids = len(state.unpaid_receipt_ids) > 0
+        telemetry.set(probe_count=probe_count, has_unpaids=has_unpaids)
+        if probe_count == 0 and not has_unpaids:
+            logging.info(
+                f"{asyncEtsyApi.shop_id} no new orders and no unpaid receipts, skipping this run."
+            )
+            telemetry.set(decision="skipped_no_changes")
+            return current_time
+        telemetry.set(decision="full")
+
+        etsyShopManager = MyEtsyShopManager(asyncEtsyApi.shop_id)
+        # The unpaid recheck runs alongside the new orders, receipts both fetched are merged in their batch.
+        async def recheck_unpaids() -> Tuple[List[int], Dict[int, dict], bool]:
+            not_paid, paid, is_complete = await MyEtsyShopManager.check_unpaids(
+                etsy_connection_id, asyncEtsyApi, params, state
+            )
+            return not_paid, {receipt["receipt_id"]: receipt for receipt in paid}, is_complete
+
+        unpaids = asyncio.ensure_future(recheck_unpaids())
+
+        async def rechecked_receipts() -> Dict[int, dict]:
+            # The same dict every time, the batches take their receipts out of it.
+            return (await unpaids)[1]
+
+        try:
+            new_receipts_not_paid, new_orders_complete = await etsyShopManager.import_new_orders(
+                asyncEtsyApi, params, checkpoint, state, telemetry, rechecked=rechecked_receipts
+            )
+            receipts_not_paid, rechecked, unpaids_complete = await unpaids
+        finally:
+            unpaids.cancel()
+        # Rechecked receipts no batch listed.
+        receipts_to_be_inserted = list(rechecked.values())
+        unresolved = await MyEtsyShopManager.calculate_due_dates(asyncEtsyApi, receipts_to_be_inserted)
+        if len(unresolved) > 0:
+            # Rechecked with the unpaid receipts next run.
+            receipts_to_be_inserted = [
+                receipt for receipt in receipts_to_be_inserted if receipt["receipt_id"] not in unresolved
+            ]
+            unpaids_complete = False
+        receipts_not_paid = list(set(receipts_not_paid + new_receipts_not_paid + unresolved))
+        logging.info(
+            f"{asyncEtsyApi.shop_id} FINAL Receipts that paid_tsz was not found -> {colored(receipts_not_paid, attrs=['bold', 'underline'])}"
+        )
+        await state.save_unpaid(receipts_not_paid)
+        logging.info(
+            f"{asyncEtsyApi.shop_id} Paid receipts from the unpaid list to be inserted into MongoDB -> {colored(' , '.join(str(receipt['receipt_id']) for receipt in receipts_to_be_inserted), attrs=['bold', 'underline'])}"
+        )
+        write_counts = await etsyShopManager.upsert_receipts(receipts_to_be_inserted, db)
+        await EtsyReadCache(etsy_connection_id).invalidate(
+            CachedResource.receipt,
+            (receipt["receipt_id"] for receipt in receipts_to_be_inserted),
+        )
+        for name, value in write_counts.items():
+            telemetry.incr(name, value)
+        telemetry.incr("not_paid", len(receipts_not_paid))
+        if not new_orders_complete:
+            raise IncompleteSyncError(etsy_connection_id, "some pages of new orders could not be fetched or miss their listings, the next run resumes from the checkpoint")
+        if not unpaids_complete:
+            logging.info(
+                f"{asyncEtsyApi.shop_id} some unpaid receipts could not be rechecked, they stay in the unpaid list."
+            )
+        return current_time
+
+    @staticmethod
+    async def plan_backfill(asyncEtsyApi: AsyncEtsy, ends_at: int) -> Tuple[int, List[List[int]]]:
+        """
+        Asks Etsy for the oldest receipt and the receipt count with one request and
+        splits [oldest creation_tsz, ends_at] into equal time windows of about
+        BACKFILL_WINDOW_RECEIPTS receipts each. Returns the count and the windows.
+        """
+        outcome = await asyncEtsyApi.outcomeByPage(
+            Method.get,
+            EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id),
+            {"sort_on": "created", "sort_order": "up", "limit": 1, "fields": "creation_tsz", "max_created": ends_at},
+            1,
+        )
+        if not outcome.ok:
+            raise IncompleteSyncError(asyncEtsyApi.etsy_connection_id, f"the backfill could not be planned {outcome}")
+        count = outcome.data["count"]
+        if count == 0:
+            return 0, []
+        starts_at = outcome.results[0]["creation_tsz"]
+        n_windows = min(BACKFILL_MAX_WINDOWS, max(1, math.ceil(count / BACKFILL_WINDOW_RECEIPTS)))
+        step = math.ceil((ends_at - starts_at + 1) / n_windows)
+        windows = [
+            [window_start, min(window_start + step - 1, ends_at)]
+            for window_start in range(starts_at, ends_at + 1, step)
+        ]
+        return count, windows
+
+    @staticmethod
+    async def sync_backfill(
+        etsy_connection_id: str, asyncEtsyApi: AsyncEtsy, state: SyncState, telemetry: SyncTelemetry
+    ) -> int:
+        """
+        Imports a never synced shop's whole history. The time windows of
+        plan_backfill are imported BACKFILL_PARALLEL_WINDOWS at a time, each one
+        oldest first with its own checkpoint, and progress is kept in
+        BackfillProgress. Returns the end of the plan as the new last_updated.
+        """
+        progress = BackfillProgress(etsy_connection_id)
+        previous = await progress.load()
+        if previous is not None and previous["status"] != "done":
+            ends_at = previous["ends_at"]
+            windows = previous["windows"]
+            windows_done = set(previous["windows_done"])
+            logging.info(
+                f"{asyncEtsyApi.shop_id} resuming the backfill, {len(windows_done)} of {len(windows)} windows are done."
+            )
+            await progress.resume()
+        else:
+            ends_at = int(datetime.now().timestamp())
+            receipts_total, windows = await MyEtsyShopManager.plan_backfill(asyncEtsyApi, ends_at)
+            windows_done = set()
+            await progress.start(ends_at, receipts_total, windows)
+            logging.info(
+                f"{asyncEtsyApi.shop_id} backfilling {receipts_total} receipts in {len(windows)} windows."
+            )
+        telemetry.set(decision="backfill", backfill_windows=len(windows), backfill_windows_done=len(windows_done))
+        etsyShopManager = MyEtsyShopManager(asyncEtsyApi.shop_id)
+        slots = asyncio.Semaphore(BACKFILL_PARALLEL_WINDOWS)
+
+        async def backfill_window(window: int, window_start: int, window_end: int) -> bool:
+            async with slots:
+                name = f"backfill_{window}"
+                params = {"includes": RECEIPT_INCLUDES, "min_created": window_start, "max_created": window_end}
+                checkpoint = {"min_created": window_start, "max_created": window_end, "pages_done": 0}
+                saved = await state.load_checkpoint(name)
+                if saved is not None:
+                    params["min_created"] = int(saved["watermark"])
+                    checkpoint["pages_done"] = int(saved["pages_done"])
+                _, is_complete = await etsyShopManager.import_new_orders(
+                    asyncEtsyApi, params, checkpoint, state, telemetry,
+                    checkpoint_name=name, on_batch=progress.add_written,
+                    # Nothing is stored yet, a light listing would only add a hydration request per receipt batch.
+                    two_phase=False,
+                )
+                if is_complete:
+                    await progress.window_done(window)
+                    logging.info(
+                        f"{asyncEtsyApi.shop_id} backfill window #{window} "
+                        f"({datetime.fromtimestamp(window_start)} - {datetime.fromtimestamp(window_end)}) is done."
+                    )
+                return is_complete
+
+        results = await asyncio.gather(
+            *(
+                backfill_window(window, window_start, window_end)
+                for window, (window_start, window_end) in enumerate(windows)
+                if window not in windows_done
+            ),
+            return_exceptions=True,
+        )
+        failed = [result for result in results if result is not True]
+        for result in failed:
+            if isinstance(result, Exception):
+                # Outside an except block, the traceback has to be passed explicitly.
+                logging.error(f"{asyncEtsyApi.shop_id} backfill window failed", exc_info=result)
+        if len(failed) > 0:
+            await progress.finish("failed")
+            raise IncompleteSyncError(
+                etsy_connection_id, f"{len(failed)} backfill windows are incomplete, the next run resumes them"
+            )
+        await state.delete_checkpoints(f"backfill_{window}" for window in range(len(windows)))
+        await progress.finish("done")
+        # A backfill requested for a shop that is already synced must not move last_updated back.
+        return max(ends_at, state.last_updated or 0)
+
+    @staticmethod
+    async def sync_modified_receipts(
+        etsy_connection_id: str, asyncEtsyApi: AsyncEtsy, state: SyncState, telemetry: SyncTelemetry
+    ) -> int:
+        """Applies every change Etsy made to paid receipts since last_modified, returns the new watermark."""
+        db = MongoDB().db
+        current_time = int(datetime.now().timestamp())
+        last_modified = state.last_modified
+        if last_modified is None:
+            # Receipts created before last_updated were imported in their latest state.
+            last_modified = state.last_updated
+            if last_modified is None:
+                logging.info(
+                    f"{asyncEtsyApi.shop_id} has never been synced, nothing to update yet."
+                )
+                telemetry.set(decision="skipped_never_synced")
+                return current_time
+        params = {
+            "includes": RECEIPT_INCLUDES,
+            "min_last_modified": last_modified,
+            "max_last_modified": current_time,
+        }
+        logging.info(f"Modified From = {datetime.fromtimestamp(last_modified)}")
+        logging.info(f"Modified To = {datetime.fromtimestamp(current_time)}")
+        receipts_to_be_updated = []
+        is_complete = True
+        async for outcome in asyncEtsyApi.iter_pages(
+            Method.get, EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id), params
+        ):
+            if not outcome.ok:
+                is_complete = False
+                logging.info(
+                    f"{asyncEtsyApi.shop_id} modified receipts response was not successful {outcome}"
+                )
+                continue
+            for receipt in outcome.results:
+                if not receipt["was_paid"] or receipt["Transactions"][0]["paid_tsz"] is None:
+                    # Unpaid receipts are imported by the unpaid recheck once they are paid.
+                    continue
+                receipts_to_be_updated.append(receipt)
+        unresolved = await MyEtsyShopManager.calculate_due_dates(asyncEtsyApi, receipts_to_be_updated)
+        if len(unresolved) > 0:
+            # last_modified stays put, they are fetched again next run.
+            is_complete = False
+            receipts_to_be_updated = [
+                receipt for receipt in receipts_to_be_updated if receipt["receipt_id"] not in unresolved
+            ]
+        write_counts = await MyEtsyShopManager(asyncEtsyApi.shop_id).upsert_receipts(
+            receipts_to_be_updated, db
+        )
+        await EtsyReadCache(etsy_connection_id).invalidate(
+            CachedResource.receipt, (receipt["receipt_id"] for receipt in receipts_to_be_updated)
+        )
+        telemetry.set(decision="full")
+        for name, value in write_counts.items():
+            telemetry.incr(name, value)
+        if not is_complete:
+            raise IncompleteSyncError(etsy_connection_id, "some modified receipts could not be fetched or miss their listings")
+        return current_time
 
     # @staticmethod
     # async def syncShop(etsy_connection_id: str):
@@ -309,7 +799,17 @@ class MyEtsyShopManager:
     # 		r.set(f"{etsy_connection_id}:is_running", "False")
 
 
-async def syncShop(etsy_connection_id: str):
+async def sync_mode_for(etsy_connection_id: str, mode: SyncMode) -> SyncMode:
+    """
+    The mode a sync is queued with: a created sync of a shop that never committed
+    last_updated is its backfill, with the backfill's job id and timeout.
+    """
+    if mode == SyncMode.created and await SyncState.last_updated_of(etsy_connection_id) is None:
+        return SyncMode.backfill
+    return mode
+
+
+async def syncShop(etsy_connection_id: str, mode: SyncMode = SyncMode.created):
     logging.info(
         colored(
             f"Sync Etsy Shop receipts process started for etsy_shop_connection: {etsy_connection_id}",
@@ -319,86 +819,40 @@ async def syncShop(etsy_connection_id: str):
     )
     is_successfull = False
     db = MongoDB().db
-    r = MyRedis().r
+    telemetry = SyncTelemetry(etsy_connection_id, mode)
+    lease = SyncLease(etsy_connection_id)
+    if not await lease.acquire():
+        logging.info(
+            colored(
+                f"{etsy_connection_id} is already running. Exisiting syncShop function.",
+                "yellow",
+                "on_grey",
+                attrs=["blink"],
+            )
+        )
+        telemetry.set(decision="already_running")
+        await telemetry.save("skipped")
+        return {"background-task": "already running"}
+    telemetry.set(lease_fence=lease.fence)
     try:
-        is_running = r.get(f"{etsy_connection_id}:is_running")
-        logging.info(f"is_running: {is_running}")
-        if is_running == "True":
-            logging.info(
-                colored(
-                    f"{etsy_connection_id} is already running. Exisiting syncShop function.",
-                    "yellow",
-                    "on_grey",
-                    attrs=["blink"],
-                )
+        asyncEtsyApi = await AsyncEtsy.getAsyncEtsyApi(etsy_connection_id, db)
+        telemetry.set(decode=asyncEtsyApi.decode_stats)
+        state = await SyncState.load(etsy_connection_id)
+        if mode == SyncMode.modified:
+            current_time = await MyEtsyShopManager.sync_modified_receipts(
+                etsy_connection_id, asyncEtsyApi, state, telemetry
+            )
+        elif mode == SyncMode.backfill:
+            current_time = await MyEtsyShopManager.sync_backfill(
+                etsy_connection_id, asyncEtsyApi, state, telemetry
             )
-            return {"background-task": "already running"}
-        else:
-            r.set(f"{etsy_connection_id}:is_running", "True")
-        last_updated = r.get(f"{etsy_connection_id}:last_updated")
-        params = {"includes": "Transactions/MainImage,Listings/ShippingTemplate"}
-        if last_updated is not None:
-            last_updated = int(last_updated)
-            logging.info("last_updated is not None, setting min_created")
-            params["min_created"] = last_updated
-        current_time = int(datetime.now().timestamp())
-        params["max_created"] = current_time
-        if last_updated is not None:
-            logging.info(f"From = {datetime.fromtimestamp(last_updated)}")
-            logging.info(f"To = {datetime.fromtimestamp(current_time)}")
         else:
-            logging.info(f"From = -")
-            logging.info(f"To = {datetime.fromtimestamp(current_time)}")
-
-        asyncEtsyApi = await AsyncEtsy.getAsyncEtsyApi(etsy_connection_id, db)
-        etsyShopManager = MyEtsyShopManager(asyncEtsyApi.shop_id)
-
-        (
-            receipts_not_paid,
-            receipts_to_be_inserted,
-        ) = await MyEtsyShopManager.check_unpaids(
-            etsy_connection_id, asyncEtsyApi, params, r
-        )
-        (
-            unpaid_receipts,
-            r_to_be_inserted,
-        ) = await MyEtsyShopManager.check_for_new_orders(asyncEtsyApi, params)
-        receipts_not_paid = receipts_not_paid + unpaid_receipts
-        receipts_not_paid = set(receipts_not_paid)
-        receipts_not_paid = list(receipts_not_paid)
-        logging.info(
-            f"{asyncEtsyApi.shop_id} FINAL Receipts that paid_tsz was not found -> {colored(receipts_not_paid, attrs=['bold', 'underline'])}"
-        )
-        r.set(
-            f"{etsy_connection_id}:unpaid_receipts",
-            ",".join(str(not_paid_receipt) for not_paid_receipt in receipts_not_paid),
-        )
-        receipts_to_be_inserted = receipts_to_be_inserted + r_to_be_inserted
-        ### Check duplicate receipts and preserve only one ###
-        # receipts_to_be_inserted = [dict(t) for t in {tuple(d.items()) for d in receipts_to_be_inserted}]
-        receipts_to_be_inserted = [
-            i
-            for n, i in enumerate(receipts_to_be_inserted)
-            if i not in receipts_to_be_inserted[n + 1 :]
-        ]
-        logging.info(
-            f"{colored(asyncEtsyApi.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} There are total {len(receipts_to_be_inserted)} orders that will be inserted into MongoDB."
-        )
-        ######################################################
-        logging.info(
-            f"{asyncEtsyApi.shop_id} FINAL Receipts to be inserted into MongoDB -> {colored(' , '.join(str(receipt['receipt_id']) for receipt in receipts_to_be_inserted), attrs=['bold', 'underline'])}"
-        )
-        mongodb_result = await etsyShopManager.insert_receipts(
-            receipts_to_be_inserted, db
-        )
-        # if len(mongodb_result) == len(receipts_to_be_inserted):
-        # 	logging.info(colored("successfully inserted all receipts", 'green', 'on_grey', attrs=['blink']))
-        # 	logging.info("setting last_updated")
-        # 	r.set(f"{etsy_connection_id}:last_updated", current_time)
+            current_time = await MyEtsyShopManager.sync_new_receipts(
+                etsy_connection_id, asyncEtsyApi, state, telemetry
+            )
     except Exception as e:
         logging.exception(e)
     else:
-        is_successfull = True
         logging.info(
             colored(
                 "successfully inserted all receipts",
@@ -407,10 +861,12 @@ async def syncShop(etsy_connection_id: str):
                 attrs=["blink"],
             )
         )
-        logging.info("setting last_updated")
-        r.set(f"{etsy_connection_id}:last_updated", current_time)
+        watermark = "last_modified" if mode == SyncMode.modified else "last_updated"
+        logging.info(f"setting {watermark}")
+        is_successfull = await lease.commit(state, watermark, current_time)
     finally:
-        r.set(f"{etsy_connection_id}:is_running", "False")
+        await lease.release()
+        await telemetry.save("success" if is_successfull else "failed")
         try:
             logging.info(
                 f".---'| {colored(asyncEtsyApi.shop_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} {colored('was Successful', 'green', 'on_white', attrs=['reverse', 'blink', 'bold']) if is_successfull else colored('Failed', 'red', 'on_white', attrs=['reverse', 'blink', 'bold'])} |'---."
@@ -419,3 +875,4 @@ async def syncShop(etsy_connection_id: str):
             logging.info(
                 f".---'| {colored(etsy_connection_id, 'blue', 'on_grey', attrs=['bold', 'underline'])} {colored('was Successful', 'green', 'on_white', attrs=['reverse', 'blink', 'bold']) if is_successfull else colored('Failed', 'red', 'on_white', attrs=['reverse', 'blink', 'bold'])} |'---."
             )
+    return {"background-task": "done", "successful": is_successfull, "fence": lease.fence}
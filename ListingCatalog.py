@@ -0,0 +1,191 @@
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from termcolor import colored
+
+from AsyncEtsyApi import AsyncEtsy, Method, EtsyUrl
+from config import LISTING_BATCH_SIZE, LISTING_CACHE_TTL, RECEIPT_BATCH_SIZE
+from database import MongoDB
+from EtsyCache import EtsyReadCache, CachedResource
+from MyLogger import Logger
+logging = Logger().logging
+
+# Everything OrderAIO needs from a listing, the rest stays at Etsy.
+LISTING_FIELDS = "listing_id,title,state,processing_min,processing_max,shipping_template_id,last_modified_tsz"
+
+
+class ListingCache(object):
+	"""In-process listing_id -> listing cache in front of the Listings collection."""
+	_instance = None
+
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No ListingCache found creating one.")
+			cls._instance = object.__new__(cls)
+			ListingCache._instance.listings = {}
+		return cls._instance
+
+	def __init__(self, ttl: float = LISTING_CACHE_TTL):
+		self.listings: Dict[int, Tuple[float, dict]] = self._instance.listings
+		self.ttl = ttl
+
+	def get_many(self, listing_ids: Iterable[int]) -> Tuple[Dict[int, dict], List[int]]:
+		now = time.monotonic()
+		found = {}
+		missing = []
+		for listing_id in listing_ids:
+			entry = self.listings.get(listing_id)
+			if entry is not None and entry[0] > now:
+				found[listing_id] = entry[1]
+			else:
+				missing.append(listing_id)
+		return found, missing
+
+	def put_many(self, listings: Iterable[dict]):
+		expires_at = time.monotonic() + self.ttl
+		for listing in listings:
+			self.listings[listing["listing_id"]] = (expires_at, listing)
+
+	def invalidate(self, listing_ids: Iterable[int]):
+		for listing_id in listing_ids:
+			self.listings.pop(listing_id, None)
+
+
+class ListingCatalog:
+	"""
+		Per-shop copy of the Etsy listings in the Listings collection. Receipts only
+		keep listing_ids, due dates are calculated from the catalog instead of the
+		Listings/ShippingTemplate includes.
+	"""
+
+	def __init__(self, asyncEtsyApi: AsyncEtsy):
+		self.asyncEtsyApi = asyncEtsyApi
+		self.shop_name = asyncEtsyApi.shop_id
+		self.cache = ListingCache()
+
+	async def get_listings(self, listing_ids: Iterable[int]) -> Dict[int, dict]:
+		"""Looks listings up in the cache, then MongoDB, then Etsy. Listings Etsy couldn't return are left out."""
+		listings, missing = self.cache.get_many(set(listing_ids))
+		if len(missing) == 0:
+			return listings
+		db = MongoDB().db
+		stored = await db["Listings"].find(
+			{"listing_id": {"$in": missing}}, projection={"_id": False}
+		).to_list(length=None)
+		self.cache.put_many(stored)
+		listings.update((listing["listing_id"], listing) for listing in stored)
+		missing = [listing_id for listing_id in missing if listing_id not in listings]
+		if len(missing) > 0:
+			fetched = await self.fetch_listings(missing)
+			await self.upsert_listings(fetched)
+			listings.update((listing["listing_id"], listing) for listing in fetched)
+		return listings
+
+	async def fetch_listings(self, listing_ids: List[int]) -> List[dict]:
+		"""Fetches listings by id with multi-id getListing requests, sold out and inactive ones included."""
+		listing_ids = [str(listing_id) for listing_id in listing_ids]
+		batches = [
+			listing_ids[i:i + LISTING_BATCH_SIZE]
+			for i in range(0, len(listing_ids), LISTING_BATCH_SIZE)
+		]
+		outcomes = await asyncio.gather(*(
+			self.asyncEtsyApi.outcomeByPage(
+				Method.get, EtsyUrl.getListing(",".join(batch)),
+				{"fields": LISTING_FIELDS, "limit": LISTING_BATCH_SIZE}, 1)
+			for batch in batches
+		))
+		listings = []
+		for outcome in outcomes:
+			if not outcome.ok:
+				logging.info(f"{self.shop_name} listings could not be fetched {outcome}")
+				continue
+			listings.extend(outcome.results)
+		logging.info(f"{self.shop_name} {len(listings)} of {len(listing_ids)} unknown listings fetched from Etsy.")
+		return listings
+
+	async def fetch_receipt_listings(self, receipt_ids: List[int]) -> List[dict]:
+		"""
+			Fetches the listings of receipts through their Listings include, for
+			listings getListing couldn't return. They are added to the catalog.
+		"""
+		receipt_ids = [str(receipt_id) for receipt_id in receipt_ids]
+		batches = [
+			receipt_ids[i:i + RECEIPT_BATCH_SIZE]
+			for i in range(0, len(receipt_ids), RECEIPT_BATCH_SIZE)
+		]
+		outcomes = await asyncio.gather(*(
+			self.asyncEtsyApi.outcomeByPage(
+				Method.get, EtsyUrl.getShop_Receipt2(",".join(batch)),
+				{"fields": "receipt_id", "includes": f"Listings({LISTING_FIELDS})", "limit": RECEIPT_BATCH_SIZE}, 1)
+			for batch in batches
+		))
+		listings = {}
+		for outcome in outcomes:
+			if not outcome.ok:
+				logging.info(f"{self.shop_name} receipt listings could not be fetched {outcome}")
+				continue
+			for receipt in outcome.results:
+				listings.update((listing["listing_id"], listing) for listing in receipt.get("Listings", []))
+		await self.upsert_listings(list(listings.values()))
+		logging.info(f"{self.shop_name} {len(listings)} listings fetched through {len(receipt_ids)} receipts.")
+		return list(listings.values())
+
+	async def upsert_listings(self, listings: List[dict]):
+		if len(listings) == 0:
+			return
+		db = MongoDB().db
+		requests = []
+		for listing in listings:
+			listing["shop_name"] = self.shop_name
+			requests.append(UpdateOne({"listing_id": listing["listing_id"]}, {"$set": listing}, upsert=True))
+		await db["Listings"].bulk_write(requests, ordered=False)
+		self.cache.put_many(listings)
+
+	async def sync(self) -> Optional[int]:
+		"""
+			Lists the shop's active listings with LISTING_FIELDS only and writes the
+			ones that are new or whose last_modified_tsz moved. Returns how many
+			listings changed, None if some pages could not be fetched.
+		"""
+		db = MongoDB().db
+		listed: Dict[int, dict] = {}
+		is_complete = True
+		async for outcome in self.asyncEtsyApi.iter_pages(
+			Method.get, EtsyUrl.findAllShopListingsActive(self.shop_name), {"fields": LISTING_FIELDS}
+		):
+			if not outcome.ok:
+				is_complete = False
+				logging.info(f"{self.shop_name} active listings response was not successful {outcome}")
+				continue
+			for listing in outcome.results:
+				listed[listing["listing_id"]] = listing
+		stored: Dict[int, Optional[int]] = {}
+		async for listing in db["Listings"].find(
+			{"listing_id": {"$in": list(listed.keys())}},
+			projection={"_id": False, "listing_id": True, "last_modified_tsz": True}
+		):
+			stored[listing["listing_id"]] = listing.get("last_modified_tsz")
+		changed = [
+			listing for listing_id, listing in listed.items()
+			if stored.get(listing_id) is None or listing["last_modified_tsz"] > stored[listing_id]
+		]
+		self.cache.invalidate(listing["listing_id"] for listing in changed)
+		await EtsyReadCache(self.asyncEtsyApi.etsy_connection_id).invalidate(
+			CachedResource.listing, (listing["listing_id"] for listing in changed))
+		await self.upsert_listings(changed)
+		logging.info(f"{colored(self.shop_name, 'blue', 'on_grey', attrs=['bold', 'underline'])} {len(listed)} active listings, {len(changed)} new or changed.")
+		return len(changed) if is_complete else None
+
+
+async def syncListings(etsy_connection_id: str):
+	db = MongoDB().db
+	try:
+		asyncEtsyApi = await AsyncEtsy.getAsyncEtsyApi(etsy_connection_id, db)
+		changed = await ListingCatalog(asyncEtsyApi).sync()
+	except Exception as e:
+		logging.exception(e)
+		return
+	if changed is None:
+		logging.info(f"({etsy_connection_id}) listing sync is incomplete, the rest is fetched on demand.")
@@ -0,0 +1,93 @@
+import time
+from typing import List
+
+from config import ADAPTIVE_POLLING_MIN_INTERVAL, ADAPTIVE_POLLING_MAX_INTERVAL, ADAPTIVE_POLLING_HISTORY_DAYS, \
+	ADAPTIVE_POLLING_TARGET_ORDERS, ADAPTIVE_POLLING_RELEARN
+from database import MongoDB
+
+HOURS = 24
+
+
+class PollingProfile:
+	"""
+		A shop's order arrival rate by hour of day (UTC), learned from the
+		creation_tsz of its last ADAPTIVE_POLLING_HISTORY_DAYS days of Receipts.
+		The new receipts sync is polled so that about ADAPTIVE_POLLING_TARGET_ORDERS
+		orders arrive between two polls, within the configured bounds.
+	"""
+
+	def __init__(self, shop_name: str, orders_by_hour: List[int], days: float, learned_at: float):
+		self.shop_name = shop_name
+		self.orders_by_hour = orders_by_hour
+		self.days = days
+		self.learned_at = learned_at
+		# A single order at 14:xx shouldn't make 14:00 a peak hour on its own,
+		# every hour is averaged with its two neighbours.
+		self.rates = [
+			sum(orders_by_hour[(hour + offset) % HOURS] for offset in (-1, 0, 1)) / 3 / days
+			for hour in range(HOURS)
+		]
+
+	@staticmethod
+	async def learn(shop_name: str) -> "PollingProfile":
+		db = MongoDB().db
+		now = time.time()
+		since = int(now - ADAPTIVE_POLLING_HISTORY_DAYS * 86400)
+		orders_by_hour = [0] * HOURS
+		first_order = now
+		async for hour in db["Receipts"].aggregate([
+			{"$match": {"shop_name": shop_name, "creation_tsz": {"$gte": since}}},
+			{"$group": {
+				"_id": {"$hour": {"$toDate": {"$multiply": ["$creation_tsz", 1000]}}},
+				"orders": {"$sum": 1},
+				"first_order": {"$min": "$creation_tsz"}
+			}}
+		]):
+			orders_by_hour[hour["_id"]] = hour["orders"]
+			first_order = min(first_order, hour["first_order"])
+		# Shops connected recently have less history than the window.
+		days = max(1.0, (now - first_order) / 86400)
+		return PollingProfile(shop_name, orders_by_hour, days, now)
+
+	def is_stale(self) -> bool:
+		return time.time() - self.learned_at > ADAPTIVE_POLLING_RELEARN
+
+	def interval_at_hour(self, hour: int) -> float:
+		"""Seconds between two polls during that hour of the day."""
+		rate = self.rates[hour]
+		if rate <= 0:
+			return ADAPTIVE_POLLING_MAX_INTERVAL * 60
+		minutes = ADAPTIVE_POLLING_TARGET_ORDERS / rate * 60
+		return min(ADAPTIVE_POLLING_MAX_INTERVAL, max(ADAPTIVE_POLLING_MIN_INTERVAL, minutes)) * 60
+
+	def interval(self, at: float) -> float:
+		return self.interval_at_hour(time.gmtime(at).tm_hour)
+
+	def next_poll(self, after: float) -> float:
+		"""
+			When to poll next after a poll at `after`. A quiet hour's long interval
+			is cut short when a busier hour starts before it ends.
+		"""
+		next_poll = after + self.interval(after)
+		hour_start = after - after % 3600 + 3600
+		while hour_start < next_poll:
+			next_poll = min(next_poll, hour_start + self.interval(hour_start))
+			hour_start += 3600
+		return next_poll
+
+	def schedule(self) -> dict:
+		return {
+			"shop_name": self.shop_name,
+			"learned_at": self.learned_at,
+			"history_days": round(self.days, 2),
+			"orders_per_day": round(sum(self.orders_by_hour) / self.days, 2),
+			"hours": [
+				{
+					"hour_utc": hour,
+					"orders": self.orders_by_hour[hour],
+					"orders_per_hour": round(self.rates[hour], 4),
+					"interval_minutes": round(self.interval_at_hour(hour) / 60, 1)
+				}
+				for hour in range(HOURS)
+			]
+		}
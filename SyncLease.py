@@ -0,0 +1,108 @@
+import asyncio
+import uuid
+from typing import Optional
+
+from aioredis import RedisError
+
+from config import SYNC_LEASE_TTL_MS
+from database import MyRedis
+from MyLogger import Logger
+from SyncState import SyncState
+logging = Logger().logging
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+	return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Sets the watermark field of the sync state hash only while we still own the
+# lease and no later lease holder has committed, i.e. the fence stored next to
+# the field is not newer than ours. The checkpoint of the watermark goes with it.
+COMMIT_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+	return 0
+end
+local fence_field = ARGV[3] .. '_fence'
+local committed_fence = tonumber(redis.call('HGET', KEYS[2], fence_field) or '0')
+if committed_fence > tonumber(ARGV[2]) then
+	return 0
+end
+redis.call('HSET', KEYS[2], ARGV[3], ARGV[4], fence_field, ARGV[2])
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+
+class SyncLease:
+	"""
+		Exclusive, expiring lease on a shop's sync. The lease is a SET NX PX key
+		holding a random owner token and is renewed by a heartbeat while the sync
+		runs, so a crashed process loses it after SYNC_LEASE_TTL_MS. Every
+		acquisition gets a fencing token from {id}:sync_fence; commit() refuses
+		to move a watermark once the lease was lost or a newer holder committed.
+	"""
+
+	def __init__(self, etsy_connection_id: str, ttl_ms: int = SYNC_LEASE_TTL_MS):
+		self.etsy_connection_id = etsy_connection_id
+		self.ttl_ms = ttl_ms
+		self.key = f"{etsy_connection_id}:sync_lease"
+		self.token = uuid.uuid4().hex
+		self.fence: Optional[int] = None
+		self.lost = False
+		self.heartbeat: Optional[asyncio.Task] = None
+
+	@staticmethod
+	async def is_held(etsy_connection_id: str) -> bool:
+		return await MyRedis().r.exists(f"{etsy_connection_id}:sync_lease") == 1
+
+	async def acquire(self) -> bool:
+		r = MyRedis().r
+		if not await r.set(self.key, self.token, nx=True, px=self.ttl_ms):
+			return False
+		self.fence = await r.incr(f"{self.etsy_connection_id}:sync_fence")
+		self.heartbeat = asyncio.get_running_loop().create_task(self.renew_forever())
+		logging.info(f"({self.etsy_connection_id}) sync lease acquired, fencing token {self.fence}.")
+		return True
+
+	async def renew_forever(self):
+		r = MyRedis().r
+		while True:
+			await asyncio.sleep(self.ttl_ms / 3000)
+			try:
+				renewed = await r.register_script(RENEW_SCRIPT)(keys=[self.key], args=[self.token, self.ttl_ms])
+			except RedisError as e:
+				logging.error(f"({self.etsy_connection_id}) couldn't renew the sync lease. {e}")
+				continue
+			if not renewed:
+				self.lost = True
+				logging.error(f"({self.etsy_connection_id}) sync lease {self.fence} was lost, its watermark won't be committed.")
+				return
+
+	async def commit(self, state: SyncState, watermark: str, value) -> bool:
+		"""Sets the watermark field of state to value if this lease is still the current one."""
+		committed = await MyRedis().r.register_script(COMMIT_SCRIPT)(
+			keys=[self.key, state.key, state.checkpoint_key(watermark)],
+			args=[self.token, self.fence, watermark, value])
+		if not committed:
+			self.lost = True
+			logging.error(f"({self.etsy_connection_id}) sync lease {self.fence} is no longer current, {watermark} was not moved.")
+			return False
+		setattr(state, watermark, int(value))
+		return True
+
+	async def release(self):
+		if self.heartbeat is not None:
+			self.heartbeat.cancel()
+		try:
+			await MyRedis().r.register_script(RELEASE_SCRIPT)(keys=[self.key], args=[self.token])
+		except RedisError as e:
+			logging.error(f"({self.etsy_connection_id}) couldn't release the sync lease, it expires in {self.ttl_ms}ms. {e}")
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import redis
+from rq import Queue, Retry, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from config import REDIS_TLS_URL, SYNC_QUEUE_NAME, SYNC_JOB_TIMEOUT, SYNC_JOB_RESULT_TTL, SYNC_JOB_BUSY_RETRIES, \
+	SYNC_JOB_BUSY_RETRY_DELAY, SYNC_JOB_POLL_INTERVAL, SYNC_JOB_CANCEL_MARGIN, BACKFILL_JOB_TIMEOUT
+from database import MyRedis
+from EtsyShopManager import syncShop, sync_mode_for, SyncMode
+from MyLogger import Logger
+logging = Logger().logging
+
+PENDING_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.SCHEDULED, JobStatus.DEFERRED)
+# Text fields of the rq:job:{id} hash, the rest is pickled.
+JOB_FIELDS = ("status", "origin", "description", "enqueued_at", "started_at", "ended_at")
+
+
+class ShopBusyError(Exception):
+	def __init__(self, etsy_connection_id: str):
+		super().__init__(f"{etsy_connection_id} is already syncing somewhere else.")
+
+
+class SyncFailedError(Exception):
+	def __init__(self, etsy_connection_id: str, mode: SyncMode):
+		super().__init__(f"{etsy_connection_id} {mode.value} sync failed, see the sync telemetry and the worker logs.")
+
+
+def sync_job_id(etsy_connection_id: str, mode: SyncMode) -> str:
+	return f"sync-{etsy_connection_id}-{mode.value.lower()}"
+
+
+def job_timeout(mode: SyncMode) -> int:
+	return BACKFILL_JOB_TIMEOUT if mode == SyncMode.backfill else SYNC_JOB_TIMEOUT
+
+
+def fail_without_retry():
+	"""The job's Retry is only meant for ShopBusyError, any other failure ends the job as failed."""
+	job = get_current_job()
+	if job is not None:
+		job.retries_left = 0
+
+
+def run_sync_job(etsy_connection_id: str, mode: str) -> dict:
+	"""
+		RQ entry point. Workers run every job on the same event loop (see worker.py),
+		so the pooled Etsy, Redis and MongoDB clients are reused between jobs.
+		syncShop is cancelled SYNC_JOB_CANCEL_MARGIN seconds before the job times
+		out, and whenever the job ends with an exception (RQ's JobTimeoutException
+		included), so no sync is left pending on the loop to wake up in the next job.
+		A sync that didn't succeed fails the job, only a busy shop is retried.
+	"""
+	mode = SyncMode(mode)
+	loop = asyncio.get_event_loop()
+	task = loop.create_task(asyncio.wait_for(
+		syncShop(etsy_connection_id, mode),
+		max(1, job_timeout(mode) - SYNC_JOB_CANCEL_MARGIN)))
+	try:
+		result = loop.run_until_complete(task)
+	except BaseException:
+		fail_without_retry()
+		if not task.done():
+			task.cancel()
+			# Lets syncShop release its lease and stop the heartbeat before the job fails.
+			loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+		raise
+	if result.get("background-task") == "already running":
+		# Retried after SYNC_JOB_BUSY_RETRY_DELAY seconds by the worker's scheduler.
+		raise ShopBusyError(etsy_connection_id)
+	if not result.get("successful"):
+		fail_without_retry()
+		raise SyncFailedError(etsy_connection_id, mode)
+	return result
+
+
+class SyncQueue(object):
+	"""
+		The RQ queue syncShop jobs are dispatched on. A shop has one job id per
+		sync mode, so a sync that is still pending is returned instead of being
+		queued twice, and the sync lease keeps two workers off the same shop.
+	"""
+	_instance = None
+
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No SyncQueue found creating one.")
+			cls._instance = object.__new__(cls)
+			redis_connection_url = urlparse(REDIS_TLS_URL)
+			# RQ pickles job data, it needs a blocking client that doesn't decode responses.
+			SyncQueue._instance.connection = redis.Redis(host=redis_connection_url.hostname,
+			                                             port=redis_connection_url.port,
+			                                             username=redis_connection_url.username,
+			                                             password=redis_connection_url.password,
+			                                             ssl=True,
+			                                             ssl_cert_reqs=None)
+			SyncQueue._instance.queue = Queue(SYNC_QUEUE_NAME, connection=SyncQueue._instance.connection)
+		return cls._instance
+
+	def __init__(self):
+		self.connection: redis.Redis = self._instance.connection
+		self.queue: Queue = self._instance.queue
+
+	def enqueue_sync(self, etsy_connection_id: str, mode: SyncMode = SyncMode.created) -> Job:
+		job_id = sync_job_id(etsy_connection_id, mode)
+		try:
+			job = Job.fetch(job_id, connection=self.connection)
+		except NoSuchJobError:
+			job = None
+		if job is not None and job.get_status() in PENDING_STATUSES:
+			logging.info(f"({etsy_connection_id}) {mode.value} sync is already {job.get_status()}, not queueing it again.")
+			return job
+		return self.queue.enqueue(
+			run_sync_job, etsy_connection_id, mode.value,
+			job_id=job_id,
+			job_timeout=job_timeout(mode),
+			result_ttl=SYNC_JOB_RESULT_TTL,
+			failure_ttl=SYNC_JOB_RESULT_TTL,
+			# Only a busy shop is retried, run_sync_job turns the retries off for any other failure.
+			retry=Retry(max=SYNC_JOB_BUSY_RETRIES, interval=SYNC_JOB_BUSY_RETRY_DELAY),
+			description=f"{mode.value} sync of {etsy_connection_id}")
+
+	async def enqueue(self, etsy_connection_id: str, mode: SyncMode = SyncMode.created) -> str:
+		mode = await sync_mode_for(etsy_connection_id, mode)
+		job = await asyncio.get_running_loop().run_in_executor(None, self.enqueue_sync, etsy_connection_id, mode)
+		return job.id
+
+	@staticmethod
+	async def job_status(job_id: str) -> Optional[dict]:
+		values = await MyRedis().r.hmget(f"rq:job:{job_id}", *JOB_FIELDS)
+		if values[0] is None:
+			return None
+		return {"job_id": job_id, **dict(zip(JOB_FIELDS, values))}
+
+	async def wait(self, job_id: str, timeout: float = SYNC_JOB_TIMEOUT * 2) -> Optional[str]:
+		"""Waits until the job is done, returns its last status (None once it expired)."""
+		deadline = time.monotonic() + timeout
+		status = None
+		while time.monotonic() < deadline:
+			job = await SyncQueue.job_status(job_id)
+			status = job["status"] if job is not None else None
+			if status not in PENDING_STATUSES:
+				return status
+			await asyncio.sleep(SYNC_JOB_POLL_INTERVAL)
+		logging.error(f"{job_id} is still {status} after {timeout}s, no longer waiting for it.")
+		return status
@@ -0,0 +1,191 @@
+import json
+import time
+from typing import Dict, Iterable, List, Optional
+
+from config import UNPAID_RECEIPT_MAX_AGE, SYNC_CHECKPOINT_TTL
+from database import MyRedis
+from MyLogger import Logger
+logging = Logger().logging
+
+
+class SyncState:
+	"""
+		A shop's sync state: watermarks in the {id}:sync_state hash and the unpaid
+		receipt ids in the {id}:unpaid_receipt_ids sorted set, scored by the time
+		they were first seen unpaid. Unpaid ids older than UNPAID_RECEIPT_MAX_AGE
+		seconds are dropped when the state is loaded. A sync that stops halfway
+		leaves a checkpoint in {id}:sync_checkpoint:{watermark}, it is deleted
+		when the watermark is committed. Watermarks of shops synced before this
+		store existed are read from their old string keys until the next commit,
+		their old unpaid list is moved into the sorted set whenever it is found.
+	"""
+
+	def __init__(self, etsy_connection_id: str):
+		self.etsy_connection_id = etsy_connection_id
+		self.key = f"{etsy_connection_id}:sync_state"
+		self.unpaid_key = f"{etsy_connection_id}:unpaid_receipt_ids"
+		self.legacy_unpaid_key = f"{etsy_connection_id}:unpaid_receipts"
+		self.last_updated: Optional[int] = None
+		self.last_modified: Optional[int] = None
+		self.unpaid_receipt_ids: List[str] = []
+		self.checkpoint: Optional[Dict[str, str]] = None
+
+	def checkpoint_key(self, watermark: str) -> str:
+		return f"{self.etsy_connection_id}:sync_checkpoint:{watermark}"
+
+	@staticmethod
+	async def load(etsy_connection_id: str) -> "SyncState":
+		state = SyncState(etsy_connection_id)
+		r = MyRedis().r
+		async with r.pipeline(transaction=False) as pipe:
+			pipe.hgetall(state.key)
+			pipe.zremrangebyscore(state.unpaid_key, "-inf", time.time() - UNPAID_RECEIPT_MAX_AGE)
+			pipe.zrange(state.unpaid_key, 0, -1)
+			pipe.get(f"{etsy_connection_id}:last_updated")
+			pipe.get(f"{etsy_connection_id}:last_modified")
+			pipe.get(state.legacy_unpaid_key)
+			pipe.hgetall(state.checkpoint_key("last_updated"))
+			fields, aged_out, unpaid_receipt_ids, \
+				legacy_last_updated, legacy_last_modified, legacy_unpaid, checkpoint = await pipe.execute()
+		if aged_out > 0:
+			logging.info(f"({etsy_connection_id}) {aged_out} unpaid receipts were too old and aged out.")
+		state.last_updated = SyncState.to_int(fields.get("last_updated", legacy_last_updated))
+		state.last_modified = SyncState.to_int(fields.get("last_modified", legacy_last_modified))
+		state.unpaid_receipt_ids = unpaid_receipt_ids
+		if legacy_unpaid is not None:
+			legacy_unpaid_ids = [receipt_id for receipt_id in legacy_unpaid.split(",") if receipt_id != ""]
+			await state.migrate_unpaid(legacy_unpaid_ids)
+			state.unpaid_receipt_ids = sorted(set(unpaid_receipt_ids) | set(legacy_unpaid_ids))
+		if len(checkpoint) > 0:
+			state.checkpoint = checkpoint
+		return state
+
+	@staticmethod
+	def to_int(value) -> Optional[int]:
+		return int(value) if value is not None else None
+
+	@staticmethod
+	async def last_updated_of(etsy_connection_id: str) -> Optional[int]:
+		r = MyRedis().r
+		async with r.pipeline(transaction=False) as pipe:
+			pipe.hget(f"{etsy_connection_id}:sync_state", "last_updated")
+			pipe.get(f"{etsy_connection_id}:last_updated")
+			last_updated, legacy_last_updated = await pipe.execute()
+		return SyncState.to_int(last_updated if last_updated is not None else legacy_last_updated)
+
+	@staticmethod
+	async def save_polling_schedule(etsy_connection_id: str, schedule: dict):
+		"""The new receipts polling the supervisor chose, kept in the sync_state hash for the web process."""
+		await MyRedis().r.hset(f"{etsy_connection_id}:sync_state", "polling_schedule", json.dumps(schedule))
+
+	@staticmethod
+	async def polling_schedule_of(etsy_connection_id: str) -> Optional[dict]:
+		schedule = await MyRedis().r.hget(f"{etsy_connection_id}:sync_state", "polling_schedule")
+		return json.loads(schedule) if schedule is not None else None
+
+	async def load_checkpoint(self, name: str) -> Optional[Dict[str, str]]:
+		checkpoint = await MyRedis().r.hgetall(self.checkpoint_key(name))
+		return checkpoint if len(checkpoint) > 0 else None
+
+	async def delete_checkpoints(self, names: Iterable[str]):
+		keys = [self.checkpoint_key(name) for name in names]
+		if len(keys) > 0:
+			await MyRedis().r.delete(*keys)
+
+	async def save_checkpoint(self, watermark: str, checkpoint: dict):
+		key = self.checkpoint_key(watermark)
+		async with MyRedis().r.pipeline(transaction=True) as pipe:
+			pipe.hset(key, mapping=checkpoint)
+			pipe.expire(key, SYNC_CHECKPOINT_TTL)
+			await pipe.execute()
+
+	async def migrate_unpaid(self, legacy_unpaid_ids: List[str]):
+		"""Moves the old comma separated unpaid list into the sorted set and deletes it, in one transaction."""
+		async with MyRedis().r.pipeline(transaction=True) as pipe:
+			if len(legacy_unpaid_ids) > 0:
+				pipe.zadd(self.unpaid_key, {receipt_id: time.time() for receipt_id in legacy_unpaid_ids}, nx=True)
+			pipe.delete(self.legacy_unpaid_key)
+			await pipe.execute()
+		logging.info(f"({self.etsy_connection_id}) {len(legacy_unpaid_ids)} unpaid receipts were migrated from {self.legacy_unpaid_key}.")
+
+	async def add_unpaid(self, unpaid_receipt_ids: Iterable):
+		"""Adds receipts to the unpaid set right away, without touching the ones already in it."""
+		unpaid_receipt_ids = {str(receipt_id) for receipt_id in unpaid_receipt_ids}
+		if len(unpaid_receipt_ids) == 0:
+			return
+		now = time.time()
+		await MyRedis().r.zadd(self.unpaid_key, {receipt_id: now for receipt_id in unpaid_receipt_ids}, nx=True)
+
+	async def save_unpaid(self, unpaid_receipt_ids: Iterable):
+		"""
+			Replaces the unpaid set with unpaid_receipt_ids in one round trip. Ids that
+			were already unpaid keep their first-seen score, the others are removed.
+		"""
+		unpaid_receipt_ids = {str(receipt_id) for receipt_id in unpaid_receipt_ids}
+		paid = set(self.unpaid_receipt_ids) - unpaid_receipt_ids
+		r = MyRedis().r
+		async with r.pipeline(transaction=True) as pipe:
+			if len(unpaid_receipt_ids) > 0:
+				now = time.time()
+				pipe.zadd(self.unpaid_key, {receipt_id: now for receipt_id in unpaid_receipt_ids}, nx=True)
+			if len(paid) > 0:
+				pipe.zrem(self.unpaid_key, *paid)
+			await pipe.execute()
+		self.unpaid_receipt_ids = sorted(unpaid_receipt_ids)
+
+
+class BackfillProgress:
+	"""
+		Plan and progress of a shop's backfill in the {id}:backfill hash. The plan
+		(its end and time windows) is kept until the backfill is done, so a failed
+		backfill is resumed with the same windows and skips the finished ones.
+	"""
+
+	def __init__(self, etsy_connection_id: str):
+		self.etsy_connection_id = etsy_connection_id
+		self.key = f"{etsy_connection_id}:backfill"
+
+	async def load(self) -> Optional[dict]:
+		fields = await MyRedis().r.hgetall(self.key)
+		if len(fields) == 0:
+			return None
+		windows = json.loads(fields.get("windows", "[]"))
+		windows_done = sorted(int(field.split(":")[1]) for field in fields if field.startswith("done:"))
+		receipts_total = int(fields.get("receipts_total", 0))
+		receipts_written = int(fields.get("receipts_written", 0))
+		return {
+			"status": fields.get("status"),
+			"started_at": SyncState.to_int(fields.get("started_at")),
+			"finished_at": SyncState.to_int(fields.get("finished_at")),
+			"ends_at": SyncState.to_int(fields.get("ends_at")),
+			"windows": windows,
+			"windows_done": windows_done,
+			"receipts_total": receipts_total,
+			"receipts_written": receipts_written,
+			"percent": round(100 * len(windows_done) / len(windows), 1) if len(windows) > 0 else 100.0
+		}
+
+	async def start(self, ends_at: int, receipts_total: int, windows: List[List[int]]):
+		async with MyRedis().r.pipeline(transaction=True) as pipe:
+			pipe.delete(self.key)
+			pipe.hset(self.key, mapping={
+				"status": "running",
+				"started_at": int(time.time()),
+				"ends_at": ends_at,
+				"receipts_total": receipts_total,
+				"receipts_written": 0,
+				"windows": json.dumps(windows)
+			})
+			await pipe.execute()
+
+	async def resume(self):
+		await MyRedis().r.hset(self.key, "status", "running")
+
+	async def add_written(self, receipts: int):
+		await MyRedis().r.hincrby(self.key, "receipts_written", receipts)
+
+	async def window_done(self, window: int):
+		await MyRedis().r.hset(self.key, f"done:{window}", 1)
+
+	async def finish(self, status: str):
+		await MyRedis().r.hset(self.key, mapping={"status": status, "finished_at": int(time.time())})
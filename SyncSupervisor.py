@@ -0,0 +1,275 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from enum import Enum
+from typing import Dict, List, Optional, Set, Tuple
+
+from termcolor import colored
+
+from config import SCHEDULED_JOB_INTERVAL, SCHEDULED_MODIFIED_JOB_INTERVAL, SCHEDULED_LISTINGS_JOB_INTERVAL, \
+	SYNC_SUPERVISOR_CONCURRENCY, SYNC_SUPERVISOR_RAMP_UP, SYNC_SUPERVISOR_JITTER, SYNC_SUPERVISOR_REFRESH_INTERVAL, \
+	SYNC_USE_WORKERS
+from database import MongoDB
+from EtsyShopManager import syncShop, SyncMode
+from ListingCatalog import syncListings
+from MyLogger import Logger
+from PollingProfile import PollingProfile
+from SyncQueue import SyncQueue
+from SyncState import SyncState
+logging = Logger().logging
+
+# A due job of a shop that is still busy with another one is looked at again after this many seconds.
+BUSY_SHOP_RETRY = 15
+
+
+class SupervisedJob(str, Enum):
+	new_receipts = "NEW_RECEIPTS"
+	modified_receipts = "MODIFIED_RECEIPTS"
+	listings = "LISTINGS"
+
+
+JOB_INTERVAL = {
+	SupervisedJob.new_receipts: SCHEDULED_JOB_INTERVAL * 60,
+	SupervisedJob.modified_receipts: SCHEDULED_MODIFIED_JOB_INTERVAL * 60,
+	SupervisedJob.listings: SCHEDULED_LISTINGS_JOB_INTERVAL * 60
+}
+
+
+async def run_job(etsy_connection_id: str, job: SupervisedJob):
+	if await SyncState.last_updated_of(etsy_connection_id) is None:
+		# Until the shop's backfill commits last_updated it is the only sync that runs.
+		if job != SupervisedJob.new_receipts:
+			logging.info(f"({etsy_connection_id}) {job.value} skipped, the shop's backfill hasn't committed yet.")
+			return
+		if SYNC_USE_WORKERS:
+			# Not waited for, a backfill can run for hours. The pending one (e.g. queued by /verify/etsy) is reused.
+			await SyncQueue().enqueue(etsy_connection_id, SyncMode.backfill)
+		else:
+			await syncShop(etsy_connection_id, SyncMode.backfill)
+		return
+	if job == SupervisedJob.listings:
+		await syncListings(etsy_connection_id)
+		return
+	mode = SyncMode.modified if job == SupervisedJob.modified_receipts else SyncMode.created
+	if SYNC_USE_WORKERS:
+		# The slot stays taken until a worker is done, so the concurrency bounds the queue too.
+		sync_queue = SyncQueue()
+		await sync_queue.wait(await sync_queue.enqueue(etsy_connection_id, mode))
+	else:
+		await syncShop(etsy_connection_id, mode)
+
+
+class SyncSupervisor(object):
+	"""
+		Runs every shop's syncs from one priority queue ordered by next due time,
+		with at most SYNC_SUPERVISOR_CONCURRENCY jobs at once and one job per shop.
+		Shops are first scheduled at a random point of the SYNC_SUPERVISOR_RAMP_UP
+		window, every interval is jittered by SYNC_SUPERVISOR_JITTER, and the shop
+		list is reloaded from EtsyShopConnections every
+		SYNC_SUPERVISOR_REFRESH_INTERVAL seconds.
+	"""
+	_instance = None
+
+	def __new__(cls, *args, **kwargs):
+		if cls._instance is None:
+			logging.info("No SyncSupervisor found creating one.")
+			cls._instance = object.__new__(cls)
+			SyncSupervisor._instance.setup()
+		return cls._instance
+
+	def setup(self):
+		# (due_at, sequence, etsy_connection_id, job), stale entries are skipped when popped.
+		self.queue: List[Tuple[float, int, str, SupervisedJob]] = []
+		self.sequence = itertools.count()
+		self.shops: Dict[str, str] = {}
+		self.due: Dict[Tuple[str, SupervisedJob], float] = {}
+		self.running: Dict[str, SupervisedJob] = {}
+		self.tasks: Set[asyncio.Task] = set()
+		self.history: Dict[Tuple[str, SupervisedJob], dict] = {}
+		self.profiles: Dict[str, PollingProfile] = {}
+		self.loop_task: Optional[asyncio.Task] = None
+		self.wakeup: Optional[asyncio.Event] = None
+		self.slots: Optional[asyncio.Semaphore] = None
+
+	@staticmethod
+	def jittered(seconds: float) -> float:
+		return seconds * random.uniform(1 - SYNC_SUPERVISOR_JITTER, 1 + SYNC_SUPERVISOR_JITTER)
+
+	def next_due(self, etsy_connection_id: str, job: SupervisedJob, after: float) -> float:
+		"""New receipts follow the shop's learned order rate, the other jobs their fixed interval."""
+		profile = self.profiles.get(etsy_connection_id)
+		if job == SupervisedJob.new_receipts and profile is not None:
+			return after + self.jittered(profile.next_poll(after) - after)
+		return after + self.jittered(JOB_INTERVAL[job])
+
+	async def learn(self, etsy_connection_id: str):
+		profile = self.profiles.get(etsy_connection_id)
+		if profile is not None and not profile.is_stale():
+			return
+		try:
+			self.profiles[etsy_connection_id] = await PollingProfile.learn(self.shops[etsy_connection_id])
+		except Exception as e:
+			logging.exception(e)
+
+	async def publish_schedule(self, etsy_connection_id: str, polled_at: float, next_poll_at: float):
+		"""Saves the polling the supervisor uses for a shop's new receipts, served by main's sync_schedule."""
+		profile = self.profiles.get(etsy_connection_id)
+		schedule = profile.schedule() if profile is not None else {"shop_name": self.shops.get(etsy_connection_id)}
+		schedule.update({
+			"adaptive": profile is not None,
+			"fixed_interval_minutes": None if profile is not None else JOB_INTERVAL[SupervisedJob.new_receipts] / 60,
+			"jitter": SYNC_SUPERVISOR_JITTER,
+			"polled_at": polled_at,
+			"next_poll_at": next_poll_at
+		})
+		try:
+			await SyncState.save_polling_schedule(etsy_connection_id, schedule)
+		except Exception as e:
+			logging.exception(e)
+
+	def schedule(self, etsy_connection_id: str, job: SupervisedJob, due_at: float):
+		self.due[(etsy_connection_id, job)] = due_at
+		heapq.heappush(self.queue, (due_at, next(self.sequence), etsy_connection_id, job))
+		if self.wakeup is not None:
+			self.wakeup.set()
+
+	def add_shop(self, etsy_connection_id: str, shop_name: str, ramp_up: float = SYNC_SUPERVISOR_RAMP_UP):
+		self.shops[etsy_connection_id] = shop_name
+		now = time.time()
+		for job in SupervisedJob:
+			self.schedule(etsy_connection_id, job, now + random.uniform(0, ramp_up))
+		logging.info(f"{shop_name} ({etsy_connection_id}) was added to the sync supervisor.")
+
+	def remove_shop(self, etsy_connection_id: str):
+		shop_name = self.shops.pop(etsy_connection_id, None)
+		self.profiles.pop(etsy_connection_id, None)
+		for job in SupervisedJob:
+			self.due.pop((etsy_connection_id, job), None)
+		logging.info(f"{shop_name} ({etsy_connection_id}) was removed from the sync supervisor.")
+
+	def trigger(self, etsy_connection_id: str, job: SupervisedJob = SupervisedJob.new_receipts) -> bool:
+		"""Moves a shop's job to the front of the queue, False if the shop is unknown."""
+		if etsy_connection_id not in self.shops:
+			return False
+		self.schedule(etsy_connection_id, job, time.time())
+		return True
+
+	async def refresh(self):
+		# Connections stay unverified (without an OAuth token) until the user finishes /verify/etsy.
+		db = MongoDB().db
+		shops = {
+			str(etsy_connection["_id"]): etsy_connection.get("etsy_shop_name")
+			async for etsy_connection in db["EtsyShopConnections"].find(
+				{"verified": True}, projection={"_id": True, "etsy_shop_name": True})
+		}
+		# The ramp-up only spreads the shops found at startup, later ones start right away.
+		ramp_up = SYNC_SUPERVISOR_RAMP_UP if len(self.shops) == 0 else 0
+		for etsy_connection_id, shop_name in shops.items():
+			if etsy_connection_id not in self.shops:
+				self.add_shop(etsy_connection_id, shop_name, ramp_up)
+		for etsy_connection_id in list(self.shops.keys()):
+			if etsy_connection_id not in shops:
+				self.remove_shop(etsy_connection_id)
+
+	def start(self):
+		if self.loop_task is not None:
+			return
+		self.wakeup = asyncio.Event()
+		self.slots = asyncio.Semaphore(SYNC_SUPERVISOR_CONCURRENCY)
+		self.loop_task = asyncio.get_running_loop().create_task(self.supervise())
+
+	async def stop(self):
+		if self.loop_task is None:
+			return
+		self.loop_task.cancel()
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(self.loop_task, *self.tasks, return_exceptions=True)
+		self.loop_task = None
+
+	async def supervise(self):
+		next_refresh = 0.0
+		while True:
+			now = time.time()
+			if now >= next_refresh:
+				try:
+					await self.refresh()
+				except Exception as e:
+					logging.exception(e)
+				next_refresh = now + SYNC_SUPERVISOR_REFRESH_INTERVAL
+			timeout = next_refresh - now
+			if len(self.queue) > 0:
+				timeout = min(timeout, self.queue[0][0] - now)
+			if timeout > 0:
+				self.wakeup.clear()
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+				continue
+			if len(self.queue) == 0:
+				continue
+			await self.slots.acquire()
+			due_at, _, etsy_connection_id, job = heapq.heappop(self.queue)
+			if self.due.get((etsy_connection_id, job)) != due_at:
+				# Removed shop, or the job was triggered or rescheduled since.
+				self.slots.release()
+				continue
+			if etsy_connection_id in self.running:
+				self.slots.release()
+				self.schedule(etsy_connection_id, job, time.time() + BUSY_SHOP_RETRY)
+				continue
+			self.running[etsy_connection_id] = job
+			task = asyncio.get_running_loop().create_task(self.execute(etsy_connection_id, job, due_at))
+			self.tasks.add(task)
+			task.add_done_callback(self.tasks.discard)
+
+	async def execute(self, etsy_connection_id: str, job: SupervisedJob, due_at: float):
+		started_at = time.time()
+		logging.info(colored(f"{self.shops.get(etsy_connection_id)} {job.value} sync started, {round(started_at - due_at, 1)}s late.", "blue", "on_grey"))
+		try:
+			await run_job(etsy_connection_id, job)
+			if job == SupervisedJob.new_receipts:
+				await self.learn(etsy_connection_id)
+		except Exception as e:
+			logging.exception(e)
+		finally:
+			finished_at = time.time()
+			self.running.pop(etsy_connection_id, None)
+			self.slots.release()
+			self.history[(etsy_connection_id, job)] = {
+				"started_at": started_at,
+				"finished_at": finished_at,
+				"lag_seconds": started_at - due_at
+			}
+			if etsy_connection_id in self.shops and (etsy_connection_id, job) in self.due:
+				# Keep the cadence, but never queue a job that is already due again.
+				next_due = max(self.next_due(etsy_connection_id, job, due_at), finished_at)
+				if self.due[(etsy_connection_id, job)] == due_at:
+					self.schedule(etsy_connection_id, job, next_due)
+					if job == SupervisedJob.new_receipts:
+						await self.publish_schedule(etsy_connection_id, started_at, next_due)
+
+	def status(self) -> dict:
+		now = time.time()
+		shops = {}
+		for (etsy_connection_id, job), due_at in self.due.items():
+			shop = shops.setdefault(etsy_connection_id, {
+				"shop_name": self.shops.get(etsy_connection_id),
+				"running": self.running.get(etsy_connection_id),
+				"jobs": {}
+			})
+			shop["jobs"][job.value] = {
+				"due_in_seconds": round(due_at - now, 1),
+				"interval_seconds": round(self.next_due(etsy_connection_id, job, now) - now),
+				**self.history.get((etsy_connection_id, job), {})
+			}
+		return {
+			"concurrency": SYNC_SUPERVISOR_CONCURRENCY,
+			"adaptive": len(self.profiles),
+			"running": len(self.running),
+			"queued": len(self.due),
+			"shops": shops
+		}
@@ -0,0 +1,39 @@
+import time
+from datetime import datetime
+
+from database import MongoDB
+from MyLogger import Logger
+logging = Logger().logging
+
+
+class SyncTelemetry:
+	"""
+		Collects what a single syncShop run did and stores it in the SyncTelemetry
+		collection when the run finishes.
+	"""
+
+	def __init__(self, etsy_connection_id: str, mode: str):
+		self.started = time.monotonic()
+		self.record = {
+			"etsy_connection_id": etsy_connection_id,
+			"mode": mode,
+			"started_at": datetime.utcnow(),
+			"decision": None,
+			"counts": {}
+		}
+
+	def set(self, **fields):
+		self.record.update(fields)
+
+	def incr(self, name: str, value: int = 1):
+		self.record["counts"][name] = self.record["counts"].get(name, 0) + value
+
+	async def save(self, status: str):
+		self.record["status"] = status
+		self.record["finished_at"] = datetime.utcnow()
+		self.record["duration_seconds"] = round(time.monotonic() - self.started, 3)
+		try:
+			await MongoDB().db["SyncTelemetry"].insert_one(self.record)
+		except Exception as e:
+			logging.exception(e)
+		logging.info(f"({self.record['etsy_connection_id']}) sync telemetry: {self.record}")
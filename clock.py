@@ -23,11 +23,13 @@ from termcolor import colored
 # from apscheduler.schedulers.background import BackgroundScheduler
 from MyLogger import Logger
 from MyScheduler import MyScheduler
-from EtsyShopManager import syncShop
+from EtsyShopManager import syncShop, sync_mode_for, SyncMode
+from AsyncEtsyApi import AsyncEtsy
+from SyncSupervisor import SyncSupervisor, SupervisedJob
 from utils.get_new_orders_for_manufacture import get_todays_order
 
 # syncShop = EtsyShopManager.syncShop
-from config import SCHEDULED_JOB_INTERVAL, SCHEDULED_JOB_OFFSET, ENV_MODE
+from config import ENV_MODE
 
 # from threading import Timer
 # from jobs import SyncEtsyShopReceipts
@@ -41,18 +43,18 @@ from config import SCHEDULED_JOB_INTERVAL, SCHEDULED_JOB_OFFSET, ENV_MODE
 logging = Logger().logging
 # import time
 import os
-from database import MongoDB
-from fastapi import FastAPI
+from database import MongoDB, MyRedis
+from fastapi import FastAPI, HTTPException
 
 mongodb = MongoDB()
 
 app = FastAPI()
 
-job_offset = 0
 myScheduler = MyScheduler().scheduler
 
 @app.on_event("startup")
 async def startup_event():
+    await MyRedis().ping()
     myScheduler.add_job(
         get_todays_order,
         trigger="cron",
@@ -66,61 +68,23 @@ async def startup_event():
         jobstore="default" if ENV_MODE == "DEV" else "mongodb",
         max_instances=1,
     )
-    # myScheduler.start()
-    # myScheduler.print_jobs()
-    # return
-    # if ENV_MODE == "DEV":
-        # return
-    
-    global job_offset
-    mongodb = MongoDB()
-    logging.info("FastAPI startup_event")
-    etsy_connections = (
-        await mongodb.db["EtsyShopConnections"]
-        .find()
-        .sort("_id", -1)
-        .to_list(length=None)
-    )
-
-    for etsy_connection in etsy_connections:
-        logging.info(f"Prepearing {etsy_connection['etsy_shop_name']} ...")
-        etsy_connection_id = str(etsy_connection["_id"])
-        # if etsy_connection_id != "612ffdb941b255b8121f7eb3":
-        #     logging.info(f"Skipping ({etsy_connection['etsy_shop_name']}) | ({etsy_connection_id}) ...")
-        #     continue
-        logging.info(f"Creating sync shop process ({etsy_connection['etsy_shop_name']}) {etsy_connection_id} ...")
-        # continue
-        logging.info(
-            colored(
-                f"ETSY_CONNECTION_ID: {etsy_connection_id}",
-                "blue",
-                "on_white",
-                attrs=["reverse", "blink"],
-            )
-        )
-        myScheduler.add_job(
-            syncShop,
-            kwargs={"etsy_connection_id": etsy_connection_id},
-            replace_existing=True,
-            max_instances=1,
-            # jobstore='mongodb'
-        )
-        if ENV_MODE != "DEV":
-            myScheduler.add_job(
-                syncShop,
-                "interval",
-                minutes=SCHEDULED_JOB_INTERVAL + job_offset,
-                kwargs={"etsy_connection_id": etsy_connection_id},
-                id=f"{etsy_connection_id}:syncShopProcess",
-                name=f"{etsy_connection_id}:syncShopProcess",
-                replace_existing=True,
-                jobstore="default" if ENV_MODE == "DEV" else "mongodb",
-                max_instances=1,
-            )
-            job_offset += SCHEDULED_JOB_OFFSET
-    # print('Press Ctrl+C to exit')
     myScheduler.start()
+    # Per-shop interval jobs of older releases are still in the mongodb jobstore, the supervisor runs them now.
+    for job in myScheduler.get_jobs():
+        if job.id.endswith((":syncShopProcess", ":syncShopModifiedProcess", ":syncListingsProcess")):
+            logging.info(f"Removing the old {job.id} job.")
+            job.remove()
     myScheduler.print_jobs()
+    SyncSupervisor().start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await SyncSupervisor().stop()
+    if myScheduler.running:
+        myScheduler.shutdown(wait=False)
+    await AsyncEtsy.close_all_clients()
+    await MyRedis().close()
 
 
 @app.get("/")
@@ -128,9 +92,25 @@ async def root():
     return {"message": "APScheduler"}
 
 
+@app.get("/supervisor")
+async def supervisor_status():
+    return SyncSupervisor().status()
+
+
+@app.get("/supervisor/{etsy_connection_id}/schedule")
+async def supervisor_schedule(etsy_connection_id: str):
+    supervisor = SyncSupervisor()
+    profile = supervisor.profiles.get(etsy_connection_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No polling profile learned for {etsy_connection_id} yet")
+    return profile.schedule()
+
+
 @app.post("/syncShopProcess/{etsy_connection_id}")
-async def sync_shop_process(etsy_connection_id: str):
-    await syncShop(etsy_connection_id)
+async def sync_shop_process(etsy_connection_id: str, job: SupervisedJob = SupervisedJob.new_receipts):
+    if SyncSupervisor().trigger(etsy_connection_id, job):
+        return {"background-task": "queued"}
+    await syncShop(etsy_connection_id, await sync_mode_for(etsy_connection_id, SyncMode.created))
     # myScheduler.add_job(
     #     syncShop,
     #     kwargs={"etsy_connection_id": etsy_connection_id},
@@ -15,10 +15,96 @@ DEFAULT_SEARCH_PAGE = 1
 
 SCHEDULED_JOB_INTERVAL = 5 if ENV_MODE == "DEV" else 15
 SCHEDULED_JOB_OFFSET = 5 if ENV_MODE == "DEV" else 5
+SCHEDULED_MODIFIED_JOB_INTERVAL = 30 if ENV_MODE == "DEV" else 60
+SCHEDULED_LISTINGS_JOB_INTERVAL = 60 if ENV_MODE == "DEV" else 360
+# Syncs the supervisor in clock.py runs at once, over all shops
+SYNC_SUPERVISOR_CONCURRENCY = int(os.environ.get("SYNC_SUPERVISOR_CONCURRENCY", 4))
+# Shops found at startup get their first syncs spread over this many seconds
+SYNC_SUPERVISOR_RAMP_UP = int(os.environ.get("SYNC_SUPERVISOR_RAMP_UP", 300))
+# Every interval is stretched or shrunk by up to this fraction so shops drift apart
+SYNC_SUPERVISOR_JITTER = float(os.environ.get("SYNC_SUPERVISOR_JITTER", 0.1))
+# Seconds between reloads of EtsyShopConnections, new and deleted shops are picked up then
+SYNC_SUPERVISOR_REFRESH_INTERVAL = int(os.environ.get("SYNC_SUPERVISOR_REFRESH_INTERVAL", 60))
+# syncShop runs as RQ jobs on this queue, consumed by worker.py (False runs them in the clock and web processes)
+SYNC_USE_WORKERS = os.environ.get("SYNC_USE_WORKERS", "True") == "True"
+SYNC_QUEUE_NAME = os.environ.get("SYNC_QUEUE_NAME", "sync")
+SYNC_JOB_TIMEOUT = int(os.environ.get("SYNC_JOB_TIMEOUT", 30 * 60))
+# A sync job cancels its own syncShop this many seconds before RQ's job timeout would abandon it
+SYNC_JOB_CANCEL_MARGIN = int(os.environ.get("SYNC_JOB_CANCEL_MARGIN", 60))
+# Seconds finished and failed sync jobs stay pollable
+SYNC_JOB_RESULT_TTL = int(os.environ.get("SYNC_JOB_RESULT_TTL", 24 * 60 * 60))
+# A job whose shop is syncing elsewhere is retried this many times, this many seconds apart
+SYNC_JOB_BUSY_RETRIES = int(os.environ.get("SYNC_JOB_BUSY_RETRIES", 5))
+SYNC_JOB_BUSY_RETRY_DELAY = int(os.environ.get("SYNC_JOB_BUSY_RETRY_DELAY", 30))
+SYNC_JOB_POLL_INTERVAL = float(os.environ.get("SYNC_JOB_POLL_INTERVAL", 2))
+# New receipts are polled so that about ADAPTIVE_POLLING_TARGET_ORDERS orders arrive between two polls,
+# going by the shop's orders per hour of day over the last ADAPTIVE_POLLING_HISTORY_DAYS days (minutes)
+ADAPTIVE_POLLING_MIN_INTERVAL = float(os.environ.get("ADAPTIVE_POLLING_MIN_INTERVAL", 5))
+ADAPTIVE_POLLING_MAX_INTERVAL = float(os.environ.get("ADAPTIVE_POLLING_MAX_INTERVAL", 120))
+ADAPTIVE_POLLING_HISTORY_DAYS = int(os.environ.get("ADAPTIVE_POLLING_HISTORY_DAYS", 28))
+ADAPTIVE_POLLING_TARGET_ORDERS = float(os.environ.get("ADAPTIVE_POLLING_TARGET_ORDERS", 1))
+# Seconds before a shop's order rate is learned again
+ADAPTIVE_POLLING_RELEARN = int(os.environ.get("ADAPTIVE_POLLING_RELEARN", 6 * 60 * 60))
 
 NO_CONCURRENT = 10
 LIMIT = 100
 
+ETSY_HTTP2 = os.environ.get("ETSY_HTTP2", "False") == "True"
+ETSY_HTTP_MAX_CONNECTIONS = int(os.environ.get("ETSY_HTTP_MAX_CONNECTIONS", 20))
+ETSY_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("ETSY_HTTP_MAX_KEEPALIVE_CONNECTIONS", 10))
+ETSY_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("ETSY_HTTP_KEEPALIVE_EXPIRY", 60))
+ETSY_HTTP_TIMEOUT = float(os.environ.get("ETSY_HTTP_TIMEOUT", 60))
+ETSY_HTTP_CONNECT_TIMEOUT = float(os.environ.get("ETSY_HTTP_CONNECT_TIMEOUT", 10))
+
+ETSY_RATE_LIMIT_PER_SECOND = float(os.environ.get("ETSY_RATE_LIMIT_PER_SECOND", 10))
+ETSY_RATE_LIMIT_BURST = int(os.environ.get("ETSY_RATE_LIMIT_BURST", 10))
+ETSY_RATE_LIMIT_DAILY_RESERVE = int(os.environ.get("ETSY_RATE_LIMIT_DAILY_RESERVE", 500))
+
+ETSY_MIN_CONCURRENT = int(os.environ.get("ETSY_MIN_CONCURRENT", 1))
+ETSY_MAX_CONCURRENT = int(os.environ.get("ETSY_MAX_CONCURRENT", 30))
+ETSY_CONCURRENCY_LATENCY_TOLERANCE = float(os.environ.get("ETSY_CONCURRENCY_LATENCY_TOLERANCE", 2.0))
+ETSY_CONCURRENCY_BACKOFF = float(os.environ.get("ETSY_CONCURRENCY_BACKOFF", 0.5))
+
+ETSY_MAX_RETRIES = int(os.environ.get("ETSY_MAX_RETRIES", 4))
+ETSY_RETRY_BACKOFF_BASE = float(os.environ.get("ETSY_RETRY_BACKOFF_BASE", 0.5))
+ETSY_RETRY_BACKOFF_MAX = float(os.environ.get("ETSY_RETRY_BACKOFF_MAX", 30))
+ETSY_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("ETSY_CIRCUIT_FAILURE_THRESHOLD", 8))
+ETSY_CIRCUIT_RESET_TIMEOUT = float(os.environ.get("ETSY_CIRCUIT_RESET_TIMEOUT", 300))
+# Etsy pages bigger than this many bytes are decoded in a worker thread instead of on the event loop
+ETSY_JSON_THREAD_THRESHOLD = int(os.environ.get("ETSY_JSON_THREAD_THRESHOLD", 256 * 1024))
+
+# getShop_Receipt2 accepts a comma separated list of receipt ids
+RECEIPT_BATCH_SIZE = int(os.environ.get("RECEIPT_BATCH_SIZE", 50))
+# Receipts (and their notes) written to MongoDB per bulk_write
+RECEIPT_WRITE_BATCH_SIZE = int(os.environ.get("RECEIPT_WRITE_BATCH_SIZE", 500))
+# A sync lease expires this many ms after its last heartbeat (renewed every third of it)
+SYNC_LEASE_TTL_MS = int(os.environ.get("SYNC_LEASE_TTL_MS", 60000))
+# Receipts still unpaid this many seconds after they were first seen stop being rechecked
+UNPAID_RECEIPT_MAX_AGE = int(os.environ.get("UNPAID_RECEIPT_MAX_AGE", 30 * 24 * 60 * 60))
+# List receipt ids first and fetch the heavy includes only for new or changed receipts
+SYNC_TWO_PHASE = os.environ.get("SYNC_TWO_PHASE", "True") == "True"
+# New receipts are written and checkpointed every this many pages, a failed sync resumes from the last checkpoint
+SYNC_CHECKPOINT_PAGES = int(os.environ.get("SYNC_CHECKPOINT_PAGES", 10))
+# Seconds a checkpoint of a sync that never finished is kept
+SYNC_CHECKPOINT_TTL = int(os.environ.get("SYNC_CHECKPOINT_TTL", 7 * 24 * 60 * 60))
+# A backfill splits the shop's history into time windows of about this many receipts (at most BACKFILL_MAX_WINDOWS)
+BACKFILL_WINDOW_RECEIPTS = int(os.environ.get("BACKFILL_WINDOW_RECEIPTS", 1000))
+BACKFILL_MAX_WINDOWS = int(os.environ.get("BACKFILL_MAX_WINDOWS", 32))
+# Windows of a backfill fetched at once, the Etsy rate limiter still applies to all of them
+BACKFILL_PARALLEL_WINDOWS = int(os.environ.get("BACKFILL_PARALLEL_WINDOWS", 4))
+BACKFILL_JOB_TIMEOUT = int(os.environ.get("BACKFILL_JOB_TIMEOUT", 4 * 60 * 60))
+# getListing accepts comma separated listing ids as well
+LISTING_BATCH_SIZE = int(os.environ.get("LISTING_BATCH_SIZE", 50))
+# Seconds a listing stays in the in-process cache before MongoDB is asked again
+LISTING_CACHE_TTL = int(os.environ.get("LISTING_CACHE_TTL", 900))
+# Seconds the Etsy proxy endpoints answer from the Redis read cache without asking Etsy
+ETSY_CACHE_TTL_RECEIPT = int(os.environ.get("ETSY_CACHE_TTL_RECEIPT", 300))
+ETSY_CACHE_TTL_LISTING = int(os.environ.get("ETSY_CACHE_TTL_LISTING", 3600))
+ETSY_CACHE_TTL_SHIPPING_TEMPLATE = int(os.environ.get("ETSY_CACHE_TTL_SHIPPING_TEMPLATE", 86400))
+ETSY_CACHE_TTL_IMAGE = int(os.environ.get("ETSY_CACHE_TTL_IMAGE", 604800))
+# Seconds an expired entry is still served while it is refreshed in the background
+ETSY_CACHE_STALE_TTL = int(os.environ.get("ETSY_CACHE_STALE_TTL", 86400))
+
 FRONTEND_URI = os.environ.get("FRONTEND_URI")
 JWT_SECRET = os.environ.get("JWT_SECRET")
 MAIL_HOST = os.environ.get("MAIL_HOST")
@@ -29,6 +115,12 @@ MONGODB_URI = os.environ.get("MONGODB_URI")
 REDIS_TLS_URL = os.environ.get("REDIS_TLS_URL")
 print(REDIS_TLS_URL)
 REDIS_URL = os.environ.get("REDIS_URL")
+# Connections per process in the shared Redis pool, callers wait up to REDIS_POOL_TIMEOUT seconds for a free one
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+# Idle pooled connections are PINGed before reuse after this many seconds
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
 ETSY_API_BASE_URI = os.environ.get("ETSY_API_BASE_URI")
 ETSY_API_KEY = os.environ.get("ETSY_API_KEY")
 ETSY_API_SECRET = os.environ.get("ETSY_API_SECRET")
@@ -4,16 +4,22 @@ from typing import Optional, List
 import secrets
 from urllib.parse import urlparse
 
+import aioredis
 import motor.motor_asyncio
-import redis
 from bson import ObjectId
 
 from pydantic import BaseModel, Field, EmailStr, AnyHttpUrl, validator
 from oauth2 import get_password_hash
-from config import MONGODB_URI, REDIS_TLS_URL
+from config import MONGODB_URI, REDIS_TLS_URL, REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, \
+	REDIS_SOCKET_TIMEOUT, REDIS_HEALTH_CHECK_INTERVAL
 
 
 class MyRedis(object):
+	"""
+		asyncio Redis client over TLS. Connections are opened lazily from one
+		blocking pool per process, so the client can be created at import time
+		and used from whichever event loop the process runs.
+	"""
 	_instance = None
 	
 	def __new__(cls, *args, **kwargs):
@@ -21,31 +27,41 @@ class MyRedis(object):
 			print("#===================#")
 			cls._instance = object.__new__(cls)
 			try:
-				print("Connecting to Redis...")
+				print("Creating the Redis connection pool...")
 				redis_connection_url = urlparse(REDIS_TLS_URL)
-				r = redis.Redis(host=redis_connection_url.hostname,
-				                port=redis_connection_url.port,
-				                username=redis_connection_url.username,
-				                password=redis_connection_url.password,
-				                ssl=True,
-				                ssl_cert_reqs=None, decode_responses=True)
-				MyRedis._instance.r = r
-				redis_info = MyRedis._instance.r.info()
-				MyRedis._instance.r.ping()
+				pool = aioredis.BlockingConnectionPool(connection_class=aioredis.SSLConnection,
+				                                       max_connections=REDIS_MAX_CONNECTIONS,
+				                                       timeout=REDIS_POOL_TIMEOUT,
+				                                       host=redis_connection_url.hostname,
+				                                       port=redis_connection_url.port,
+				                                       username=redis_connection_url.username,
+				                                       password=redis_connection_url.password,
+				                                       ssl_cert_reqs=None,
+				                                       socket_timeout=REDIS_SOCKET_TIMEOUT,
+				                                       socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+				                                       health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+				                                       decode_responses=True)
+				MyRedis._instance.r = aioredis.Redis(connection_pool=pool)
 			except Exception as e:
-				print("Error: Redis connection not established {}".format(e))
-			else:
-				print("Redis connection established\nconnected clients: {}\nredis_version: {}".format(
-					redis_info["connected_clients"],
-					redis_info["redis_version"]))
+				print("Error: Redis connection pool not created {}".format(e))
 			print("#===================#")
 		return cls._instance
 	
 	def __init__(self):
-		self.r: redis.Redis = self._instance.r
+		self.r: aioredis.Redis = self._instance.r
+	
+	async def ping(self):
+		try:
+			redis_info = await self.r.info()
+		except Exception as e:
+			print("Error: Redis connection not established {}".format(e))
+		else:
+			print("Redis connection established\nconnected clients: {}\nredis_version: {}".format(
+				redis_info["connected_clients"],
+				redis_info["redis_version"]))
 	
-	def __del__(self):
-		self.r.close()
+	async def close(self):
+		await self.r.connection_pool.disconnect()
 
 
 class MongoDB(object):
@@ -3,13 +3,13 @@ from starlette import status
 from schemas import UserData
 from fastapi import APIRouter, Depends, HTTPException
 from oauth2 import is_authenticated
-from database import MongoDB, MyRedis
+from database import MongoDB
 from bson import ObjectId
 from datetime import datetime
 from database import ReceiptNoteStatus
+from SyncState import SyncState
 
 mongodb = MongoDB()
-r = MyRedis().r
 
 router = APIRouter(
     prefix="/connections_info",
@@ -20,9 +20,8 @@ router = APIRouter(
 
 @router.get('/{etsy_connection_id}')
 async def get_etsy_connection_info(etsy_connection_id: str, user: UserData = Depends(is_authenticated)):
-    last_updated = r.get(f'{etsy_connection_id}:last_updated')
+    last_updated = await SyncState.last_updated_of(etsy_connection_id)
     if last_updated is not None:
-        last_updated = int(last_updated)
         last_updated = datetime.fromtimestamp(last_updated, pytz.timezone('Canada/Eastern'))
     from_etsy_connection = await mongodb.db['EtsyShopConnections'].find_one({'_id': ObjectId(etsy_connection_id)})
     print(from_etsy_connection)
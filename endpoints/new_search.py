@@ -50,7 +50,11 @@ async def new_search(
 		"Note": True
 	}
 	if search_body.item_type is not None:
-		match['Listings.title'] = search_body.item_type
+		listing_ids = await mongodb.db['Listings'].distinct('listing_id', {'title': search_body.item_type})
+		match['$or'] = [
+			{'listing_ids': {'$in': listing_ids}},
+			{'Listings.title': search_body.item_type}
+		]
 	if search_body.receipt_status is not None:
 		match['Note.status'] = search_body.receipt_status
 	if search_body.shop_name is not None:
@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 import pytz
-from typing import List
+from typing import List, Optional
 from MyLogger import Logger
 logging = Logger().logging
 
@@ -19,40 +19,37 @@ def bday(from_date: datetime, n_days: int) -> datetime:
 	return comp_date
 
 
-def find_bigger_max_processing(receipt: dict) -> int:
-	listings = []
-	try:
-		listings: List[dict] = receipt["Listings"]
-	except KeyError:
-		return -1
-	max_pro_day: int = -1
-	for listing in listings:
-		max_pro_day = max(max_pro_day, listing["processing_max"])
-	return max_pro_day
+def find_bigger_max_processing(receipt: dict, listings: Optional[List[dict]] = None) -> Optional[int]:
+	"""None when the receipt has no listings to take the processing days from."""
+	if listings is None:
+		listings = receipt.get("Listings", [])
+	if len(listings) == 0:
+		return None
+	return max(listing["processing_max"] for listing in listings)
 
 
-def find_smaller_min_processing(receipt: dict) -> int:
-	listings = []
-	try:
-		listings: List[dict] = receipt["Listings"]
-	except KeyError:
-		return -1
-	min_pro_day: int = 999
-	for listing in listings:
-		min_pro_day = min(min_pro_day, listing["processing_min"])
-	return min_pro_day
+def find_smaller_min_processing(receipt: dict, listings: Optional[List[dict]] = None) -> Optional[int]:
+	"""None when the receipt has no listings to take the processing days from."""
+	if listings is None:
+		listings = receipt.get("Listings", [])
+	if len(listings) == 0:
+		return None
+	return min(listing["processing_min"] for listing in listings)
 
 
-def calculate_max_min_due_date(receipt: dict) -> None:
+def calculate_max_min_due_date(receipt: dict, listings: Optional[List[dict]] = None) -> None:
+	"""listings are the receipt's listings from the catalog, receipt["Listings"] is used when they are not given."""
 	logging.debug(f"number of transactions: {len(receipt['Transactions'])}")
-	logging.debug(f"number of listings: {len(receipt['Listings'])}")
+	logging.debug(f"number of listings: {len(listings if listings is not None else receipt.get('Listings', []))}")
 	# pprint.pprint(receipt['Transactions'])
 	receipt["is_completed"] = False
 	paid_date = datetime.fromtimestamp(int(receipt["Transactions"][0]["paid_tsz"]), pytz.timezone('Canada/Eastern'))
 	
-	max_pro_n_day: int = find_bigger_max_processing(receipt)
+	max_pro_n_day: Optional[int] = find_bigger_max_processing(receipt, listings)
+	min_pro_n_day: Optional[int] = find_smaller_min_processing(receipt, listings)
+	if max_pro_n_day is None or min_pro_n_day is None:
+		raise ValueError(f"{receipt['receipt_id']} has no listings, its due dates can't be calculated.")
 	max_due_date = bday(paid_date, max_pro_n_day)
-	min_pro_n_day: int = find_smaller_min_processing(receipt)
 	min_due_date = bday(paid_date, min_pro_n_day)
 	receipt["max_due_date"] = max_due_date
 	receipt["min_due_date"] = min_due_date
@@ -15,15 +15,21 @@ import jwt
 from bson.objectid import ObjectId
 from fastapi import FastAPI, Depends, Body, HTTPException, status, BackgroundTasks, Query, UploadFile, File
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from redis import ResponseError
+from aioredis import ResponseError
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 
 from EtsyAPISession import EtsyAPISession
-from EtsyShopManager import syncShop
+from EtsyShopManager import syncShop, sync_mode_for, SyncMode
+from SyncLease import SyncLease
+from SyncQueue import SyncQueue
+from SyncState import SyncState, BackfillProgress
+from AsyncEtsyApi import AsyncEtsy
+from EtsyRateLimiter import EtsyRateLimiter
+from AdaptiveConcurrency import AdaptiveConcurrencyRegistry
 from auth import AuthHandler
 from database import MongoDB, MyRedis, EtsyShopConnection, ReceiptNoteStatus, UpdateEtsyShopConnection, InvitationEmail, User, \
 	ReceiptNote, CreateReceiptNote, UpdateReceiptNote
@@ -31,7 +37,8 @@ from oauth2 import (oauth2_schema,
                     is_authenticated,
                     verify_password)
 from schemas import UserData, ReceiptStatus
-from EtsyAPI import EtsyAPI, create_etsy_api_with_etsy_connection
+from EtsyAPI import AsyncEtsyAPI, create_async_etsy_api_with_etsy_connection
+from EtsyCache import EtsyErrorResponse
 
 from endpoints import assignments
 from endpoints import check_same_address_same_name
@@ -42,14 +49,13 @@ from endpoints import connections_info
 from MySocketManager import MySocketManager as SocketManager
 
 # from MyScheduler import MyScheduler
-from config import ENV_MODE, FRONTEND_URI, JWT_SECRET, SCHEDULED_JOB_INTERVAL, SCHEDULED_JOB_OFFSET
+from config import ENV_MODE, FRONTEND_URI, JWT_SECRET, SCHEDULED_JOB_INTERVAL, SCHEDULED_JOB_OFFSET, SYNC_USE_WORKERS
 import tempfile
 from MyLogger import Logger
 logging = Logger().logging
 logging.info("Logging singleton test message.")
 
 mongodb = MongoDB()
-r = MyRedis().r
 # myScheduler = MyScheduler()
 
 context = ssl.create_default_context()
@@ -108,7 +114,7 @@ async def on_user_connected(sid, data, *args, **kwargs):
 
 @app.on_event("startup")
 async def startup_event():
-	...
+	await MyRedis().ping()
 	# logging.info("FastAPI startup_event")
 	# etsy_connections = await mongodb.db["EtsyShopConnections"].find().to_list(100)
 	# job_offset = 0
@@ -139,8 +145,9 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+	await AsyncEtsy.close_all_clients()
 	await mongodb.client.close()
-	r.close()
+	await MyRedis().close()
 
 
 app.include_router(assignments.router)
@@ -150,6 +157,12 @@ app.include_router(shipments.router)
 app.include_router(connections_info.router)
 
 
+@app.exception_handler(EtsyErrorResponse)
+async def etsy_error_response_handler(request: Request, exc: EtsyErrorResponse):
+	# Etsy's own status and body, e.g. a 404 "Listing not found" or an oauth_problem string.
+	return Response(status_code=exc.status_code, content=exc.text, media_type=exc.content_type)
+
+
 @app.get("/")
 async def root():
 	# myScheduler.scheduler.print_jobs()
@@ -602,17 +615,22 @@ async def search(request: Request,
 
 
 @app.get("/async_etsy/sync/{etsy_connection_id}")
-async def sync(etsy_connection_id: str, background_tasks: BackgroundTasks, user: UserData = Depends(is_authenticated)):
-	is_running = r.get(f"{etsy_connection_id}:is_running")
-	if is_running == "True":
+async def sync(etsy_connection_id: str, background_tasks: BackgroundTasks, mode: SyncMode = SyncMode.created,
+               user: UserData = Depends(is_authenticated)):
+	if SYNC_USE_WORKERS:
+		job_id = await SyncQueue().enqueue(etsy_connection_id, mode)
+		return {
+			"background-task": "queued",
+			"job_id": job_id
+		}
+	if await SyncLease.is_held(etsy_connection_id):
 		return {
 			"background-task": "already running"
 		}
 	background_tasks.add_task(
 		func=syncShop,
 		etsy_connection_id=etsy_connection_id,
-		db=mongodb.db,
-		r=r
+		mode=await sync_mode_for(etsy_connection_id, mode)
 	)
 	
 	return {
@@ -620,32 +638,68 @@ async def sync(etsy_connection_id: str, background_tasks: BackgroundTasks, user:
 	}
 
 
+@app.get("/async_etsy/sync_job/{job_id}")
+async def get_sync_job(job_id: str, user: UserData = Depends(is_authenticated)):
+	job = await SyncQueue.job_status(job_id)
+	if job is None:
+		raise HTTPException(status_code=404, detail=f"Sync job {job_id} not found or expired")
+	return job
+
+
+@app.get("/async_etsy/backfill/{etsy_connection_id}")
+async def get_backfill_progress(etsy_connection_id: str, user: UserData = Depends(is_authenticated)):
+	progress = await BackfillProgress(etsy_connection_id).load()
+	if progress is None:
+		raise HTTPException(status_code=404, detail=f"No backfill found for {etsy_connection_id}")
+	return progress
+
+
+@app.get("/async_etsy/rate_limit/{etsy_connection_id}")
+async def get_rate_limit_metrics(etsy_connection_id: str, user: UserData = Depends(is_authenticated)):
+	etsy_connection = await mongodb.db["EtsyShopConnections"].find_one({"_id": ObjectId(etsy_connection_id)})
+	if etsy_connection is None:
+		raise HTTPException(status_code=404, detail=f"EtsyShopConnection {etsy_connection_id} not found")
+	return {
+		**(await EtsyRateLimiter(etsy_connection["app_key"]).metrics()),
+		"concurrency": AdaptiveConcurrencyRegistry().metrics(etsy_connection_id)
+	}
+
+
+@app.get("/async_etsy/sync_schedule/{etsy_connection_id}")
+async def get_sync_schedule(etsy_connection_id: str, user: UserData = Depends(is_authenticated)):
+	# Saved by the sync supervisor in clock.py each time it schedules the shop's next poll.
+	schedule = await SyncState.polling_schedule_of(etsy_connection_id)
+	if schedule is None:
+		raise HTTPException(status_code=404, detail=f"{etsy_connection_id} wasn't polled by the sync supervisor yet")
+	return schedule
+
+
 @app.get('/receipts/{etsy_connection_id}/{receipt_id}')
 async def get_receipt_by_id(etsy_connection_id: str, receipt_id: str, user: UserData = Depends(is_authenticated)):
-	etsy_api = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
+	etsy_api = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
 	# shop_id = etsy_connection["etsy_shop_id"]
-	receipt = etsy_api.getShop_Receipt2(receipt_id)
+	receipt = await etsy_api.getShop_Receipt2(receipt_id)
 	print(receipt)
 	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=receipt)
 
 
 @app.get('/listings/{etsy_connection_id}/{listing_id}')
 async def get_listing(etsy_connection_id: str, listing_id: int):
-	etsy_api = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
-	etsy_api.getListing(listing_id)
+	etsy_api = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
+	return await etsy_api.getListing(listing_id)
 
 
 @app.get('/shipping/templates/{etsy_connection_id}/{shipping_template_id}')
 async def get_shipping_template(etsy_connection_id: str, shipping_template_id: int):
-	etsy_api = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
-	etsy_api.getShippingTemplate(shipping_template_id)
+	etsy_api = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
+	return await etsy_api.getShippingTemplate(shipping_template_id)
 
 
 @app.get("/shops/{etsy_connection_id}/receipts/{status}/")
 async def get_receipts_by_status(etsy_connection_id: str, status: ReceiptStatus):
-	(etsy_connection, etsy_api) = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
+	(etsy_connection, etsy_api) = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
 	shop_id = etsy_connection["etsy_shop_id"]
-	etsy_api.findAllShopReceiptsByStatus(shop_id, status)
+	return await etsy_api.findAllShopReceiptsByStatus(shop_id, status)
 
 
 @app.get("/receipts/{etsy_connection_id}")
@@ -663,41 +717,41 @@ async def get_all_receipts_by_etsy_connection(etsy_connection_id: str,
 	# 								client_key=etsy_connection["app_key"],
 	# 								client_secret=etsy_connection["app_secret"])
 	# etsy_api = EtsyAPI(etsy_api_session.get_etsy_api_session())
-	(etsy_connection, etsy_api) = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
+	(etsy_connection, etsy_api) = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
 	shop_id = etsy_connection["etsy_shop_id"]
-	all_receipts = etsy_api.findAllShopReceipts(shop_id,
-	                                            min_created=min_created,
-	                                            max_created=max_created,
-	                                            min_last_modified=min_last_modified,
-	                                            max_last_modified=max_last_modified,
-	                                            was_paid=was_paid,
-	                                            was_shipped=was_shipped)
+	all_receipts = await etsy_api.findAllShopReceipts(shop_id,
+	                                                  min_created=min_created,
+	                                                  max_created=max_created,
+	                                                  min_last_modified=min_last_modified,
+	                                                  max_last_modified=max_last_modified,
+	                                                  was_paid=was_paid,
+	                                                  was_shipped=was_shipped)
 	# pprint.pprint(all_receipts)
 	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=all_receipts)
 
 
 @app.get('/search/{etsy_connection_id}')
 async def searchTest(etsy_connection_id: str):
-	(etsy_connection, etsy_api) = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
+	(etsy_connection, etsy_api) = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id)
 	shop_id = etsy_connection["etsy_shop_id"]
-	res = etsy_api.searchAllShopReceipts(shop_id)
+	res = await etsy_api.searchAllShopReceipts(shop_id)
 	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=res)
 
 
 @app.get('/transactions/{receipt_id}/{etsy_connection_id}')
 async def get_all_transactions_by_receipt_id(receipt_id: str, etsy_connection_id: str,
                                              user: UserData = Depends(is_authenticated)):
-	etsy_api = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
-	all_transactions_by_receipt_id = etsy_api.findAllShop_Receipt2Transactions(receipt_id)
+	etsy_api = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
+	all_transactions_by_receipt_id = await etsy_api.findAllShop_Receipt2Transactions(receipt_id)
 	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=all_transactions_by_receipt_id)
 
 
 @app.get('/images/{listing_id}/{listing_image_id}/{etsy_connection_id}')
 async def get_image_of_transaction(listing_id: str, listing_image_id: str, etsy_connection_id: str,
                                    user: UserData = Depends(is_authenticated)):
-	etsy_api = await create_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
-	images = etsy_api.getImage_Listing(listing_id, listing_image_id)
-	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=images.json())
+	etsy_api = await create_async_etsy_api_with_etsy_connection(mongodb.db, etsy_connection_id, 1)
+	images = await etsy_api.getImage_Listing(listing_id, listing_image_id)
+	return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=images)
 
 
 class ConnectEtsyAppDetails(BaseModel):
@@ -708,7 +762,7 @@ class ConnectEtsyAppDetails(BaseModel):
 @app.post("/connect/etsy")
 async def connect_etsy_shop(app_details: ConnectEtsyAppDetails = Body(...), user: UserData = Depends(is_authenticated)):
 	print(app_details)
-	request_token_dict: dict = EtsyAPISession.get_request_token(app_details.app_key, app_details.app_secret)
+	request_token_dict: dict = await EtsyAPISession.async_get_request_token(app_details.app_key, app_details.app_secret)
 	app_details = jsonable_encoder(app_details)
 	app_details["created_at"] = datetime.utcnow()
 	new_etsy_connection = await mongodb.db["EtsyShopConnections"].insert_one({
@@ -733,13 +787,13 @@ class VerifyEtsyConnection(BaseModel):
 
 
 @app.put("/verify/etsy")
-async def verify_request_tokens(verify_body: VerifyEtsyConnection = Body(...),
+async def verify_request_tokens(background_tasks: BackgroundTasks, verify_body: VerifyEtsyConnection = Body(...),
                                 user: UserData = Depends(is_authenticated)):
 	etsy_connection_id: ObjectId = ObjectId(verify_body.etsy_connection_id)
 	etsy_connection = await mongodb.db["EtsyShopConnections"].find_one({"_id": etsy_connection_id})
 	if etsy_connection is None or etsy_connection["verified"]:
 		raise HTTPException(status_code=400, detail="Etsy connection id not found or it has already been connected.")
-	access_token_dict: dict = EtsyAPISession.get_access_token(
+	access_token_dict: dict = await EtsyAPISession.async_get_access_token(
 		resource_owner_key=verify_body.temp_oauth_token,
 		resource_owner_secret=etsy_connection['request_temporary_oauth_token_secret'],
 		verifier=verify_body.oauth_verifier.split("#")[0],
@@ -758,12 +812,13 @@ async def verify_request_tokens(verify_body: VerifyEtsyConnection = Body(...),
 		}
 	})
 	if update_etsy_connection_result.modified_count == 1:
-		etsy_api_session = EtsyAPISession(access_token_dict["oauth_token"],
+		etsy_api = AsyncEtsyAPI(AsyncEtsy(etsy_connection["app_key"],
+		                                  etsy_connection["app_secret"],
+		                                  access_token_dict["oauth_token"],
 		                                  access_token_dict["oauth_token_secret"],
-		                                  client_key=etsy_connection["app_key"],
-		                                  client_secret=etsy_connection["app_secret"])
-		etsy_api = EtsyAPI(etsy_api_session.get_etsy_api_session())
-		all_shops = etsy_api.findAllUserShops()
+		                                  "__SELF__",
+		                                  verify_body.etsy_connection_id))
+		all_shops = await etsy_api.findAllUserShops()
 		shop_id = None
 		shop_name = None
 		shop_url = None
@@ -776,7 +831,7 @@ async def verify_request_tokens(verify_body: VerifyEtsyConnection = Body(...),
 			shop_url = all_shops_json['results'][0]['url']
 			shop_banner_url = all_shops_json['results'][0]['image_url_760x100']
 			shop_icon_url = all_shops_json['results'][0]['icon_url_fullxfull']
-		user = etsy_api.getUser()
+		user = await etsy_api.getUser()
 		etsy_owner_email = None
 		if user.json()['count'] != 0:
 			etsy_owner_email = user.json()['results'][0]['primary_email']
@@ -795,6 +850,12 @@ async def verify_request_tokens(verify_body: VerifyEtsyConnection = Body(...),
 			})
 		if update_etsy_connection_shop_details_result.modified_count == 1:
 			if shop_id is not None and shop_name is not None:
+				# Imports the shop's history right away instead of waiting for the supervisor.
+				if SYNC_USE_WORKERS:
+					await SyncQueue().enqueue(verify_body.etsy_connection_id, SyncMode.backfill)
+				else:
+					background_tasks.add_task(func=syncShop, etsy_connection_id=verify_body.etsy_connection_id,
+					                          mode=SyncMode.backfill)
 				return JSONResponse(
 					status_code=status.HTTP_200_OK, 
 					content={
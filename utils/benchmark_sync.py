@@ -0,0 +1,206 @@
+"""
+Benchmarks the Etsy sync paths and the Stallion label lookups against utils/fake_apis.py.
+
+    uvicorn utils.fake_apis:app --port 8010
+    python utils/benchmark_sync.py --base-url http://127.0.0.1:8010 --runs 3
+
+Only the Etsy/Stallion side is measured: MongoDB and the sync's Redis writes are
+stubbed out by dry_run(), the Etsy rate limiter still needs Redis.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+p = os.path.abspath('.')
+sys.path.insert(1, p)
+
+import httpx
+
+import AsyncEtsyApi
+import EtsyShopManager
+import LabelProvider
+import ListingCatalog
+from AsyncEtsyApi import AsyncEtsy, Method, EtsyUrl
+from AdaptiveConcurrency import AdaptiveConcurrencyRegistry
+from EtsyCache import EtsyReadCache
+from EtsyShopManager import MyEtsyShopManager, SyncMode, RECEIPT_INCLUDES, LIGHT_RECEIPT_FIELDS
+from ListingCatalog import ListingCache
+from SyncState import SyncState
+from SyncTelemetry import SyncTelemetry
+
+
+def point_at(base_url: str):
+    # config reads the base urls once from the environment (.env overrides it), patch the modules instead.
+    AsyncEtsyApi.ETSY_API_BASE_URI = f"{base_url}/etsy/v2"
+    LabelProvider.STALLION_API_BASE_URL = f"{base_url}/stallion"
+
+
+class DryRunCursor:
+    """Nothing is stored in a dry run."""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    async def to_list(self, length=None) -> list:
+        return []
+
+
+class DryRunCollection:
+    def find(self, *args, **kwargs) -> DryRunCursor:
+        return DryRunCursor()
+
+    async def bulk_write(self, requests, ordered=True):
+        return None
+
+
+class DryRunDb(dict):
+    def __missing__(self, name: str) -> DryRunCollection:
+        return DryRunCollection()
+
+
+class DryRunMongoDB:
+    db = DryRunDb()
+
+
+def dry_run():
+    """Stubs the MongoDB and Redis writes of the sync, every listed receipt looks new."""
+    async def upsert_receipts(self, receipts, db):
+        return {"inserted": len(receipts)}
+
+    async def nothing(*args, **kwargs):
+        return None
+
+    EtsyShopManager.MongoDB = DryRunMongoDB
+    ListingCatalog.MongoDB = DryRunMongoDB
+    MyEtsyShopManager.upsert_receipts = upsert_receipts
+    SyncState.save_checkpoint = nothing
+    SyncState.add_unpaid = nothing
+    EtsyReadCache.invalidate = nothing
+
+
+async def fake_stats(base_url: str, reset: bool = False) -> dict:
+    async with httpx.AsyncClient() as client:
+        if reset:
+            return (await client.post(f"{base_url}/fake/reset")).json()
+        return (await client.get(f"{base_url}/fake/stats")).json()
+
+
+async def timed(name: str, coroutine) -> dict:
+    started_at = time.perf_counter()
+    result = await coroutine
+    return {"name": name, "seconds": time.perf_counter() - started_at, **result}
+
+
+async def list_receipts(asyncEtsyApi: AsyncEtsy, params: dict) -> dict:
+    pages = receipts = failed = 0
+    async for outcome in asyncEtsyApi.iter_pages(
+        Method.get, EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id), params
+    ):
+        pages += 1
+        if not outcome.ok:
+            failed += 1
+            continue
+        receipts += len(outcome.results)
+    return {"pages": pages, "failed_pages": failed, "receipts": receipts}
+
+
+async def new_orders(asyncEtsyApi: AsyncEtsy) -> dict:
+    """The real import_new_orders over the whole shop, under dry_run() nothing is stored."""
+    ListingCache().listings.clear()
+    telemetry = SyncTelemetry(asyncEtsyApi.etsy_connection_id, SyncMode.created)
+    checkpoint = {"min_created": "", "max_created": int(time.time()), "pages_done": 0}
+    not_paid, is_complete = await MyEtsyShopManager(asyncEtsyApi.shop_id).import_new_orders(
+        asyncEtsyApi,
+        {"includes": RECEIPT_INCLUDES, "max_created": checkpoint["max_created"]},
+        checkpoint,
+        SyncState(asyncEtsyApi.etsy_connection_id),
+        telemetry,
+    )
+    return {
+        "pages": checkpoint["pages_done"],
+        "not_paid": len(not_paid),
+        "complete": is_complete,
+        **telemetry.record["counts"],
+    }
+
+
+async def recheck_receipts(asyncEtsyApi: AsyncEtsy, n_receipts: int) -> dict:
+    receipt_ids = []
+    pages = asyncEtsyApi.iter_pages(
+        Method.get, EtsyUrl.findAllShopReceipts(asyncEtsyApi.shop_id), {"fields": "receipt_id"}
+    )
+    try:
+        async for outcome in pages:
+            receipt_ids.extend(receipt["receipt_id"] for receipt in outcome.results)
+            if len(receipt_ids) >= n_receipts:
+                break
+    finally:
+        await pages.aclose()
+    batches = await MyEtsyShopManager.fetch_receipts_by_ids(
+        asyncEtsyApi, receipt_ids[:n_receipts], {"includes": RECEIPT_INCLUDES}
+    )
+    outcomes = [outcome for _, batch_outcomes in batches for outcome in batch_outcomes]
+    return {
+        "batches": len(batches),
+        "receipts": sum(len(outcome.results) for outcome in outcomes),
+        "failed_pages": sum(1 for outcome in outcomes if not outcome.ok),
+    }
+
+
+async def labels(n_orders: int) -> dict:
+    stallion_api = LabelProvider.StallionAPI(api_token="fake")
+
+    async def label(order_id: int):
+        track = await stallion_api.get_status_by_order_id(order_id=order_id)
+        return await stallion_api.get_shipment(track["details"]["ship_code"])
+
+    shipments = await asyncio.gather(*(label(2000000000 + i) for i in range(n_orders)), return_exceptions=True)
+    return {"labels": sum(1 for shipment in shipments if isinstance(shipment, dict))}
+
+
+async def run(args) -> list:
+    asyncEtsyApi = AsyncEtsy("fake", "fake", "fake", "fake", args.shop, f"benchmark:{args.shop}")
+    results = [
+        await timed("list receipts (light)", list_receipts(asyncEtsyApi, {"fields": LIGHT_RECEIPT_FIELDS})),
+        await timed("list receipts (includes)", list_receipts(asyncEtsyApi, {"includes": RECEIPT_INCLUDES})),
+        await timed("import_new_orders (dry run)", new_orders(asyncEtsyApi)),
+        await timed(f"recheck {args.recheck} receipts by id", recheck_receipts(asyncEtsyApi, args.recheck)),
+        await timed(f"{args.labels} Stallion labels", labels(args.labels)),
+    ]
+    return results
+
+
+async def main(args):
+    point_at(args.base_url)
+    dry_run()
+    runs = []
+    for i in range(args.runs):
+        await fake_stats(args.base_url, reset=True)
+        runs.append(await run(args))
+        print(f"run #{i + 1}: {json.dumps(await fake_stats(args.base_url))}")
+    print()
+    print(f"{'benchmark':<36}{'median s':>10}{'min s':>10}{'max s':>10}  last run")
+    for i, result in enumerate(runs[-1]):
+        seconds = [run_results[i]["seconds"] for run_results in runs]
+        details = {k: v for k, v in result.items() if k not in ("name", "seconds")}
+        print(f"{result['name']:<36}{statistics.median(seconds):>10.3f}{min(seconds):>10.3f}{max(seconds):>10.3f}  {details}")
+    print()
+    print(f"concurrency: {json.dumps(AdaptiveConcurrencyRegistry().metrics(f'benchmark:{args.shop}'))}")
+    await AsyncEtsy.close_all_clients()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8010")
+    parser.add_argument("--shop", default="FakeShop")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--recheck", type=int, default=200, help="receipts fetched by id, like check_unpaids")
+    parser.add_argument("--labels", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,506 @@
+"""
+Local stand-in for the Etsy v2 and Stallion Express APIs, for load testing and
+benchmarking the sync without touching the real services.
+
+    uvicorn utils.fake_apis:app --port 8010
+
+then point the backend at it (e.g. in .env):
+
+    ETSY_API_BASE_URI=http://127.0.0.1:8010/etsy/v2
+    STALLION_API_BASE_URL=http://127.0.0.1:8010/stallion
+
+FAKE_API_MODE selects where the responses come from:
+    synthetic  generated receipts, transactions and listings (default)
+    record     forwards to the real APIs and writes every response to FAKE_API_CASSETTE_DIR
+    replay     answers only from FAKE_API_CASSETTE_DIR, 404 for requests that were never recorded
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+from authlib.integrations.httpx_client import AsyncOAuth1Client
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from httpx import AsyncClient
+
+FAKE_API_MODE = os.environ.get("FAKE_API_MODE", "synthetic")
+FAKE_API_CASSETTE_DIR = os.environ.get("FAKE_API_CASSETTE_DIR", "fake_api_cassettes")
+FAKE_API_SEED = int(os.environ.get("FAKE_API_SEED", 42))
+FAKE_API_RECEIPTS = int(os.environ.get("FAKE_API_RECEIPTS", 2000))
+FAKE_API_LISTINGS = int(os.environ.get("FAKE_API_LISTINGS", 150))
+FAKE_API_UNPAID_RATIO = float(os.environ.get("FAKE_API_UNPAID_RATIO", 0.02))
+FAKE_API_HISTORY_DAYS = int(os.environ.get("FAKE_API_HISTORY_DAYS", 30))
+# Injected latency (ms) is FAKE_API_LATENCY_MS +/- FAKE_API_LATENCY_JITTER_MS, plus per result for big pages
+FAKE_API_LATENCY_MS = float(os.environ.get("FAKE_API_LATENCY_MS", 150))
+FAKE_API_LATENCY_JITTER_MS = float(os.environ.get("FAKE_API_LATENCY_JITTER_MS", 50))
+FAKE_API_LATENCY_PER_RESULT_MS = float(os.environ.get("FAKE_API_LATENCY_PER_RESULT_MS", 1))
+# Share of requests answered with 503, and requests per second above which 429 is returned
+FAKE_API_ERROR_RATE = float(os.environ.get("FAKE_API_ERROR_RATE", 0))
+FAKE_API_RATE_PER_SECOND = float(os.environ.get("FAKE_API_RATE_PER_SECOND", 10))
+FAKE_API_DAILY_LIMIT = int(os.environ.get("FAKE_API_DAILY_LIMIT", 10000))
+# Upstreams and credentials used in record mode, the fake server re-signs Etsy requests itself
+FAKE_API_ETSY_UPSTREAM = os.environ.get("FAKE_API_ETSY_UPSTREAM", "https://openapi.etsy.com/v2")
+FAKE_API_STALLION_UPSTREAM = os.environ.get("FAKE_API_STALLION_UPSTREAM", "https://ship.stallionexpress.ca/api/v3")
+FAKE_API_ETSY_APP_KEY = os.environ.get("FAKE_API_ETSY_APP_KEY")
+FAKE_API_ETSY_APP_SECRET = os.environ.get("FAKE_API_ETSY_APP_SECRET")
+FAKE_API_ETSY_OAUTH_TOKEN = os.environ.get("FAKE_API_ETSY_OAUTH_TOKEN")
+FAKE_API_ETSY_OAUTH_TOKEN_SECRET = os.environ.get("FAKE_API_ETSY_OAUTH_TOKEN_SECRET")
+
+# Query parameters that change on every request and must not be part of a cassette key
+VOLATILE_PARAMS = {"oauth_consumer_key", "oauth_nonce", "oauth_signature", "oauth_signature_method",
+                   "oauth_timestamp", "oauth_token", "oauth_version", "api_key"}
+
+app = FastAPI(title="Fake Etsy & Stallion APIs")
+
+
+class FakeShop:
+    """Deterministic receipts, transactions and listings for one shop."""
+
+    def __init__(self, shop_id: str, seed: int = FAKE_API_SEED):
+        rnd = random.Random(f"{seed}:{shop_id}")
+        now = int(time.time())
+        self.shop_id = shop_id
+        self.shipping_templates: Dict[int, dict] = {}
+        self.listings: Dict[int, dict] = {}
+        for i in range(FAKE_API_LISTINGS):
+            listing_id = 900000000 + rnd.randint(0, 99999999)
+            shipping_template_id = 100000 + i % 5
+            processing_min = rnd.randint(1, 5)
+            self.shipping_templates[shipping_template_id] = {
+                "shipping_template_id": shipping_template_id,
+                "title": f"Shipping profile {i % 5}",
+                "min_processing_days": processing_min,
+                "max_processing_days": processing_min + 2,
+            }
+            self.listings[listing_id] = {
+                "listing_id": listing_id,
+                "state": "active" if rnd.random() > 0.1 else "sold_out",
+                "title": f"Item type {i % 12} #{i}",
+                "price": f"{rnd.randint(10, 150)}.00",
+                "quantity": rnd.randint(0, 50),
+                "processing_min": processing_min,
+                "processing_max": processing_min + rnd.randint(0, 5),
+                "shipping_template_id": shipping_template_id,
+                "creation_tsz": now - FAKE_API_HISTORY_DAYS * 86400 - rnd.randint(0, 86400 * 365),
+                "last_modified_tsz": now - rnd.randint(0, FAKE_API_HISTORY_DAYS * 86400),
+            }
+        listing_ids = list(self.listings.keys())
+        self.receipts: Dict[int, dict] = {}
+        self.transactions: Dict[int, List[dict]] = {}
+        for i in range(FAKE_API_RECEIPTS):
+            receipt_id = 2000000000 + i * 7
+            creation_tsz = now - int(FAKE_API_HISTORY_DAYS * 86400 * (1 - i / FAKE_API_RECEIPTS))
+            was_paid = rnd.random() > FAKE_API_UNPAID_RATIO
+            self.receipts[receipt_id] = {
+                "receipt_id": receipt_id,
+                "order_id": receipt_id + 1,
+                "seller_user_id": 1,
+                "buyer_user_id": rnd.randint(1000, 999999),
+                "name": f"Buyer {rnd.randint(1, 5000)}",
+                "first_line": f"{rnd.randint(1, 9999)} Main St",
+                "city": "Toronto",
+                "zip": "M5V 2T6",
+                "country_id": 79,
+                "was_paid": was_paid,
+                "was_shipped": False,
+                "grandtotal": f"{rnd.randint(10, 300)}.00",
+                "creation_tsz": creation_tsz,
+                "last_modified_tsz": creation_tsz + rnd.randint(0, 3600),
+            }
+            self.transactions[receipt_id] = []
+            for j in range(rnd.choice((1, 1, 1, 2, 3))):
+                listing_id = rnd.choice(listing_ids)
+                self.transactions[receipt_id].append({
+                    "transaction_id": receipt_id * 10 + j,
+                    "receipt_id": receipt_id,
+                    "listing_id": listing_id,
+                    "title": self.listings[listing_id]["title"],
+                    "quantity": rnd.randint(1, 3),
+                    "price": self.listings[listing_id]["price"],
+                    "paid_tsz": creation_tsz + 60 if was_paid else None,
+                    "shipped_tsz": None,
+                    "creation_tsz": creation_tsz,
+                    "image_listing_id": listing_id * 10,
+                })
+
+    def receipt(self, receipt_id: int, includes: List[str]) -> dict:
+        receipt = dict(self.receipts[receipt_id])
+        if "Transactions" in includes:
+            receipt["Transactions"] = [dict(transaction) for transaction in self.transactions[receipt_id]]
+            if "Transactions/MainImage" in includes:
+                for transaction in receipt["Transactions"]:
+                    transaction["MainImage"] = self.image(transaction["listing_id"], transaction["image_listing_id"])
+        if "Listings" in includes:
+            listing_ids = dict.fromkeys(transaction["listing_id"] for transaction in self.transactions[receipt_id])
+            receipt["Listings"] = [self.listing(listing_id, includes) for listing_id in listing_ids]
+        return receipt
+
+    def listing(self, listing_id: int, includes: List[str]) -> dict:
+        listing = dict(self.listings[listing_id])
+        if "Listings/ShippingTemplate" in includes or "ShippingTemplate" in includes:
+            listing["ShippingTemplate"] = self.shipping_templates[listing["shipping_template_id"]]
+        return listing
+
+    @staticmethod
+    def image(listing_id: int, listing_image_id: int) -> dict:
+        return {
+            "listing_image_id": listing_image_id,
+            "listing_id": listing_id,
+            "url_75x75": f"https://i.etsystatic.com/fake/{listing_image_id}/il_75x75.jpg",
+            "url_570xN": f"https://i.etsystatic.com/fake/{listing_image_id}/il_570xN.jpg",
+            "url_fullxfull": f"https://i.etsystatic.com/fake/{listing_image_id}/il_fullxfull.jpg",
+        }
+
+
+class FakeEtsyLimits:
+    """Per-second and daily request budget, reported with Etsy's X-RateLimit-* headers."""
+
+    def __init__(self):
+        self.window_started = time.monotonic()
+        self.window_count = 0
+        self.remaining = FAKE_API_DAILY_LIMIT
+
+    def take(self) -> Optional[float]:
+        """Counts a request, returns Retry-After seconds when it is over the limit."""
+        now = time.monotonic()
+        if now - self.window_started >= 1:
+            self.window_started = now
+            self.window_count = 0
+        self.window_count += 1
+        if self.window_count > FAKE_API_RATE_PER_SECOND or self.remaining <= 0:
+            return max(0.0, 1 - (now - self.window_started))
+        self.remaining -= 1
+        return None
+
+    def headers(self) -> dict:
+        return {"X-RateLimit-Limit": str(FAKE_API_DAILY_LIMIT), "X-RateLimit-Remaining": str(self.remaining)}
+
+
+shops: Dict[str, FakeShop] = {}
+etsy_limits = FakeEtsyLimits()
+stats = {"requests": 0, "throttled": 0, "errors": 0, "replayed": 0, "recorded": 0, "missing": 0}
+
+
+def get_shop(shop_id: str) -> FakeShop:
+    try:
+        return shops[shop_id]
+    except KeyError:
+        shops[shop_id] = FakeShop(shop_id)
+        return shops[shop_id]
+
+
+def find_shop_of_receipt(receipt_id: int) -> Optional[FakeShop]:
+    for shop in shops.values():
+        if receipt_id in shop.receipts:
+            return shop
+    return None
+
+
+def find_shop_of_listing(listing_id: int) -> Optional[FakeShop]:
+    for shop in shops.values():
+        if listing_id in shop.listings:
+            return shop
+    return None
+
+
+def only_fields(result: dict, fields: Optional[str]) -> dict:
+    if fields is None:
+        return result
+    wanted = set(fields.split(","))
+    return {k: v for k, v in result.items() if k in wanted or k[0].isupper()}
+
+
+def etsy_page(request: Request, results: List[dict], result_type: str) -> dict:
+    params = dict(request.query_params)
+    limit = min(int(params.get("limit", 25)), 100)
+    if "page" in params:
+        page = max(1, int(params["page"]))
+        offset = (page - 1) * limit
+    else:
+        offset = int(params.get("offset", 0))
+        page = offset // limit + 1
+    has_next = offset + limit < len(results)
+    return {
+        "count": len(results),
+        "results": [only_fields(result, params.get("fields")) for result in results[offset:offset + limit]],
+        "params": params,
+        "type": result_type,
+        "pagination": {
+            "effective_limit": limit,
+            "effective_offset": offset,
+            "next_offset": offset + limit if has_next else None,
+            "effective_page": page,
+            "next_page": page + 1 if has_next else None,
+        },
+    }
+
+
+def in_range(value: int, params: dict, low: str, high: str) -> bool:
+    return (low not in params or value >= int(params[low])) and (high not in params or value <= int(params[high]))
+
+
+def includes_of(request: Request) -> List[str]:
+    includes = request.query_params.get("includes")
+    if includes is None:
+        return []
+    expanded = []
+    for include in includes.split(","):
+        expanded.append(include)
+        if "/" in include:
+            expanded.append(include.split("/")[0])
+    return expanded
+
+
+def ids_of(id_s: str) -> List[int]:
+    return [int(i) for i in id_s.split(",") if i != ""]
+
+
+async def inject_latency(n_results: int = 0):
+    delay = FAKE_API_LATENCY_MS + random.uniform(-FAKE_API_LATENCY_JITTER_MS, FAKE_API_LATENCY_JITTER_MS)
+    delay += n_results * FAKE_API_LATENCY_PER_RESULT_MS
+    await asyncio.sleep(max(0.0, delay) / 1000)
+
+
+async def etsy_response(body: dict) -> JSONResponse:
+    stats["requests"] += 1
+    retry_after = etsy_limits.take()
+    if retry_after is not None:
+        stats["throttled"] += 1
+        return JSONResponse(status_code=429, content="You have exceeded your quota of requests",
+                            headers={**etsy_limits.headers(), "Retry-After": str(round(retry_after, 3))})
+    await inject_latency(len(body.get("results", [])))
+    if random.random() < FAKE_API_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse(status_code=503, content="Service temporarily unavailable", headers=etsy_limits.headers())
+    return JSONResponse(content=body, headers=etsy_limits.headers())
+
+
+def not_found(detail: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content=detail, headers={"X-Error-Detail": detail})
+
+
+# ------------------------------------------------------------------ record / replay
+
+
+def cassette_path(service: str, request: Request, body: bytes) -> str:
+    params = sorted((k, v) for k, v in request.query_params.multi_items() if k not in VOLATILE_PARAMS)
+    key = hashlib.sha1(json.dumps([request.method, request.url.path, params, body.decode("utf-8", "replace")])
+                       .encode()).hexdigest()
+    return os.path.join(FAKE_API_CASSETTE_DIR, service, f"{key}.json")
+
+
+async def forward(service: str, path: str, request: Request, body: bytes):
+    params = [(k, v) for k, v in request.query_params.multi_items() if k not in VOLATILE_PARAMS]
+    if service == "etsy":
+        client = AsyncOAuth1Client(FAKE_API_ETSY_APP_KEY, FAKE_API_ETSY_APP_SECRET,
+                                   FAKE_API_ETSY_OAUTH_TOKEN, FAKE_API_ETSY_OAUTH_TOKEN_SECRET)
+        url = f"{FAKE_API_ETSY_UPSTREAM}/{path}"
+        headers = {}
+    else:
+        client = AsyncClient()
+        url = f"{FAKE_API_STALLION_UPSTREAM}/{path}"
+        headers = {k: v for k, v in request.headers.items() if k.lower() in ("authorization", "accept", "content-type")}
+    async with client:
+        return await client.request(request.method, url, params=params, content=body or None, headers=headers)
+
+
+async def record_or_replay(service: str, path: str, request: Request) -> JSONResponse:
+    body = await request.body()
+    cassette = cassette_path(service, request, body)
+    if FAKE_API_MODE == "replay":
+        try:
+            with open(cassette) as f:
+                recorded = json.load(f)
+        except FileNotFoundError:
+            stats["missing"] += 1
+            return not_found(f"No recording for {request.method} {request.url.path}")
+        stats["replayed"] += 1
+        await inject_latency()
+        return JSONResponse(status_code=recorded["status_code"], content=recorded["body"], headers=recorded["headers"])
+    res = await forward(service, path, request, body)
+    try:
+        content = res.json()
+    except ValueError:
+        content = res.text
+    headers = {k: v for k, v in res.headers.items() if k.lower().startswith("x-ratelimit") or k.lower() == "retry-after"}
+    os.makedirs(os.path.dirname(cassette), exist_ok=True)
+    with open(cassette, "w") as f:
+        json.dump({"method": request.method, "path": request.url.path, "status_code": res.status_code,
+                   "headers": headers, "body": content}, f)
+    stats["recorded"] += 1
+    return JSONResponse(status_code=res.status_code, content=content, headers=headers)
+
+
+@app.middleware("http")
+async def record_replay_middleware(request: Request, call_next):
+    if FAKE_API_MODE == "synthetic" or request.url.path.startswith("/fake"):
+        return await call_next(request)
+    for service in ("etsy", "stallion"):
+        prefix = "/etsy/v2/" if service == "etsy" else "/stallion/"
+        if request.url.path.startswith(prefix):
+            return await record_or_replay(service, request.url.path[len(prefix):], request)
+    return await call_next(request)
+
+
+# ------------------------------------------------------------------ Etsy v2
+
+
+@app.get("/etsy/v2/shops/{shop_id}/receipts")
+async def findAllShopReceipts(shop_id: str, request: Request):
+    shop = get_shop(shop_id)
+    params = dict(request.query_params)
+    includes = includes_of(request)
+    matching = [
+        receipt_id for receipt_id, receipt in shop.receipts.items()
+        if in_range(receipt["creation_tsz"], params, "min_created", "max_created")
+        and in_range(receipt["last_modified_tsz"], params, "min_last_modified", "max_last_modified")
+        and ("was_paid" not in params or str(receipt["was_paid"]).lower() == params["was_paid"])
+    ]
+    matching.sort(key=lambda receipt_id: shop.receipts[receipt_id]["creation_tsz"],
+                  reverse=params.get("sort_order", "down") == "down")
+    page = etsy_page(request, [{"receipt_id": receipt_id} for receipt_id in matching], "Receipt")
+    page["results"] = [only_fields(shop.receipt(result["receipt_id"], includes), params.get("fields"))
+                       for result in page["results"]]
+    return await etsy_response(page)
+
+
+@app.get("/etsy/v2/receipts/{receipt_id_s}")
+async def getShop_Receipt2(receipt_id_s: str, request: Request):
+    includes = includes_of(request)
+    results = []
+    for receipt_id in ids_of(receipt_id_s):
+        shop = find_shop_of_receipt(receipt_id)
+        if shop is not None:
+            results.append(shop.receipt(receipt_id, includes))
+    if len(results) == 0:
+        return not_found(f"Receipt {receipt_id_s} not found")
+    return await etsy_response(etsy_page(request, results, "Receipt"))
+
+
+@app.get("/etsy/v2/receipts/{receipt_id}/transactions")
+async def findAllShop_Receipt2Transactions(receipt_id: int, request: Request):
+    shop = find_shop_of_receipt(receipt_id)
+    if shop is None:
+        return not_found(f"Receipt {receipt_id} not found")
+    return await etsy_response(etsy_page(request, shop.transactions[receipt_id], "Transaction"))
+
+
+@app.get("/etsy/v2/shops/{shop_id}/listings/active")
+async def findAllShopListingsActive(shop_id: str, request: Request):
+    shop = get_shop(shop_id)
+    includes = includes_of(request)
+    active = [shop.listing(listing_id, includes) for listing_id, listing in shop.listings.items()
+              if listing["state"] == "active"]
+    return await etsy_response(etsy_page(request, active, "Listing"))
+
+
+@app.get("/etsy/v2/listings/{listing_id_s}")
+async def getListing(listing_id_s: str, request: Request):
+    includes = includes_of(request)
+    results = []
+    for listing_id in ids_of(listing_id_s):
+        shop = find_shop_of_listing(listing_id)
+        if shop is not None:
+            results.append(shop.listing(listing_id, includes))
+    if len(results) == 0:
+        return not_found(f"Listing {listing_id_s} not found")
+    return await etsy_response(etsy_page(request, results, "Listing"))
+
+
+@app.get("/etsy/v2/listings/{listing_id}/images/{listing_image_id}")
+async def getImage_Listing(listing_id: int, listing_image_id: int, request: Request):
+    return await etsy_response(etsy_page(request, [FakeShop.image(listing_id, listing_image_id)], "ListingImage"))
+
+
+@app.get("/etsy/v2/shipping/templates/{shipping_template_id}")
+async def getShippingTemplate(shipping_template_id: int, request: Request):
+    for shop in shops.values():
+        if shipping_template_id in shop.shipping_templates:
+            return await etsy_response(
+                etsy_page(request, [shop.shipping_templates[shipping_template_id]], "ShippingTemplate"))
+    return not_found(f"ShippingTemplate {shipping_template_id} not found")
+
+
+@app.get("/etsy/v2/users/__SELF__")
+async def getUser(request: Request):
+    return await etsy_response(etsy_page(request, [{"user_id": 1, "login_name": "fakeseller",
+                                                    "primary_email": "seller@example.com"}], "User"))
+
+
+@app.get("/etsy/v2/users/__SELF__/shops")
+async def findAllUserShops(request: Request):
+    return await etsy_response(etsy_page(request, [{
+        "shop_id": 1, "shop_name": "FakeShop", "url": "https://www.etsy.com/shop/FakeShop",
+        "image_url_760x100": None, "icon_url_fullxfull": None}], "Shop"))
+
+
+# ------------------------------------------------------------------ Stallion Express
+
+
+def fake_shipment(order_id: str, ship_code: Optional[str] = None) -> dict:
+    ship_code = ship_code or f"FAKE{hashlib.sha1(str(order_id).encode()).hexdigest()[:10].upper()}"
+    return {
+        "ship_code": ship_code,
+        "order_id": order_id,
+        "status": "ready",
+        "tracking_code": f"92{int(hashlib.sha1(ship_code.encode()).hexdigest(), 16) % 10 ** 20:020d}",
+        "label": base64.b64encode(f"%PDF-1.4 fake label {ship_code}".encode()).decode(),
+    }
+
+
+async def stallion_response(body: dict, status_code: int = 200) -> JSONResponse:
+    stats["requests"] += 1
+    await inject_latency()
+    if random.random() < FAKE_API_ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse(status_code=503, content={"success": False, "message": "Service unavailable"})
+    return JSONResponse(status_code=status_code, content=body)
+
+
+@app.get("/stallion/shipments")
+async def stallion_shipments(request: Request):
+    order_id = request.query_params.get("order_id")
+    data = [fake_shipment(order_id)] if order_id is not None else []
+    return await stallion_response({"success": True, "data": data, "total": len(data)})
+
+
+@app.get("/stallion/shipments/{ship_code}")
+async def stallion_shipment(ship_code: str):
+    return await stallion_response(fake_shipment(ship_code, ship_code))
+
+
+@app.post("/stallion/shipments")
+async def stallion_purchase_label(request: Request):
+    body = await request.json()
+    return await stallion_response({"success": True, "shipment": fake_shipment(body.get("order_id"))}, 201)
+
+
+@app.get("/stallion/track")
+async def stallion_track(order_id: str):
+    shipment = fake_shipment(order_id)
+    return await stallion_response({"success": True, "details": {"ship_code": shipment["ship_code"],
+                                                                 "status": shipment["status"]}})
+
+
+# ------------------------------------------------------------------ control
+
+
+@app.get("/fake/stats")
+async def fake_stats():
+    return {"mode": FAKE_API_MODE, **stats, "daily_remaining": etsy_limits.remaining,
+            "shops": {shop_id: len(shop.receipts) for shop_id, shop in shops.items()}}
+
+
+@app.post("/fake/reset")
+async def fake_reset():
+    global etsy_limits
+    shops.clear()
+    etsy_limits = FakeEtsyLimits()
+    for k in stats:
+        stats[k] = 0
+    return await fake_stats()
@@ -1,15 +1,15 @@
-import os
+import asyncio
 
-import redis
-from rq import Worker, Queue, Connection
+# Jobs run one after another on this loop instead of a fresh one per job, so the
+# pooled Etsy, Redis and MongoDB clients are created before the first job and reused.
+asyncio.set_event_loop(asyncio.new_event_loop())
 
-listen = ['high', 'default', 'low']
+from rq import SimpleWorker
 
-redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
-
-conn = redis.from_url(redis_url)
+from SyncQueue import SyncQueue
 
 if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(map(Queue, listen))
-        worker.work()
+    sync_queue = SyncQueue()
+    # SimpleWorker runs jobs in this process (no fork per job), the scheduler requeues busy shops.
+    worker = SimpleWorker([sync_queue.queue], connection=sync_queue.connection)
+    worker.work(with_scheduler=True)